@@ -0,0 +1,233 @@
+"""
+    A compact in memory rdflib store.
+
+    Terms are interned into integer ids and each of the spo, pos, and
+    osp orderings of the triples is kept as a list of sorted blocks.
+    A block is a pair of array('q'), the first two ids of each triple
+    are packed into one int in the first array and the third id goes
+    in the second, so all lookups are bisects over the arrays.
+
+    New triples go into a small write buffer that is flushed into a
+    new block before any read. Blocks of similar size are merged so
+    there are only ever O(log n) of them.
+
+    Terms are never un-interned, a term stays in the table after the
+    last triple using it is removed, so a store that sees a lot of
+    churn keeps growing. The packing limits a store to 2 ** 31 terms.
+
+    Usage: OntGraph(store='pyontutils-compact')
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from heapq import merge
+from rdflib.store import Store
+
+_shift = 32
+_mask = (1 << _shift) - 1
+# the first id is shifted into the high half of a signed 64 bit int
+_max_terms = 1 << (63 - _shift)
+
+# positions of s p o in each ordering
+_spo = 0, 1, 2
+_pos = 1, 2, 0
+_osp = 2, 0, 1
+
+
+def _merge_blocks(x, y):
+    ab, c = array('q'), array('q')
+    for k, v in merge(zip(*x), zip(*y)):
+        ab.append(k)
+        c.append(v)
+
+    return ab, c
+
+
+def _block_range(ab, cs, a, b, c):
+    """ the slice of a block matching the prefix a b c, trailing Nones are wildcards """
+    if a is None:
+        return 0, len(ab)
+    elif b is None:
+        start = a << _shift
+        return bisect_left(ab, start), bisect_left(ab, start + (1 << _shift))
+
+    k = a << _shift | b
+    i = bisect_left(ab, k)
+    j = bisect_right(ab, k, i)
+    if c is None:
+        return i, j
+
+    n = bisect_left(cs, c, i, j)
+    return n, (n + 1 if n < j and cs[n] == c else n)
+
+
+class CompactStore(Store):
+    """ Interned terms and sorted array indexes, not context aware. """
+
+    # number of new triples held before they are written into a block
+    buffer_size = 10000
+
+    # above this many removals blocks are filtered instead of deleted from
+    _bulk_remove = 64
+
+    def __init__(self, configuration=None, identifier=None):
+        super().__init__(configuration)
+        self.identifier = identifier
+        self._ids = {}
+        self._terms = []
+        self._buffer = set()
+        self._indexes = {_spo: [], _pos: [], _osp: []}
+        self._len = 0
+        self._namespace = {}
+        self._prefix = {}
+
+    def _intern(self, term):
+        """ the id for term, terms are kept even if all their triples are removed """
+        try:
+            return self._ids[term]
+        except KeyError:
+            i = len(self._terms)
+            if i >= _max_terms:
+                raise OverflowError(f'{self.__class__.__name__} is limited '
+                                    f'to {_max_terms} distinct terms')
+
+            self._ids[term] = i
+            self._terms.append(term)
+            return i
+
+    def _flush(self):
+        if not self._buffer:
+            return
+
+        buffer, self._buffer = self._buffer, set()
+        for (x, y, z), blocks in self._indexes.items():
+            pairs = sorted((t[x] << _shift | t[y], t[z]) for t in buffer)
+            blocks.append((array('q', [k for k, _ in pairs]),
+                           array('q', [v for _, v in pairs])))
+            while len(blocks) > 1 and len(blocks[-2][0]) < 2 * len(blocks[-1][0]):
+                y_block = blocks.pop()
+                x_block = blocks.pop()
+                blocks.append(_merge_blocks(x_block, y_block))
+
+    def _find(self, order, ids):
+        """ the block and position of one fully bound triple """
+        x, y, z = order
+        for ab, cs in self._indexes[order]:
+            i, j = _block_range(ab, cs, ids[x], ids[y], ids[z])
+            if i != j:
+                return ab, cs, i
+
+    def _match(self, triple):
+        """ matching triples as spo ids """
+        ids = []
+        for term in triple:
+            if term is None:
+                ids.append(None)
+            elif term in self._ids:
+                ids.append(self._ids[term])
+            else:  # a term we have never seen matches nothing
+                return
+
+        self._flush()
+        s, p, o = ids
+        if s is not None:
+            order = _osp if p is None and o is not None else _spo
+        elif p is not None:
+            order = _pos
+        elif o is not None:
+            order = _osp
+        else:
+            order = _spo
+
+        x, y, z = order
+        a, b, c = ids[x], ids[y], ids[z]
+        for ab, cs in list(self._indexes[order]):
+            i, j = _block_range(ab, cs, a, b, c)
+            for k, v in zip(ab[i:j], cs[i:j]):
+                t = [None, None, None]
+                t[x], t[y], t[z] = k >> _shift, k & _mask, v
+                yield tuple(t)
+
+    def add(self, triple, context, quoted=False):
+        ids = tuple(self._intern(t) for t in triple)
+        if ids in self._buffer or self._find(_spo, ids) is not None:
+            return
+
+        self._buffer.add(ids)
+        self._len += 1
+        if len(self._buffer) >= self.buffer_size:
+            self._flush()
+
+    def addN(self, quads):
+        for s, p, o, c in quads:
+            self.add((s, p, o), c)
+
+    def remove(self, triple, context=None):
+        self._flush()
+        if triple == (None, None, None):
+            self._indexes = {order: [] for order in self._indexes}
+            self._len = 0
+            return
+
+        removed = list(self._match(triple))
+        if not removed:
+            return
+
+        for order, blocks in self._indexes.items():
+            if len(removed) <= self._bulk_remove:
+                for ids in removed:
+                    ab, cs, i = self._find(order, ids)
+                    del ab[i]
+                    del cs[i]
+            else:
+                x, y, z = order
+                drop = set((t[x] << _shift | t[y], t[z]) for t in removed)
+                for n, (ab, cs) in enumerate(blocks):
+                    keep = [(k, v) for k, v in zip(ab, cs) if (k, v) not in drop]
+                    if len(keep) != len(ab):
+                        blocks[n] = (array('q', [k for k, _ in keep]),
+                                     array('q', [v for _, v in keep]))
+
+            blocks[:] = [block for block in blocks if block[0]]
+
+        self._len -= len(removed)
+
+    def triples(self, triple, context=None):
+        terms = self._terms
+        for s, p, o in self._match(triple):
+            yield (terms[s], terms[p], terms[o]), iter(())
+
+    def __len__(self, context=None):
+        return self._len
+
+    def contexts(self, triple=None):
+        return iter(())
+
+    def bind(self, prefix, namespace, override=True):
+        # same behavior as the rdflib memory stores
+        bound_namespace = self._namespace.get(prefix)
+        bound_prefix = self._prefix.get(namespace)
+        if bound_prefix is None:
+            bound_prefix = self._prefix.get(bound_namespace)
+
+        if override:
+            if bound_prefix is not None:
+                del self._namespace[bound_prefix]
+            if bound_namespace is not None:
+                del self._prefix[bound_namespace]
+
+            self._prefix[namespace] = prefix
+            self._namespace[prefix] = namespace
+        else:
+            namespace = namespace if bound_namespace is None else bound_namespace
+            prefix = prefix if bound_prefix is None else bound_prefix
+            self._prefix[namespace] = prefix
+            self._namespace[prefix] = namespace
+
+    def namespace(self, prefix):
+        return self._namespace.get(prefix, None)
+
+    def prefix(self, namespace):
+        return self._prefix.get(namespace, None)
+
+    def namespaces(self):
+        yield from self._namespace.items()
@@ -1,11 +1,13 @@
 import io
 import os
 import re
+import bisect
 import json
 import yaml
 import types
 import gzip
 import zipfile
+import shutil
 import tempfile
 import mimetypes
 import subprocess
@@ -13,7 +15,7 @@ import idlib
 import rdflib
 from inspect import getsourcefile
 from pathlib import Path, PurePath
-from itertools import chain
+from itertools import chain, islice
 from collections import namedtuple, defaultdict
 from urllib.parse import urlparse
 import ontquery as oq
@@ -23,7 +25,7 @@ from rdflib.extras import infixowl
 from ttlser import CustomTurtleSerializer, natsort
 from pyontutils import combinators as cmb
 from pyontutils import closed_namespaces as cnses
-from pyontutils.johnson import simple_cycles
+from pyontutils.johnson import simple_cycles, cyclic_components
 from pyontutils.utils import (refile,
                               TODAY,
                               UTCNOW,
@@ -51,7 +53,7 @@ from pyontutils.namespaces import (makePrefixes,
                                    prov,
                                    oboInOwl,
                                    replacedBy,)
-from pyontutils.identity_bnode import IdentityBNode, bnNone, idf, it as ibn_it
+from pyontutils.identity_bnode import IdentityBNode, IdentityCache, bnNone, idf, it as ibn_it
 
 current_file = Path(__file__).absolute()
 oq.utils.log.removeHandler(oq.utils.log.handlers[0])
@@ -358,25 +360,56 @@ class OntRes(idlib.Stream):
             ic_res = list(self.import_chain)
             all_res = [self] + ic_res  # TODO consider retaining in debug case
             merged = self.Graph()
-            _ = [merged.namespace_manager.populate_from(ontres.metadata().graph) for ontres in all_res]
+            # namespaces are merged once per source graph
+            for ontres in all_res:
+                merged.namespace_manager.populate_from(ontres.metadata().graph)
+
+            merged.populate_from_triples(self._import_closure_metadata(
+                ic_res, import_ontology_type, import_ontology_predicate))
+            for ontres in all_res:
+                merged.populate_from(ontres.graph.data)
+
+            self._ic_graph = merged
+
+        return self._ic_graph
+
+    def import_closure_view(
+            self,
+            import_ontology_type=ilxtr.Ontology,
+            import_ontology_predicate=ilxtr.imports):
+        """ the same triples as import_closure_graph as a read-only
+            OntGraphUnion over the graphs in the chain, only the
+            metadata sections are copied so this is the one to use
+            when the closure is only queried """
+        if not hasattr(self, '_ic_view'):
+            ic_res = list(self.import_chain)
+            all_res = [self] + ic_res
+            header = self.Graph(bind_namespaces='none')
+            for ontres in all_res:
+                header.namespace_manager.populate_from(ontres.metadata().graph)
+
+            header.populate_from_triples(self._import_closure_metadata(
+                ic_res, import_ontology_type, import_ontology_predicate))
+            graphs = [ontres.graph for ontres in all_res]
+            # hide the original metadata sections, header has the swapped versions
+            exclude = [()] + [graph._metadata_subjects() for graph in graphs]
+            self._ic_view = OntGraphUnion([header] + graphs, exclude=exclude)
+
+        return self._ic_view
+
+    def _import_closure_metadata(self, ic_res, import_ontology_type, import_ontology_predicate):
+        def swap_imports(t):
             # swap owl:imports for ilxtr:imports to avoid double import in merged file but still allow tracing the chain
-            _ = [merged.add(t)
-                 if t[1] != owl.imports
-                 else merged.add((t[0], import_ontology_predicate, t[2]))
-                 for t in self.graph.metadata()]
+            return t if t[1] != owl.imports else (t[0], import_ontology_predicate, t[2])
+
+        def swap_ontology(t):
             # ensure that there is only a single top level owl:Ontology but retain imported metadata sections
             # also have to swap the owl:imports for ilxtr:imports in this case as well because owlapi will
             # type pun and infer types super hard and thus pull in all the transitive chain >_<
-            _ = [(merged.add(t)
-                  if t[1] != owl.imports
-                  else merged.add((t[0], import_ontology_predicate, t[2])))
-                 if t[2] != owl.Ontology
-                 else merged.add((t[0], t[1], import_ontology_type))
-                 for ontres in ic_res for t in ontres.graph.metadata()]
-            _ = [merged.add(t) for ontres in all_res for t in ontres.graph.data]
-            self._ic_graph = merged
+            return swap_imports(t) if t[2] != owl.Ontology else (t[0], t[1], import_ontology_type)
 
-        return self._ic_graph
+        yield from (swap_imports(t) for t in self.graph.metadata())
+        yield from (swap_ontology(t) for ontres in ic_res for t in ontres.graph.metadata())
 
     def __eq__(self, other):
         raise NotImplementedError
@@ -529,6 +562,9 @@ class OntResOnt(OntRes):
 
     _metadata_class = None  # FIXME can we do this by dispatching OntMeta like Path?
 
+    # raw bytes held in memory by identity_next before spilling to disk
+    identity_spool_size = 2 ** 24
+
     def __eq__(self, other):
         return self.metadata().identifier_bound == other.metadata().identifier_bound
 
@@ -996,6 +1032,9 @@ class OntResIri(OntIdIri, OntResOnt):
             #return None
 
         if compute_identity:
+            # self._identity is a checksum of the raw bytes, not a graph
+            # identity, IncrementalIdentity and IdentityBNode need parsed
+            # triples so this stays a plain cypher over the chunks
             def makegen():
                 if hasattr(self.Graph, 'IdentityBNode'):
                     m = self.Graph.IdentityBNode.cypher()
@@ -1013,6 +1052,42 @@ class OntResIri(OntIdIri, OntResOnt):
         else:
             return chain(header_chunks, gen)
 
+    def identity_next(self, *, idbn_class=None, cache=None, **kwargs):
+        """ identity of the graph, served from an IdentityCache keyed on
+            the sha256 of the raw bytes when they have been seen before,
+            in which case the graph is never parsed, embedded identities
+            for named subjects are set on self.subject_identities """
+        if idbn_class is None:
+            idbn_class = getattr(self.Graph, 'IdentityBNode', IdentityBNode)
+
+        if cache is None:
+            cache = IdentityCache()
+
+        # the cache key is only known after the last chunk so the chunks
+        # are spooled instead of parsed as they arrive, a hit never parses
+        with tempfile.SpooledTemporaryFile(max_size=self.identity_spool_size) as spool:
+            for chunk in self.data_next(compute_identity=True, **kwargs):
+                spool.write(chunk)
+
+            version = cache.version_key(idbn_class.default_version, idbn_class)
+            hit = cache.get(self._identity, version, self.format)
+            if hit is not None:
+                identity, self.subject_identities = hit
+                return identity
+
+            spool.seek(0)
+            graph = self.Graph(bind_namespaces='none')
+            self._populate(graph, iter(lambda: spool.read(2 ** 16), b''))
+
+        self._graph = graph
+        ibn = idbn_class(graph)
+        embedded = idf['(s ((p o) ...))']
+        self.subject_identities = {
+            s: v for (s, *rest), v in ibn._if_cache.partition_items(graph)
+            if rest == [embedded] and isinstance(s, rdflib.URIRef)}
+        cache.put(self._identity, version, self.format, ibn.identity, self.subject_identities)
+        return ibn.identity
+
     @property
     def data(self):
         try:
@@ -1169,6 +1244,7 @@ class OntResPath(OntIdPath, OntResOnt):
     _metadata_class = OntMetaPath
     data = OntResIri.data
     data_next = OntResIri.data_next
+    identity_next = OntResIri.identity_next
 
     _populate = OntResIri._populate  # FIXME application/rdf+xml is a mess ... cant parse streams :/
 
@@ -1245,6 +1321,7 @@ class OntResGit(OntIdGit, OntResOnt):
     _metadata_class = OntMetaGit
     data = OntResIri.data
     data_next = OntResIri.data_next
+    identity_next = OntResIri.identity_next
 
     _populate = OntResIri._populate  # FIXME application/rdf+xml is a mess ... cant parse streams :/
 
@@ -1454,6 +1531,91 @@ class BetterNamespaceManager(rdflib.namespace.NamespaceManager):
         return self  # allow chaining
 
 
+def _bnode_units(graph, triples):
+    """ map each triple that involves a bnode to the bnode structures
+        that contain it, a structure is (subject, predicate, bnode)
+        for a bnode pointed to by a named subject or (None, None, bnode)
+        for a free bnode head """
+    up = {}
+    def units(node):
+        # iterative post order walk up the bnode parents, long rdf
+        # lists are too deep to recurse, nodes that are still on the
+        # stack contribute nothing so cycles terminate
+        stack = [(node, None)]
+        while stack:
+            n, parents = stack.pop()
+            if parents is None:
+                if n in up:
+                    continue
+
+                up[n] = None
+                parents = list(graph.subject_predicates(n))
+                stack.append((n, parents))
+                stack.extend((s, None) for s, p in parents
+                             if isinstance(s, rdflib.BNode) and s not in up)
+            else:
+                out = set() if parents else {(None, None, n)}
+                for s, p in parents:
+                    if isinstance(s, rdflib.BNode):
+                        out.update(up[s] or ())
+                    else:
+                        out.add((s, p, n))
+
+                up[n] = out
+
+        return up[node]
+
+    found = {}
+    for t in triples:
+        s, p, o = t
+        if isinstance(s, rdflib.BNode):
+            found[t] = units(s)
+        elif isinstance(o, rdflib.BNode):
+            found[t] = {t}
+
+    return found
+
+
+def _bnode_unit_keys(graph, triple_units, idbn_class):
+    """ (subject, predicate, condensed identity of the bnode) for each
+        bnode structure, None if there are bnode cycles """
+    all_units = set(u for us in triple_units.values() for u in us)
+    bnodes = set(b for s, p, b in all_units)
+    if len(triple_units) > len(graph) // 8:
+        # most of the graph is affected, e.g. the same file parsed
+        # twice, hashing it whole is cheaper than copying it out
+        g = graph
+        idbn_class.cache_discard(g)
+    else:
+        g = OntGraph().populate_from_triples(_bnode_closure_triples(graph, bnodes))
+
+    try:
+        ibn = idbn_class(g)
+    except NotImplementedError:
+        return None
+
+    condensed = idf['((p o) ...)']
+    idents = {s: v for (s, *rest), v in ibn._if_cache.partition_items(g)
+              if rest == [condensed] and s in bnodes}
+    return {(s, p, b): (s, p, idents.get(b, b)) for s, p, b in all_units}
+
+
+def _bnode_closure_triples(graph, bnodes):
+    """ the triples of each bnode and of the bnodes it points to """
+    seen = set()
+    stack = list(bnodes)
+    while stack:
+        b = stack.pop()
+        if b in seen:
+            continue
+
+        seen.add(b)
+        for p, o in graph.predicate_objects(b):
+            yield b, p, o
+            if isinstance(o, rdflib.BNode):
+                stack.append(o)
+
+
 class OntGraph(rdflib.Graph):
     """ A 5th try at making one of these. ConjunctiveGraph version? """
 
@@ -1524,6 +1686,25 @@ class OntGraph(rdflib.Graph):
                                  _set_namespace_manager,
                                  doc="this graph's namespace-manager")
 
+    # number of triples passed to each addN call by populate_from_triples
+    populate_batch_size = 10000
+
+    # bumped on every change made through the graph, together with
+    # len(self) this tells lazily built indexes when to rebuild
+    _mutations = 0
+
+    def add(self, triple):
+        self._mutations += 1
+        return super().add(triple)
+
+    def addN(self, quads):
+        self._mutations += 1
+        return super().addN(quads)
+
+    def remove(self, triple):
+        self._mutations += 1
+        return super().remove(triple)
+
     def compute_qname(self, uri, generate=False):
         # XXX need to flip to generate=False so that things like
         # infixowl can't silently insert madness into namespaces
@@ -1599,20 +1780,64 @@ class OntGraph(rdflib.Graph):
             if fd is not None:
                 os.close(fd)
 
+    def _namespace_index(self):
+        """ sorted strings of every uri in the graph, built on first use
+            and rebuilt when the graph has changed since """
+        key = self._mutations, len(self)
+        if getattr(self, '_namespace_index_key', None) != key:
+            self._namespace_index_iris = sorted(
+                set(str(e) for t in self for e in t if isinstance(e, rdflib.URIRef)))
+            self._namespace_index_key = key
+
+        return self._namespace_index_iris
+
     def matchNamespace(self, namespace, *, ignore_predicates=tuple()):
-        """ find all uris that have namespace as their prefix """
-        # FIXME can't we hit the cache for these?
+        """ find all uris that have namespace as their prefix
+
+            namespace must be bound and uris that fall under a longer
+            bound namespace or that split into a longer namespace are
+            not included, this matches compute_qname without calling it
+            so the namespace manager is not touched, each uri is yielded
+            once in sorted order """
         sns = str(namespace)
-        for s, p, o in self:
-            if p not in ignore_predicates:
-                for e in (s, p, o):
-                    if isinstance(e, rdflib.URIRef):
-                        try:
-                            pre, ns, suff = self.compute_qname(e, generate=False)
-                            if str(ns) == sns:
-                                yield e
-                        except KeyError:
-                            pass
+        bound = set(str(n) for p, n in self.namespace_manager.namespaces())
+        if sns not in bound:
+            return
+
+        # the sub ranges belonging to longer namespaces are skipped
+        # so time is proportional to the number of matches
+        longer = []
+        for b in sorted(b for b in bound if b.startswith(sns) and b != sns):
+            if not longer or not b.startswith(longer[-1]):
+                longer.append(b)  # nested namespaces are covered by the shortest
+
+        iris = self._namespace_index()
+        i = bisect.bisect_left(iris, sns)
+        while i < len(iris) and iris[i].startswith(sns):
+            iri = iris[i]
+            j = bisect.bisect_right(longer, iri) - 1
+            if j >= 0 and iri.startswith(longer[j]):
+                i = bisect.bisect_left(iris, longer[j] + '\U0010ffff', i)
+                continue
+
+            i += 1
+            try:
+                split_ns, _ = rdflib.namespace.split_uri(iri)
+            except ValueError:
+                # no local name, only the namespace itself can match
+                split_ns = iri
+
+            if len(split_ns) > len(sns):
+                continue
+
+            e = rdflib.URIRef(iri)
+            if ignore_predicates and not (
+                    (e not in ignore_predicates and (None, e, None) in self) or
+                    any(p not in ignore_predicates for p in self.predicates(e, None)) or
+                    any(p not in ignore_predicates for p in self.predicates(None, e))):
+                continue
+
+            yield e
 
     def couldMapEntities(self, *temp_namespaces, ignore_predicates=tuple()):
         yield from (e for ns in temp_namespaces
@@ -1642,20 +1867,67 @@ class OntGraph(rdflib.Graph):
 
         return add, rem, same
 
-    def diffFromGraph(self, graph):
-        # FIXME extremely inefficient
-        add, rem, same = [self.__class__() for _ in range(3)]
-        for t in self:
-            if t in graph:
-                same.add(t)
-            else:
-                rem.add(t)
+    def diffFromGraph(self, graph, *, subjects=False, idbn_class=None):
+        """ compute add, remove, same graphs going from self to graph
 
-        for t in graph:
-            if t not in self:
-                add.add(t)
+            triples are compared as sets, then bnode structures that only
+            differ by bnode ids are matched by the IdentityBNode digest of
+            the top bnode together with the subject and predicate that
+            point to it and are counted as same, keeping the self side
 
-        return add, rem, same
+            with subjects=True also return a dict with the added, removed,
+            and changed named subjects """
+        if idbn_class is None:
+            idbn_class = self.IdentityBNode
+
+        s_trips = set(self)
+        o_trips = set(graph)
+        same_trips = s_trips & o_trips
+        rem_trips = s_trips - same_trips
+        add_trips = o_trips - same_trips
+        del s_trips, o_trips
+
+        s_units = _bnode_units(self, rem_trips)
+        o_units = _bnode_units(graph, add_trips)
+        if s_units and o_units:
+            s_keys = _bnode_unit_keys(self, s_units, idbn_class)
+            o_keys = _bnode_unit_keys(graph, o_units, idbn_class)
+            s_matched, o_matched = set(), set()
+            if s_keys is not None and o_keys is not None:
+                by_key = defaultdict(list)
+                for unit, key in o_keys.items():
+                    by_key[key].append(unit)
+
+                for unit, key in s_keys.items():
+                    if by_key[key]:
+                        s_matched.add(unit)
+                        o_matched.add(by_key[key].pop())
+
+            moved = {t for t, us in s_units.items() if us and us <= s_matched}
+            rem_trips -= moved
+            same_trips |= moved
+            add_trips -= {t for t, us in o_units.items() if us and us <= o_matched}
+
+        add, rem, same = [self.__class__().populate_from_triples(ts)
+                          for ts in (add_trips, rem_trips, same_trips)]
+        if not subjects:
+            return add, rem, same
+
+        touched = set()
+        for trips, units in ((rem_trips, s_units), (add_trips, o_units)):
+            for t in trips:
+                if isinstance(t[0], rdflib.URIRef):
+                    touched.add(t[0])
+                elif t in units:
+                    touched.update(s for s, p, b in units[t] if s is not None)
+
+        in_self = {s: (s, None, None) in self for s in touched}
+        in_graph = {s: (s, None, None) in graph for s in touched}
+        subjects = dict(
+            added={s for s in touched if in_graph[s] and not in_self[s]},
+            removed={s for s in touched if in_self[s] and not in_graph[s]},
+            changed={s for s in touched if in_self[s] and in_graph[s]},)
+        return add, rem, same, subjects
 
     def subjectGraph(self, subject, bnode_multi_parent=False):
         return self._pop_new_from_gen(self.subject_triples(subject, bnode_multi_parent=bnode_multi_parent))
@@ -1666,6 +1938,64 @@ class OntGraph(rdflib.Graph):
     def subjectsGraph(self, subjects, bnode_multi_parent=False):
         return self._pop_new_from_gen(self.subjects_triples(subjects, bnode_multi_parent=bnode_multi_parent))
 
+    def subjectGraphs(self, subjects):
+        """ subjectGraph for many subjects at once, named subjects are
+            served from an index of bnode closures that is built in a
+            single pass over the graph, returns {subject: graph} """
+        index = self._bnode_closure_index()
+        # binding namespaces one at a time through a namespace manager
+        # dominates the cost of many small graphs, so bind the prefixes
+        # that subjectGraph would produce directly in each store
+        template = list(self._pop_new_from_gen(()).namespaces())
+        out = {}
+        for subject in subjects:
+            if isinstance(subject, rdflib.BNode):
+                out[subject] = self.subjectGraph(subject)
+            else:
+                g = self.__class__(bind_namespaces='none')
+                for prefix, namespace in template:
+                    g.store.bind(prefix, namespace)
+
+                g.addN((s, p, o, g) for s, p, o in index.get(subject, ()))
+                out[subject] = g
+
+        return out
+
+    def _bnode_closure_index(self):
+        """ named subject -> the triples of subject_triples for that
+            subject, built on first use and rebuilt when the graph has
+            changed since """
+        key = self._mutations, len(self)
+        if getattr(self, '_bnode_closure_index_key', None) != key:
+            by_subject = defaultdict(list)
+            for t in self:
+                by_subject[t[0]].append(t)
+
+            index = {}
+            for subject, triples in by_subject.items():
+                if isinstance(subject, rdflib.BNode):
+                    continue
+
+                closure = list(triples)
+                seen = {subject}
+                todo = [o for s, p, o in triples if isinstance(o, rdflib.BNode)]
+                while todo:
+                    bnode = todo.pop()
+                    if bnode in seen:
+                        continue
+
+                    seen.add(bnode)
+                    btriples = by_subject.get(bnode, ())
+                    closure.extend(btriples)
+                    todo.extend(o for s, p, o in btriples if isinstance(o, rdflib.BNode))
+
+                index[subject] = closure
+
+            self._bnode_closure_index_triples = index
+            self._bnode_closure_index_key = key
+
+        return self._bnode_closure_index_triples
+
     def _pop_new_from_gen(self, gen):
         g = self.__class__()
         g.namespace_manager.populate_from(self)
@@ -1784,6 +2114,47 @@ class OntGraph(rdflib.Graph):
 
         return g, ibn
 
+    def subjectIdentities(self, subjects=None, kind='condensed', *, idbn_class=None):
+        """ identities for many subjects at once, computed with a single
+            IdentityBNode traversal of the whole graph so that bnode
+            identities are only resolved once
+
+            values match subjectCondensedIdentity or subjectEmbeddedIdentity
+            depending on kind, subjects defaults to all named subjects """
+        if kind == 'condensed':
+            id_method = idf['((p o) ...)']
+            single = self.subjectCondensedIdentity
+        elif kind == 'embedded':
+            id_method = idf['(s ((p o) ...))']
+            single = self.subjectEmbeddedIdentity
+        else:
+            raise ValueError(f'unknown kind {kind!r}')
+
+        if idbn_class is None:
+            idbn_class = self.IdentityBNode
+
+        if subjects is None:
+            subjects = set(self.named_subjects())
+
+        # the graph may have changed since it was last hashed
+        idbn_class.cache_discard(self)
+        try:
+            ibn = idbn_class(self)
+        except NotImplementedError:
+            # bnode cycles somewhere in the graph, subjects that
+            # are not part of a cycle can still be identified alone
+            ibn = None
+
+        out = {}
+        for subject in subjects:
+            if ibn is not None and (self, subject, id_method) in ibn._if_cache:
+                out[subject] = ibn.__class__(subject, id_method=id_method, in_graph=self)
+            else:
+                # versions < 3 or subjects in cycles
+                out[subject] = single(subject, idbn_class=idbn_class)
+
+        return out
+
     def subjectIdentity(self, subject, *, idbn_class=None, debug=False):
         return self.subjectEmbeddedIdentity(subject, idbn_class=idbn_class, debug=debug)
         #raise NotImplementedError('subject identity is ambiguous use subjectCondensedIdentity or subjectEmbeddedIdentity instead')
@@ -2018,8 +2389,8 @@ class OntGraph(rdflib.Graph):
 
         # FIXME cases where we have :a a owl:Class . :b a owl:Class .
         # in a single graph
-        sid = {self.subjectIdentity(s):s for s in set(self.named_subjects())}
-        oid = {other_graph.subjectIdentity(s):s for s in set(other_graph.named_subjects())}
+        sid = {i:s for s, i in self.subjectIdentities(kind='embedded').items()}
+        oid = {i:s for s, i in other_graph.subjectIdentities(kind='embedded').items()}
         # FIXME triples output vs map?
         mapping = {s:oid[identity] for identity, s in sid.items()
                    if identity in oid and oid[identity] != s}
@@ -2055,8 +2426,8 @@ class OntGraph(rdflib.Graph):
                             #ilxtr.hasTemporaryId,
                             #o) for s, o in self[:ilxtr.hasTemporaryId:]]
 
-        sid = {s:self.subjectIdentity(s) for s in set(self.named_subjects())}
-        osid = {s:other_graph.subjectIdentity(s) for s in set(other_graph.named_subjects())}
+        sid = self.subjectIdentities(kind='embedded')
+        osid = other_graph.subjectIdentities(kind='embedded')
         ssid = set(sid)
         sosid = set(osid)
         added = not_in_other = ssid - sosid
@@ -2232,12 +2603,16 @@ class OntGraph(rdflib.Graph):
         yield from ((s, p, o) for s, p, o in self.metadata()
                     if isinstance(s, rdflib.BNode))
 
-    @property
-    def data(self):
+    def _metadata_subjects(self):
+        """ subjects whose triples are excluded from data """
         bis = tuple(self.boundIdentifiers)
         meta_bnodes = tuple(e for t in self.metadata_unnamed() for e in t
                             if isinstance(e, rdflib.BNode))
-        meta_skip_subject = bis + meta_bnodes
+        return bis + meta_bnodes
+
+    @property
+    def data(self):
+        meta_skip_subject = self._metadata_subjects()
         for s, p, o in self:
             if s not in meta_skip_subject:  # FIXME conjunctive for performance
                 yield (s, p, o)
@@ -2299,42 +2674,120 @@ class OntGraph(rdflib.Graph):
 
         return graph
 
-    def populate_from(self, graph):
-        for t in graph:
-            self.add(t)
-
-        return self
+    def populate_from(self, graph, batch_size=None):
+        return self.populate_from_triples(graph, batch_size=batch_size)
+
+    def populate_from_triples(self, generator, batch_size=None):
+        """ add triples in batches of batch_size with addN, defaults to
+            populate_batch_size, namespaces are not copied """
+        if batch_size is None:
+            batch_size = self.populate_batch_size
+
+        # conjunctive graphs add single triples to their default context
+        context = getattr(self, 'default_context', self)
+        triples = iter(generator)
+        while True:
+            batch = [(s, p, o, context) for s, p, o in islice(triples, batch_size)]
+            if not batch:
+                break
 
-    def populate_from_triples(self, generator):
-        for t in generator:
-            self.add(t)
+            self.addN(batch)
 
         return self
 
     def _genNodesEdges(self, triples_gen, label_predicate):
         nodes = []
         edges = []
-        done = set()
+        for kind, blob in self._iterNodesEdges(triples_gen, label_predicate):
+            if kind == 'node':
+                nodes.append(blob)
+            else:
+                edges.append(blob)
+
+        return nodes, edges
+
+    def _annotationIndex(self, label_predicate):
+        """ labels and deprecation for every node in one pass per predicate
+            instead of two graph queries per node, nodes with more than
+            one value are marked with None so that they are still looked
+            up individually and get the same value as before """
+        labels = {}
+        for s, o in self[:label_predicate:]:
+            labels[s] = None if s in labels else o
+
+        deprecated = {}
+        for s, o in self[:owl.deprecated:]:
+            deprecated[s] = None if s in deprecated else o
+
+        return labels, deprecated
+
+    def _iterNodesEdges(self, triples_gen, label_predicate):
+        """ yield ('edge', blob) for each triple followed by ('node', blob)
+            for each element of the triple not seen before """
+        labels, deprecated = self._annotationIndex(label_predicate)
+        nm = self.namespace_manager
+        sdep = owl.deprecated.toPython()
+        curies = {}  # also serves as the set of nodes already done
+        def curie(e):
+            if e not in curies:
+                curies[e] = nm._qhrm(e)
+
+            return curies[e]
+
         for t in triples_gen:
-            edge = Edge(t)
-            edges.append(edge.asOboGraph(self.namespace_manager))
+            s, p, o = t
+            # same as Edge(t).asOboGraph(nm) without computing qnames twice
+            new = []
             for e in t:
-                if e in done:
-                    continue
+                if e not in curies and e not in new:
+                    new.append(e)
+
+            yield 'edge', {'sub': curie(s), 'pred': curie(p), 'obj': curie(o)}
+            for e in new:
+                lbl = labels.get(e, e)
+                if lbl is None:
+                    lbl = next(self[e:label_predicate])
+
+                lbl = lbl.toPython()
+                dep = deprecated.get(e, e)
+                if dep is None:
+                    meta = {sdep: d.toPython() for d in self[e:owl.deprecated]}
+                elif dep is e:
+                    meta = {}
+                else:
+                    meta = {sdep: dep.toPython()}
 
-                done.add(e)
+                yield 'node', {'id': curies[e], 'lbl': lbl, 'meta': meta}
 
-                try:
-                    lbl = next(self[e:label_predicate]).toPython()
-                except StopIteration:
-                    lbl = e.toPython()
+    def _oboGraphTriples(self, predicate, restriction):
+        restriction = predicate is not None and restriction
 
-                meta = {owl.deprecated.toPython():o.toPython() for o in self[e:owl.deprecated]}
-                node = {'id': self.namespace_manager._qhrm(e),
-                        'lbl': lbl, 'meta': meta}
-                nodes.append(node)
+        if predicate is None or isinstance(predicate, rdflib.URIRef):
+            pass
+        elif predicate == 'isDefinedBy':
+            predicate = self.namespace_manager.expand('rdfs:isDefinedBy')
+        else:
+            predicate = self.namespace_manager.expand(predicate)
 
-        return nodes, edges
+        if not restriction:
+            if predicate is None:
+                # FIXME this needs to implement the full conversion rules
+                # otherwise the bnodes flood everything, this is probably
+                # the real use case for the combinators
+                gen = (t for t in self
+                       if not isinstance(t[-1], rdflib.Literal))
+            else:
+                gen = ((s, predicate, o) for s, o in self[:predicate:]
+                       if not [e for e in (s, o) if isinstance(e, rdflib.BNode)])
+        else:
+            # TODO consider using the combinators here ?
+            gen = ((s, predicate, o)
+                   for s_bnode in self[:owl.onProperty:predicate]
+                   for s in self[:rdfs.subClassOf:s_bnode]
+                   for p in (owl.someValuesFrom,)  # I don't think we would want all values from?
+                   for o in self[s_bnode:p])
+
+        return gen
 
     def cycle_check(self):
         """ check immediate cycles between bnodes """
@@ -2346,9 +2799,15 @@ class OntGraph(rdflib.Graph):
 
         return cycle_participants
 
-    def cycle_check_long(self, btc_node=None):
+    def cycle_check_long(self, btc_node=None, scc_only=False):
+        """ find bnode cycles, by default every simple cycle is returned as
+            a list of triples, with scc_only=True the strongly connected
+            components are returned instead, one list of triples per
+            component, which is linear in the size of the graph even when
+            there are exponentially many cycles """
         # use jonhson simple cycle detection because doing anything else is stupid
-        # tarjan scc doesn't work by itself in this case
+        # tarjan scc doesn't work by itself in this case, but it does condense
+        # the graph down to the parts that can contain cycles at all
         atrisk = set(s for s in self.subjects(unique=True) if isinstance(s, rdflib.BNode))
         objs = defaultdict(list)
         incoming = defaultdict(list)
@@ -2372,6 +2831,12 @@ class OntGraph(rdflib.Graph):
             for to in trips_with_s_as_object:
                 g[to] = [ts for ts in trips_with_s_as_subject if ts != to or ts in sos]
 
+        sccs = cyclic_components(g)
+        if scc_only:
+            return [[lu[t] for t in scc] for scc in sccs]
+
+        members = set(t for scc in sccs for t in scc)
+        g = {t: [ts for ts in g[t] if ts in members] for t in members}
         _cycles = list(simple_cycles(g))
 
         cycles = [[lu[t] for t in c] for c in _cycles]
@@ -2384,35 +2849,33 @@ class OntGraph(rdflib.Graph):
         else:
             label_predicate = self.namespace_manager.expand(label_predicate)  # FIXME oh boy this will break stuff
 
-        restriction = predicate is not None and restriction
-
-        if isinstance(predicate, rdflib.URIRef):
-            pass
-        elif predicate == 'isDefinedBy':
-            predicate = self.namespace_manager.expand('rdfs:isDefinedBy')
-        else:
-            predicate = self.namespace_manager.expand(predicate)
+        gen = self._oboGraphTriples(predicate, restriction)
+        nodes, edges = self._genNodesEdges(gen, label_predicate)
+        return {'nodes': nodes, 'edges': edges}
 
-        if not restriction:
-            if predicate is None:
-                # FIXME this needs to implement the full conversion rules
-                # otherwise the bnodes flood everything, this is probably
-                # the real use case for the combinators
-                gen = (t for t in self
-                       if not isinstance(t[-1], rdflib.Literal))
-            else:
-                gen = ((s, predicate, o) for s, o in self[:predicate:]
-                       if not [e for e in (s, o) if isinstance(e, rdflib.BNode)])
+    def writeOboGraph(self, file, predicate=None, label_predicate=None, restriction=True):
+        """ write asOboGraph as json to a text file without building it
+            in memory, the output is the same as json.dump of asOboGraph,
+            edges are spooled to a temporary file until the nodes are done """
+        if label_predicate is None:
+            label_predicate = rdfs.label
         else:
-            # TODO consider using the combinators here ?
-            gen = ((s, predicate, o)
-                   for s_bnode in self[:owl.onProperty:predicate]
-                   for s in self[:rdfs.subClassOf:s_bnode]
-                   for p in (owl.someValuesFrom,)  # I don't think we would want all values from?
-                   for o in self[s_bnode:p])
+            label_predicate = self.namespace_manager.expand(label_predicate)  # FIXME oh boy this will break stuff
 
-        nodes, edges = self._genNodesEdges(gen, label_predicate)
-        return {'nodes': nodes, 'edges': edges}
+        gen = self._oboGraphTriples(predicate, restriction)
+        with tempfile.TemporaryFile('w+', encoding='utf-8') as spool:
+            file.write('{"nodes": [')
+            sep = {'node': '', 'edge': ''}
+            for kind, blob in self._iterNodesEdges(gen, label_predicate):
+                out = file if kind == 'node' else spool
+                out.write(sep[kind])
+                out.write(json.dumps(blob))
+                sep[kind] = ', '
+
+            file.write('], "edges": [')
+            spool.seek(0)
+            shutil.copyfileobj(spool, file)
+            file.write(']}')
 
     def fromTabular(self, rows, lifting_rule=None):
         pass
@@ -2472,6 +2935,96 @@ class OntGraphData(OntGraph):
     """ the homogenous everything else """
 
 
+class OntGraphUnion(OntGraph):
+    """ A read-only view of the union of graphs. Nothing is copied,
+        triples are read from the member graphs and a triple that is
+        in more than one member is only yielded by the first of them.
+
+        exclude is an optional sequence parallel to graphs where each
+        entry is a collection of subjects to hide in that member. """
+
+    def __init__(self, graphs, *args, exclude=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        graphs = list(graphs)
+        if exclude is None:
+            exclude = [()] * len(graphs)
+        elif len(exclude) != len(graphs):
+            msg = f'exclude does not match graphs {len(exclude)} != {len(graphs)}'
+            raise ValueError(msg)
+
+        self._members = [(graph, frozenset(ex)) for graph, ex in zip(graphs, exclude)]
+        self.namespace_manager.populate_from(*graphs)
+        self._len = None, None
+        self._shared_subjects = None, None
+
+    @property
+    def graphs(self):
+        return [graph for graph, _ in self._members]
+
+    @property
+    def _mutations(self):
+        # changes to any member invalidate our lazy indexes
+        return tuple((getattr(graph, '_mutations', None), len(graph))
+                     for graph, _ in self._members)
+
+    @property
+    def _shared(self):
+        """ subjects visible in more than one member, triples
+            of any other subject cannot be duplicates """
+        key = self._mutations
+        if self._shared_subjects[0] != key:
+            seen, shared = set(), set()
+            for graph, exclude in self._members:
+                subjects = set(graph.subjects()) - exclude
+                shared |= subjects & seen
+                seen |= subjects
+
+            self._shared_subjects = key, shared
+
+        return self._shared_subjects[1]
+
+    def _union(self, method, *args):
+        shared = self._shared
+        for i, (graph, exclude) in enumerate(self._members):
+            before = self._members[:i]
+            for t in getattr(graph, method)(*args):
+                if t[0] in exclude:
+                    continue
+
+                if (t[0] in shared and
+                    any(t[0] not in bex and t in bg for bg, bex in before)):
+                    continue
+
+                yield t
+
+    def triples(self, triple):
+        s, p, o = triple
+        if isinstance(p, rdflib.paths.Path):
+            for _s, _o in p.eval(self, s, o):
+                yield _s, p, _o
+        else:
+            yield from self._union('triples', triple)
+
+    def triples_choices(self, triple, context=None):
+        yield from self._union('triples_choices', triple)
+
+    def __len__(self):
+        key = self._mutations
+        if self._len[0] != key:
+            self._len = key, sum(1 for _ in self._union('triples', (None, None, None)))
+
+        return self._len[1]
+
+    def add(self, triple):
+        raise rdflib.graph.ModificationException()
+
+    def addN(self, quads):
+        raise rdflib.graph.ModificationException()
+
+    def remove(self, triple):
+        raise rdflib.graph.ModificationException()
+
+
 # TODO bind _ont_class for headers
 
 
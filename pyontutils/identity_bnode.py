@@ -1,9 +1,22 @@
+import io
+import os
 import sys
+import functools
+import bisect
+import shutil
 import hashlib
-from collections import defaultdict
+import sqlite3
+import weakref
+import tempfile
+import itertools
+from collections import defaultdict, OrderedDict
+from contextlib import closing, contextmanager
 import rdflib
 from enum import Enum
+from rdflib.plugins.parsers.ntriples import W3CNTriplesParser
+from ttlser.utils import can_fork, fork_map, ExternalSort
 
+from .johnson import cyclic_components
 from .utils_fast import log as _log
 
 log = _log.getChild('ibnode')
@@ -61,6 +74,7 @@ it = Enum(
      ('ident-seq', 15),
      ('seq-of-ordered-seqs', 16),
      ('empty-seq', 17),
+     ('ntriples-stream', 19),  # see IdentityBNode.from_ntriples_stream
 
      ])
 
@@ -190,6 +204,7 @@ idfun_v3 = {
     it['graph-combined']: idf['graph-combined'],
     it['graph-named']: idf['record-seq'],
     it['graph-bnode']: idf['record-seq'],
+    it['ntriples-stream']: idf['record-seq'],
     #it['']: idf[''],
 }
 
@@ -198,6 +213,10 @@ def bnodes(ts):
     return set(e for t in ts for e in t if isinstance(e, rdflib.BNode))
 
 
+class CycleError(Exception):
+    """ raised by toposort, args[1] is a node in the cycle """
+
+
 def toposort(adj, unmarked_key=None):
     # XXX NOTE adj cannot be a generator
     _dd = defaultdict(list)
@@ -208,27 +227,37 @@ def toposort(adj, unmarked_key=None):
     _values = set([b for a, b in adj])
     starts = list(_keys - _values)
 
-    unmarked = sorted((_keys | _values), key=unmarked_key)
+    ordered = sorted((_keys | _values), key=unmarked_key)
+    unmarked = set(ordered)
     temp = set()
     out = []
     def visit(n):
+        # depth first with an explicit stack so that long lists
+        # and deeply nested bnodes do not hit the recursion limit
         if n not in unmarked:
             return
-        if n in temp:
-            import pprint
-            raise Exception(f'oops you have a cycle {n}\n{pprint.pformat(n)}', n)
 
         temp.add(n)
-        if n in nexts:
-            for m in nexts[n]:
-                visit(m)
+        stack = [(n, iter(nexts.get(n, ())))]
+        while stack:
+            n, ms = stack[-1]
+            for m in ms:
+                if m not in unmarked:
+                    continue
+                if m in temp:
+                    import pprint
+                    raise CycleError(f'oops you have a cycle {m}\n{pprint.pformat(m)}', m)
 
-        temp.remove(n)
-        unmarked.remove(n)
-        out.append(n)
+                temp.add(m)
+                stack.append((m, iter(nexts.get(m, ()))))
+                break
+            else:
+                stack.pop()
+                temp.remove(n)
+                unmarked.remove(n)
+                out.append(n)
 
-    while unmarked:
-        n = unmarked[0]
+    for n in ordered:  # same as repeatedly visiting the first unmarked
         visit(n)
 
     return out
@@ -251,6 +280,419 @@ def split_named_bnode(triple_seq):
     return named, bnode
 
 
+def bnode_components(triple_seq):
+    """ split triples into the components connected by bnodes, triples
+        go with their subject and named objects are leaves so subjects
+        that only share named objects are not connected """
+    triples = list(triple_seq)
+    parent = {}
+    for s, p, o in triples:
+        if isinstance(o, rdflib.BNode):
+            _union(parent, s, o)
+
+    components = defaultdict(list)
+    for t in triples:
+        components[_find(parent, t[0])].append(t)
+
+    return list(components.values())
+
+
+def _find(parent, n):
+    root = n
+    while True:
+        up = parent.setdefault(root, root)
+        if up == root:
+            break
+
+        root = up
+
+    while n != root:  # path compression
+        parent[n], n = root, parent[n]
+
+    return root
+
+
+def _union(parent, a, b):
+    ra, rb = _find(parent, a), _find(parent, b)
+    if ra != rb:
+        parent[ra] = rb
+
+
+def _chunk_components(components, nchunks):
+    target = -(-sum(len(c) for c in components) // max(nchunks, 1))
+    chunks = []
+    chunk = []
+    for component in components:
+        chunk.extend(component)
+        if len(chunk) >= target:
+            chunks.append(chunk)
+            chunk = []
+
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+
+class _Sink:
+    """ minimal sink for rdflib's n-triples parser """
+
+    def __init__(self, triple):
+        self.triple = triple
+
+
+class _NTriplesSource:
+    """ n-triples path or file object that can be parsed more than once,
+        unhashable so that identities are never cached by input """
+
+    __hash__ = None
+
+    def __init__(self, path_or_fileobj, max_sort_bytes):
+        self.path_or_fileobj = path_or_fileobj
+        self.max_sort_bytes = max_sort_bytes
+        self._spooled = None
+
+    @contextmanager
+    def _open(self):
+        pof = self.path_or_fileobj
+        if isinstance(pof, (str, os.PathLike)):
+            with open(pof, 'rb') as f:
+                yield f
+
+        elif self._spooled is not None:
+            self._spooled.seek(0)
+            yield self._spooled
+
+        elif pof.seekable():
+            start = pof.tell()
+            yield pof
+            pof.seek(start)
+
+        else:
+            # copy once so that the stream can be read a second time
+            mode = 'w+' if isinstance(pof, io.TextIOBase) else 'w+b'
+            self._spooled = tempfile.TemporaryFile(mode)
+            shutil.copyfileobj(pof, self._spooled)
+            self._spooled.seek(0)
+            yield self._spooled
+
+    def parse(self, triple, bnode_context):
+        """ call triple(s, p, o) for each triple, pass the same
+            bnode_context to get the same bnodes on each pass """
+        with self._open() as f:
+            W3CNTriplesParser(_Sink(triple)).parse(f, bnode_context=bnode_context)
+
+    def close(self):
+        if self._spooled is not None:
+            self._spooled.close()
+            self._spooled = None
+
+
+def blake2b(digest_size=32):
+    """ a blake2b cypher for IdentityBNode.register_version """
+    cypher = functools.partial(hashlib.blake2b, digest_size=digest_size)
+    cypher.__name__ = f'blake2b_{digest_size * 8}'
+    return cypher
+
+
+def _approx_sizeof(thing, _depth=0, _getsizeof=sys.getsizeof):
+    """ shallow size of thing plus the shallow size of any members of
+        nested tuples and lists, good enough for cache accounting """
+    size = _getsizeof(thing)
+    if _depth < 3 and (type(thing) == tuple or type(thing) == list):
+        for e in thing:
+            te = type(e)
+            if te == tuple or te == list:
+                size += _approx_sizeof(e, _depth + 1)
+            else:
+                size += _getsizeof(e)
+
+    return size
+
+
+class _LRUCache:
+    """ Mapping that evicts least recently used entries once it holds
+        more than max_entries entries or more than approximately max_bytes
+        bytes of keys and values. None disables the respective bound.
+        The most recently set entry is never evicted. """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        if key in self._data:
+            return True
+
+        self.misses += 1
+        return False
+
+    def __getitem__(self, key):
+        try:
+            value, _ = self._data[key]
+        except KeyError:
+            self.misses += 1
+            raise
+
+        self.hits += 1
+        self._data.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            _, old_size = self._data[key]
+            self.nbytes -= old_size
+
+        size = _approx_sizeof(key) + _approx_sizeof(value)
+        self._data[key] = value, size
+        self._data.move_to_end(key)
+        self.nbytes += size
+        self._evict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        # copy so that callers can read while iterating
+        return iter(list(self._data))
+
+    def _evict(self):
+        data = self._data
+        while len(data) > 1 and (
+                (self.max_entries is not None and len(data) > self.max_entries) or
+                (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            _, (_, size) = data.popitem(last=False)
+            self.nbytes -= size
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value, size = self._data.pop(key)
+        except KeyError:
+            if default:
+                return default[0]
+
+            raise
+
+        self.nbytes -= size
+        return value
+
+    def keys(self):
+        return list(self._data)
+
+    def items(self):
+        return [(k, v) for k, (v, _) in self._data.items()]
+
+    def resize(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def clear(self):
+        self._data.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return dict(entries=len(self._data),
+                    bytes=self.nbytes,
+                    hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions)
+
+
+class _GraphScopedCache:
+    """ Cache for _identity_function. Keys that start with a graph,
+        (graph, ...) or ((graph, tag), ...), are stored in a partition
+        that is held via a weak reference to the graph so that results
+        for a graph live exactly as long as the graph does and are never
+        evicted before then since callers such as OntGraph.subjectIdentity
+        read them back out. All other keys are pure memoization and go
+        into a bounded _LRUCache. """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self._graphs = weakref.WeakKeyDictionary()
+        self._last = None
+        self._memo = _LRUCache(max_entries, max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    _graph_types = {}
+
+    @classmethod
+    def _is_graph(cls, thing):
+        # isinstance on rdflib types is slow and this is called for every key
+        t = type(thing)
+        try:
+            return cls._graph_types[t]
+        except KeyError:
+            out = cls._graph_types[t] = issubclass(t, rdflib.Graph)
+            return out
+
+    @classmethod
+    def _split(cls, key):
+        if type(key) == tuple and key:
+            head = key[0]
+            if cls._is_graph(head):
+                return head, None, key[1:]
+            elif (type(head) == tuple and len(head) == 2 and
+                  cls._is_graph(head[0])):
+                return head[0], head[1], key[1:]
+
+        return None, None, key
+
+    @staticmethod
+    def _join(graph, tag, rest):
+        return ((graph,) if tag is None else ((graph, tag),)) + rest
+
+    def _tags(self, graph):
+        # lookups come in long runs for the same graph so skip the
+        # WeakKeyDictionary (and Graph.__eq__) when we can
+        last = self._last
+        if last is not None and last[0]() is graph:
+            return last[1]
+
+        tags = self._graphs.get(graph)
+        if tags is not None:
+            self._last = weakref.ref(graph), tags
+
+        return tags
+
+    def _partition(self, graph, tag):
+        tags = self._tags(graph)
+        if tags is None or tag not in tags:
+            return None
+
+        return tags[tag]
+
+    def __contains__(self, key):
+        graph, tag, rest = self._split(key)
+        if graph is None:
+            return key in self._memo
+
+        part = self._partition(graph, tag)
+        if part is not None and rest in part:
+            return True
+
+        self.misses += 1
+        return False
+
+    def __getitem__(self, key):
+        graph, tag, rest = self._split(key)
+        if graph is None:
+            return self._memo[key]
+
+        part = self._partition(graph, tag)
+        if part is None or rest not in part:
+            self.misses += 1
+            raise KeyError(key)
+
+        self.hits += 1
+        return part[rest]
+
+    def __setitem__(self, key, value):
+        graph, tag, rest = self._split(key)
+        if graph is None:
+            self._memo[key] = value
+            return
+
+        hash(rest)  # raise TypeError for unhashable keys before we create a partition
+        tags = self._tags(graph)
+        if tags is None:
+            tags = self._graphs[graph] = {}
+
+        if tag not in tags:
+            tags[tag] = {}
+
+        tags[tag][rest] = value
+
+    def __len__(self):
+        return (len(self._memo) +
+                sum(len(part) for tags in list(self._graphs.values())
+                    for part in tags.values()))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [k for k, v in self.items()]
+
+    def items(self):
+        out = []
+        for graph, tags in list(self._graphs.items()):
+            for tag, part in tags.items():
+                out.extend((self._join(graph, tag, rest), v) for rest, v in part.items())
+
+        out.extend(self._memo.items())
+        return out
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        graph, tag, rest = self._split(key)
+        if graph is None:
+            return self._memo.pop(key, *default)
+
+        part = self._partition(graph, tag)
+        if part is None or rest not in part:
+            if default:
+                return default[0]
+
+            raise KeyError(key)
+
+        return part.pop(rest)
+
+    def partition_items(self, graph, tag=None):
+        """ (rest, value) for all entries for (graph, tag) """
+        part = self._partition(graph, tag)
+        return [] if part is None else list(part.items())
+
+    def discard(self, graph):
+        self._last = None
+        self._graphs.pop(graph, None)
+
+    def retag(self, graph, new_graph, tag):
+        """ move all untagged entries for graph to (new_graph, tag) """
+        self._last = None
+        tags = self._graphs.pop(graph, None)
+        if tags is None or None not in tags:
+            return
+
+        for rest, value in tags[None].items():
+            self[self._join(new_graph, tag, rest)] = value
+
+    def resize(self, max_entries=None, max_bytes=None):
+        self._memo.resize(max_entries, max_bytes)
+
+    def clear(self):
+        self._last = None
+        self._graphs.clear()
+        self._memo.clear()
+
+    def stats(self):
+        memo = self._memo.stats()
+        return dict(entries=len(self),
+                    bytes=memo['bytes'],
+                    graphs=len(self._graphs),
+                    hits=self.hits + memo['hits'],
+                    misses=self.misses + memo['misses'],
+                    evictions=memo['evictions'])
+
+
 class IdentityBNode(rdflib.BNode):
     # FIXME __eq__ needs to warn if types are the same but versions are different
 
@@ -296,33 +738,150 @@ class IdentityBNode(rdflib.BNode):
         contents of the message and regenerate the IBNode. IBNodes are therefore
         not useful as bound identifiers, but only as unbound or pointing identifiers.
     """
-    cypher = hashlib.sha256
+    cypher = hashlib.sha256  # for versions that are not registered
     cypher_field_separator = ' '
     encoding = sys.getdefaultencoding()
     sortlast = b'\uf8ff'
     default_version = 3
 
+    # bounds for each of the per-version memoization caches, the
+    # debug cache holds whole debug structures so it stays small
+    cache_max_entries = 2 ** 20
+    cache_max_bytes = 2 ** 27
+    cache_max_entries_debug = 2 ** 8
+
+    # memory used by each of the on disk sorts in from_ntriples_stream
+    stream_max_sort_bytes = 2 ** 24
+
+    _caches_top = {}
+
+    # version -> (cypher, algorithm) for versions that do not use cypher
+    _version_cyphers = {}
+
+    @classmethod
+    def register_version(cls, version, cypher, algorithm=None):
+        """ compute identities for version using cypher, a hashlib
+            constructor or equivalent. The algorithm is recorded with
+            the version so identities from versions that use different
+            cyphers are never compared. Only versions > 2 use the
+            version 3 algorithm. """
+        if algorithm is None:
+            m = cypher()
+            algorithm = (m.name if m.name.endswith(str(m.digest_size * 8)) else
+                         f'{m.name}-{m.digest_size * 8}')
+
+        if version in cls._version_cyphers and cls._version_cyphers[version][1] != algorithm:
+            old = cls._version_cyphers[version][1]
+            raise ValueError(f'version {version} already uses {old} not {algorithm}')
+
+        cls._version_cyphers[version] = cypher, algorithm
+
+    @classmethod
+    def version_metadata(cls, version=None):
+        version = cls.default_version if version is None else version
+        cypher, algorithm = cls._version_cypher(version)
+        return dict(version=version, algorithm=algorithm,
+                    digest_size=cypher().digest_size)
+
+    @classmethod
+    def _version_cypher(cls, version):
+        if version in cls._version_cyphers:
+            return cls._version_cyphers[version]
+
+        return cls.cypher, cls.cypher().name
+
+    @classmethod
+    def _version_caches(cls, version):
+        if version not in cls._caches_top:
+            cls._caches_top[version] = {
+                name: cache_class(*cls._cache_limits(name))
+                for name, cache_class in (
+                        ('recurse', _LRUCache),
+                        ('ordered_identity', _LRUCache),
+                        ('identity_function', _GraphScopedCache),
+                        ('predicate', _LRUCache),
+                        ('debug', _LRUCache),)}
+
+        return cls._caches_top[version]
+
+    @classmethod
+    def _cache_limits(cls, name):
+        if name == 'debug':
+            return cls.cache_max_entries_debug, cls.cache_max_bytes
+
+        return cls.cache_max_entries, cls.cache_max_bytes
+
+    @classmethod
+    def cache_stats(cls, version=None):
+        """ entry, byte, hit, miss, and eviction counts for each cache """
+        version = cls.default_version if version is None else version
+        return {name: cache.stats() for name, cache in
+                cls._version_caches(version).items()}
+
+    @classmethod
+    def cache_resize(cls, max_entries=None, max_bytes=None, version=None):
+        """ set the bounds for the caches for version, None restores the
+            class defaults, the debug cache is never made larger than its
+            default number of entries """
+        version = cls.default_version if version is None else version
+        for name, cache in cls._version_caches(version).items():
+            default_entries, default_bytes = cls._cache_limits(name)
+            entries = default_entries if max_entries is None else max_entries
+            if name == 'debug':
+                entries = min(entries, default_entries)
+
+            cache.resize(entries, default_bytes if max_bytes is None else max_bytes)
+
+    @classmethod
+    def cache_clear(cls, version=None):
+        version = cls.default_version if version is None else version
+        for cache in cls._version_caches(version).values():
+            cache.clear()
+
+    @classmethod
+    def cache_discard(cls, graph, version=None):
+        """ drop all cached results for graph, use when graph has been
+            modified since it was last hashed """
+        version = cls.default_version if version is None else version
+        cls._version_caches(version)['identity_function'].discard(graph)
+
+    @classmethod
+    def from_ntriples_stream(cls, path_or_fileobj, *, version=None, max_sort_bytes=None):
+        """ identity of the graph in an n-triples file without loading
+            it into memory, equal to IdentityBNode(graph) for the same
+            version. The input is read twice, named subjects are hashed
+            as they are read and everything else goes through on disk
+            sorts, only the bnode connectivity is held in memory. """
+        version = cls.default_version if version is None else version
+        if version <= 2:
+            raise ValueError(f'streaming is not supported for version {version}')
+
+        source = _NTriplesSource(path_or_fileobj, max_sort_bytes or cls.stream_max_sort_bytes)
+        try:
+            return cls(source, version=version, as_type=it['ntriples-stream'])
+        finally:
+            source.close()
+
     def __new__(cls, triples_or_pairs_or_thing, *, version=None, debug=False, pot=False,
-                as_type=None, id_method=None, in_graph=None, symmetric_predicates=tuple(), no_reorder_list_predicates=tuple()):
+                as_type=None, id_method=None, in_graph=None, symmetric_predicates=tuple(), no_reorder_list_predicates=tuple(),
+                workers=None):
         self = super().__new__(cls)  # first time without value
         self.version = self.default_version if version is None else version
-        if self.version not in self._reccache_top:
-            # FIXME sigh overhead every instance UGH separate classes ...
-            self._reccache_top[self.version] = {}
-
+        caches = self._version_caches(self.version)
         # FIXME also ... reccache is useless ... it is usually just the bytes conversions :/
         # it is for attempting to emulate old v1 iirc but very broken
-        self._reccache = self._reccache_top[self.version]
-        if self.version not in self._oi_cache_top:
-            # FIXME sigh overhead every instance UGH separate classes ...
-            self._oi_cache_top[self.version] = {}
-
-        self._oi_cache = self._oi_cache_top[self.version]
+        self._reccache = caches['recurse']
+        self._oi_cache = caches['ordered_identity']
+        self._if_cache = caches['identity_function']
+        self._if_predicate_cache = caches['predicate']
+        self._if_debug_cache = caches['debug']
         self.debug = debug
+        self.workers = workers  # > 1 hashes the bnode connected components of a graph in that many processes
         self._pot = pot  # pair or triple, use when you explicitly want to get the id for a pair or triple not just a list of 2 or 3 things
         self.id_lookup = {}
         self.symmetric_predicates = symmetric_predicates  # FIXME this is ok, but a bit awkward
         self._thing = triples_or_pairs_or_thing
+        self.cypher, self.algorithm = self._version_cypher(self.version)
 
         if not hasattr(self, f'_{self.version}_cfs'):
             m = self.cypher()
@@ -370,9 +929,15 @@ class IdentityBNode(rdflib.BNode):
         # for backward compat we shuffle these along so that calls to IBN('').identity_function work
         real_self._reccache = self._reccache
         real_self._oi_cache = self._oi_cache
+        real_self._if_cache = self._if_cache
+        real_self._if_predicate_cache = self._if_predicate_cache
+        real_self._if_debug_cache = self._if_debug_cache
 
         real_self.version = self.version
+        real_self.cypher = self.cypher
+        real_self.algorithm = self.algorithm
         real_self.debug = debug
+        real_self.workers = self.workers
         real_self._idfun_map = self._idfun_map
         real_self._pot = self._pot
         real_self.identity = self.identity
@@ -463,8 +1028,7 @@ class IdentityBNode(rdflib.BNode):
         else:
             return str(thing).encode(self.encoding)
 
-    # FIXME this is get shared betwen versions!
-    _oi_cache_top = {}  # as or more important that caching at recurse
+    # _oi_cache is as or more important that caching at recurse
     def ordered_identity(self, *things, separator=True):
         """ this assumes that the things are ALREADY ordered correctly """
         if (things, separator) in self._oi_cache:
@@ -553,7 +1117,6 @@ class IdentityBNode(rdflib.BNode):
             if isinstance(s, rdflib.BNode):
                 subgraph_mapping[s] = os
 
-    _reccache_top = {}  # FIXME shared between versions !!!
     _cache_hits = 0
     def recurse(self, triples_or_pairs_or_thing, bnodes_ok=False, pot=False):
         """ Absolutely must memoize the results for this otherwise
@@ -587,8 +1150,9 @@ class IdentityBNode(rdflib.BNode):
                     return
             else:
                 self._cache_hits += 1
+                ids = self._reccache[triples_or_pairs_or_thing]
 
-            yield from self._reccache[triples_or_pairs_or_thing]
+            yield from ids
 
     def _recurse(self, triples_or_pairs_or_thing, bnodes_ok=False, pot=False):
         if triples_or_pairs_or_thing is None or isinstance(triples_or_pairs_or_thing, str):
@@ -1271,9 +1835,7 @@ class IdentityBNode(rdflib.BNode):
         if sigh:
             breakpoint()
 
-    _if_cache = {}  # FIXME version issue
-    _if_debug_cache = {}
-    _if_predicate_cache = {}  # this one usually doesn't need to be reset and is heavily used
+    # _if_predicate_cache usually doesn't need to be reset and is heavily used
     def _identity_function(self, thing, treat_as_type, *, id_method=None, in_graph=None, is_pred=False):
         # FIXME TODO treat_as_type to something other than
         # strings for better performance maybe? probably much later
@@ -1364,6 +1926,11 @@ class IdentityBNode(rdflib.BNode):
             s, p, ident_o = thing
             ident = oid(self._identity_function(s, it['bytes']),
                         self._identity_function((p, ident_o), it['pair-ident']), separator=False)
+        elif treat_as_type == idf['record-seq'] and input_type == it['ntriples-stream']:
+            ident = self._record_seq_stream(thing)
+        elif (treat_as_type == idf['record-seq'] and self.workers is not None and self.workers > 1 and
+              not self.debug and isinstance(thing, rdflib.Graph) and can_fork()):
+            ident = self._record_seq_parallel(thing, input_type)
         elif treat_as_type == idf['record-seq'] or treat_as_type == idf['record-alt-seq']:  # in ('trip-seq', '((s ((p o) ...)) ...)'):
             bnode_identities = defaultdict(list)
             subject_identities = defaultdict(list)
@@ -1443,10 +2010,30 @@ class IdentityBNode(rdflib.BNode):
 
                 # FIXME TODO move cycle check to its own file to avoid you got it, circular imports HAH
                 from pyontutils.core import OntGraph
-                g = OntGraph().populate_from_triples((s, p, o) for s, pos in unresolved_bnodes.items() for p, o in pos)
 
-                # detect cycles
-                cycles = g.cycle_check_long()
+                # detect cycles, toposort is linear and fails on any cycle
+                # so the expensive enumeration of all cycles is only needed
+                # when it fails
+                try:
+                    subject_order = toposort([(s, o) for s, pos in unresolved_bnodes.items() for p, o in pos])
+                    cycles = []
+                except CycleError:
+                    # condense the bnode graph into strongly connected
+                    # components first, this is linear, enumerating every
+                    # simple cycle is not and never finishes on dense cycles
+                    sccs = cyclic_components(
+                        {s: [o for p, o in pos] for s, pos in unresolved_bnodes.items()})
+                    if not self.debug:
+                        sizes = sorted((len(scc) for scc in sccs), reverse=True)
+                        msg = (f'identity for bnode cycles is not implemented, '
+                               f'{len(sccs)} cyclic components with sizes {sizes[:10]}')
+                        raise NotImplementedError(msg)
+
+                    members = set(b for scc in sccs for b in scc)
+                    g = OntGraph().populate_from_triples(
+                        (s, p, o) for s, pos in unresolved_bnodes.items() if s in members
+                        for p, o in pos if o in members)
+                    cycles = g.cycle_check_long()
                 btc = rdflib.BNode('BREAK-THE-CYCLE')
 
                 # break cycles
@@ -1540,8 +2127,9 @@ you will only very rarely be able to determine that two graphs are the same'''
                             breakpoint()
                             raise e
 
-                # toposort
-                subject_order = toposort([(s, o) for s, pos in cycles_broken.items() for p, o in pos])
+                if cycles:
+                    # toposort
+                    subject_order = toposort([(s, o) for s, pos in cycles_broken.items() for p, o in pos])
 
                 # resolve identities in a single pass
                 for s in subject_order:
@@ -1582,7 +2170,8 @@ you will only very rarely be able to determine that two graphs are the same'''
 
                         idents_po.append((ident_po, (p, o)))
 
-                        if o in transitive_triples:
+                        if self.debug and o in transitive_triples:
+                            # debug only, quadratic for long chains of bnodes
                             transitive_triples[s].extend(transitive_triples[o])  # FIXME maybe pop
 
                     if isinstance(s, rdflib.BNode):
@@ -1735,13 +2324,8 @@ you will only very rarely be able to determine that two graphs are the same'''
             gn = self._identity_function(named, treat_as_type=it['graph-named'])
             gb = self._identity_function(bnode, treat_as_type=it['graph-bnode'])
             # TODO figure out if there is some more consistent way to deal with this?
-            for nkey in [k for k in list(self._if_cache) if named in k]:
-                new_nkey = (thing, 'named'), *nkey[1:]
-                self._if_cache[new_nkey] = self._if_cache.pop(nkey)
-
-            for bkey in [k for k in list(self._if_cache) if bnode in k]:
-                new_bkey = (thing, 'bnode'), *bkey[1:]
-                self._if_cache[new_bkey] = self._if_cache.pop(bkey)
+            self._if_cache.retag(named, thing, 'named')
+            self._if_cache.retag(bnode, thing, 'bnode')
 
             ident = oid(gn, gb, separator=False)
         elif treat_as_type == idf['pair-seq']:
@@ -1817,6 +2401,110 @@ you will only very rarely be able to determine that two graphs are the same'''
 
         return ident
 
+    def _record_seq_parallel(self, thing, input_type):
+        """ record-seq for a graph where the bnode connected components
+            are hashed in forked workers, the identity of a subject
+            only depends on its own component so combining the subject
+            identities from all the chunks gives the sequential result """
+        chunks = _chunk_components(bnode_components(thing), self.workers * 4)
+        def chunk(i):
+            return self._recordSeqChunk(chunks[i], input_type)
+
+        results = list(fork_map(chunk, self.workers, range(len(chunks))))
+
+        seids = []
+        for chunk_seids, subject_entries in results:
+            seids.extend(chunk_seids)
+            for subject, idfun_value, value in subject_entries:
+                self._if_cache[thing, subject, idf(idfun_value)] = value
+
+        self._if_cache[thing, idf['(s ((p o) ...)) ...']] = seids
+        return self.ordered_identity(*sorted(seids), separator=False)
+
+    def _recordSeqChunk(self, triples, input_type):
+        """ hashes triples on their own, e.g. in a forked worker, returns
+            the subject identities and the per subject cache entries, the enum
+            is created functionally and cannot be pickled so its values
+            are sent instead """
+        graph = rdflib.Graph()
+        for t in triples:
+            graph.add(t)
+
+        self.__class__(graph, version=self.version, as_type=input_type,
+                       symmetric_predicates=self.symmetric_predicates)
+        seids = self._if_cache[graph, idf['(s ((p o) ...)) ...']]
+        subject_entries = [(rest[0], rest[1].value, value)
+                           for rest, value in self._if_cache.partition_items(graph)
+                           if len(rest) == 2]
+        self._if_cache.discard(graph)
+        return seids, subject_entries
+
+    def _record_seq_stream(self, source):
+        """ record-seq for an _NTriplesSource. The first pass finds the
+            components connected by bnodes. In the second pass subjects
+            outside those components are hashed one pair at a time and
+            the triples inside them are sorted by component so that each
+            can be hashed on its own as in _record_seq_parallel. """
+        bnode_context = {}
+        parent = {}
+        connected = set()  # named subjects with bnode objects
+
+        def first(s, p, o):
+            if isinstance(o, rdflib.BNode):
+                if not isinstance(s, rdflib.BNode):
+                    connected.add(s)
+
+                _union(parent, s, o)
+
+        source.parse(first, bnode_context)
+
+        named = ExternalSort(source.max_sort_bytes)
+        components = ExternalSort(source.max_sort_bytes)
+        seids = ExternalSort(source.max_sort_bytes)
+        try:
+            def second(s, p, o):
+                if isinstance(s, rdflib.BNode) or s in connected:
+                    root = _find(parent, s).n3()
+                    components.add(f'{root}\t{s.n3()} {p.n3()} {o.n3()} .\n'.encode())
+                else:
+                    ident_po = self._identity_function((p, o), it['pair'])
+                    named.add(f'{s}\t{ident_po.hex()}\n'.encode())
+
+            source.parse(second, bnode_context)
+            del bnode_context, parent, connected
+
+            def key(line):
+                return line.split(b'\t', 1)[0]
+
+            # lines for a key are contiguous since no key contains a tab
+            for subject, lines in itertools.groupby(named, key=key):
+                ids = [bytes.fromhex(line.split(b'\t', 1)[1].decode())
+                       for line, _ in itertools.groupby(lines)]  # graphs are sets
+                condensed = self.ordered_identity(*sorted(ids), separator=False)
+                _subject_identity = self._identity_function(
+                    rdflib.URIRef(subject.decode()), it['bytes'])
+                embedded = self.ordered_identity(_subject_identity, condensed, separator=False)
+                seids.add(embedded.hex().encode() + b'\n')
+
+            for root, lines in itertools.groupby(components, key=key):
+                triples = []
+                data = b''.join(line.split(b'\t', 1)[1] for line in lines)
+                W3CNTriplesParser(_Sink(lambda *t: triples.append(t))).parsestring(data)
+                chunk_seids, _ = self._recordSeqChunk(triples, it['triple-seq'])
+                for seid in chunk_seids:
+                    seids.add(seid.hex().encode() + b'\n')
+
+            # same as sid(*seids, separator=False) without holding them
+            m = self.cypher()
+            for line in seids:
+                m.update(bytes.fromhex(line.decode()))
+
+            return m.digest()
+        finally:
+            named.close()
+            components.close()
+            seids.close()
+
     def identity_function(self, triples_or_pairs_or_thing):
         """ at the moment identity_function should not be called recursively so
         that it is possible to access the original entrypoint without passing
@@ -2075,6 +2763,181 @@ data free ???   | 3 f:p "freeeeee"
         return hash((self.__class__, self.identity))
 
 
+# opt in, versions that are not registered use IdentityBNode.cypher,
+# register other digest sizes as needed e.g.
+# IdentityBNode.register_version(3.2, blake2b(16))
+IdentityBNode.register_version(3.1, blake2b(32))
+
+
+class IncrementalIdentity:
+    """ Graph identity that is kept up to date as triples are added and
+        removed. The subject identities that make up the record-seq are
+        held per bnode connected component together with a sorted list
+        of all of them, a change only rehashes the components that it
+        touches. identity is always equal to IdentityBNode(graph).identity
+        for the same version. """
+
+    def __init__(self, triples=tuple(), *, version=None, IdentityBNode=IdentityBNode):
+        self._ibn = IdentityBNode(b'', version=version)
+        self.version = self._ibn.version
+        if self.version <= 2:
+            raise ValueError(f'incremental identity is not supported for version {self.version}')
+
+        self.graph = rdflib.Graph()
+        self._component_of = {}  # subject or bnode -> component id
+        self._members = {}  # component id -> subjects and bnodes
+        self._seids = {}  # component id -> subject identities
+        self._sorted = []  # all subject identities
+        self._next_id = itertools.count()
+        self.add(triples)
+
+    @property
+    def identity(self):
+        """ same as sid(*seids, separator=False) on the current graph """
+        m = self._ibn.cypher()
+        m.update(b''.join(self._sorted))
+        return m.digest()
+
+    def __len__(self):
+        return len(self.graph)
+
+    def add(self, triples):
+        self._update([t for t in triples if t not in self.graph], [])
+
+    def remove(self, triples):
+        self._update([], [t for t in triples if t in self.graph])
+
+    def _update(self, added, removed):
+        if not added and not removed:
+            return
+
+        for t in added:
+            self.graph.add(t)
+        for t in removed:
+            self.graph.remove(t)
+
+        try:
+            # all pieces of a component that was split or merged are
+            # reached from the ends of the triples that changed
+            affected = {e for s, p, o in (*added, *removed)
+                        for e in ((s, o) if isinstance(o, rdflib.BNode) else (s,))}
+            new = []
+            done = set()
+            for node in affected:
+                if node not in done:
+                    members, triples = self._component(node)
+                    done.update(members)
+                    if triples:
+                        seids, _ = self._ibn._recordSeqChunk(triples, it['triple-seq'])
+                        new.append((members, seids))
+
+        except Exception as e:
+            # leave the graph as it was, e.g. when a bnode cycle was added
+            for t in removed:
+                self.graph.add(t)
+            for t in added:
+                self.graph.remove(t)
+
+            raise e
+
+        for cid in {self._component_of[n] for n in done if n in self._component_of}:
+            for n in self._members.pop(cid):
+                self._component_of.pop(n, None)
+
+            for seid in self._seids.pop(cid):
+                del self._sorted[bisect.bisect_left(self._sorted, seid)]
+
+        for members, seids in new:
+            cid = next(self._next_id)
+            self._members[cid] = members
+            self._seids[cid] = seids
+            for n in members:
+                self._component_of[n] = cid
+
+            for seid in seids:
+                bisect.insort(self._sorted, seid)
+
+    def _component(self, node):
+        """ subjects and bnodes connected to node by bnodes, named
+            objects are leaves, and the triples of those subjects """
+        graph = self.graph
+        members = set()
+        triples = []
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            if n in members:
+                continue
+
+            members.add(n)
+            for p, o in graph.predicate_objects(n):
+                triples.append((n, p, o))
+                if isinstance(o, rdflib.BNode):
+                    stack.append(o)
+
+            if isinstance(n, rdflib.BNode):
+                stack.extend(s for s, p in graph.subject_predicates(n))
+
+        return members, triples
+
+
+class IdentityCache:
+    """ Map the sha256 of the raw bytes of a serialized graph, the
+        identity version, and the serialization format to the identity
+        of the parsed graph and the embedded identities of its named
+        subjects so that unchanged files never have to be parsed twice. """
+
+    def __init__(self, path=None):
+        if path is None:
+            cache_home = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+            path = os.path.join(cache_home, 'pyontutils', 'identity.sqlite')
+
+        self.path = path
+
+    @staticmethod
+    def version_key(version, idbn_class=None):
+        """ versions are stored with their algorithm so that changing the
+            cypher for a version can never return a stale identity """
+        if idbn_class is None:
+            idbn_class = IdentityBNode
+
+        return f'{version} {idbn_class._version_cypher(version)[1]}'
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=60)
+        conn.execute('CREATE TABLE IF NOT EXISTS graphs ('
+                     'raw BLOB, version TEXT, format TEXT, identity BLOB, '
+                     'PRIMARY KEY (raw, version, format))')
+        conn.execute('CREATE TABLE IF NOT EXISTS subjects ('
+                     'raw BLOB, version TEXT, format TEXT, subject TEXT, identity BLOB, '
+                     'PRIMARY KEY (raw, version, format, subject))')
+        return conn
+
+    def get(self, raw, version, format):
+        """ (identity, {subject: identity}) or None """
+        key = raw, version, format
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT identity FROM graphs WHERE raw = ? AND '
+                               'version = ? AND format = ?', key).fetchone()
+            if row is None:
+                return None
+
+            subjects = {rdflib.URIRef(s): i for s, i in conn.execute(
+                'SELECT subject, identity FROM subjects WHERE raw = ? AND '
+                'version = ? AND format = ?', key)}
+
+        return row[0], subjects
+
+    def put(self, raw, version, format, identity, subject_identities):
+        key = raw, version, format
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM subjects WHERE raw = ? AND version = ? AND format = ?', key)
+            conn.execute('INSERT OR REPLACE INTO graphs VALUES (?, ?, ?, ?)', (*key, identity))
+            conn.executemany('INSERT INTO subjects VALUES (?, ?, ?, ?, ?)',
+                             ((*key, str(s), i) for s, i in subject_identities.items()))
+
+
 class IdLocalBNode(rdflib.BNode):
     """ For use inside triples.
         Local ids should be consecutive integers.
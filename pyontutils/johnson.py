@@ -97,6 +97,61 @@ def strongly_connected_components_iter(graph):
                         yield scc
 
 
+def tarjan_scc_iter(graph):
+    # Tarjan's algorithm with an explicit stack so that long chains
+    # do not hit the recursion limit, components are yielded in reverse
+    # topological order, successors that are not keys in graph are
+    # treated as sinks
+    index_counter = 0
+    stack = []
+    on_stack = set()
+    lowlink = {}
+    index = {}
+
+    for root in graph:
+        if root in index:
+            continue
+
+        index[root] = lowlink[root] = index_counter
+        index_counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph.get(root, ())))]
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = lowlink[successor] = index_counter
+                    index_counter += 1
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(graph.get(successor, ()))))
+                    break
+                elif successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+                if lowlink[node] == index[node]:
+                    connected_component = []
+                    while True:
+                        successor = stack.pop()
+                        on_stack.discard(successor)
+                        connected_component.append(successor)
+                        if successor == node: break
+                    yield connected_component
+
+
+def cyclic_components(graph):
+    # the strongly connected components that contain at least one cycle
+    # i.e. more than one member or a single member with a self loop
+    return [scc for scc in tarjan_scc_iter(graph)
+            if len(scc) > 1 or scc[0] in graph.get(scc[0], ())]
+
+
 def strongly_connected_components_rec(graph):
     # Tarjan's algorithm for finding SCC's
     # Robert Tarjan. "Depth-first search and linear graph algorithms." SIAM journal on computing. 1972.
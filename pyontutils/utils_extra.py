@@ -10,6 +10,8 @@ rdflib.plugin.register('librdfxml', rdflib.parser.Parser,
                        'pyontutils.librdf', 'libRdfxmlParser')
 rdflib.plugin.register('libttl', rdflib.parser.Parser,
                        'pyontutils.librdf', 'libTurtleParser')
+rdflib.plugin.register('pyontutils-compact', rdflib.store.Store,
+                       'pyontutils.compact_store', 'CompactStore')
 
 
 def check_value(v):
@@ -124,6 +124,9 @@ setup(
             'scigraph-deploy=pyontutils.scigraph_deploy:main',
             'scig=pyontutils.scig:main',
         ],
+        'rdf.plugins.store': [
+            'pyontutils-compact=pyontutils.compact_store:CompactStore',
+        ],
     },
     #package_data
     #data_files=[('resources',['pyontutils/resources/chebi-subset-ids.txt',])],  # not part of distro
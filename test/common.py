@@ -1,9 +1,12 @@
 import os
+import sys
+import time
+import subprocess
 from pathlib import Path
 from tempfile import gettempdir
 import shutil
 import pytest
-from pyontutils.core import log as _log
+from pyontutils.core import OntGraph, log as _log
 
 log = _log.getChild('test')
 
@@ -21,3 +24,55 @@ def ensure_temp_path():
 SKIP_NETWORK = ('SKIP_NETWORK' in os.environ or
                 'FEATURES' in os.environ and 'network-sandbox' in os.environ['FEATURES'])
 skipif_no_net = pytest.mark.skipif(SKIP_NETWORK, reason='Skipping due to network requirement')
+
+RUN_BENCHMARKS = 'BENCHMARK' in os.environ
+skipif_no_bench = pytest.mark.skipif(not RUN_BENCHMARKS, reason='Skipping benchmark, set BENCHMARK to run')
+
+
+def bench_batch(single, batch, items, sample):
+    """ check that batch(items) is faster per item than single(item),
+        single is only timed on the first sample items, wall clock
+        so only call this from tests marked skipif_no_bench """
+    start = time.time()
+    for item in items[:sample]:
+        single(item)
+
+    per_item = (time.time() - start) / sample
+    start = time.time()
+    result = batch(items)
+    batch_time = time.time() - start
+    n = len(items)
+    log.info(f'{n} items: batch {batch_time:.2f}s, '
+             f'one at a time {per_item * n:.2f}s (estimated from {sample})')
+    assert batch_time / n < per_item
+    return result
+
+
+class GraphFixtures:
+    """ mixin for test cases that run _check(graph) on the shared fixtures """
+
+    fixtures = 'ttlser/test/nasty.ttl', 'ttlser/test/good.ttl', 'test/owl-test.ttl'
+
+    def fixture_graphs(self):
+        for fixture in self.fixtures:
+            yield fixture, OntGraph().parse(fixture)
+
+    def test_fixtures(self):
+        for fixture, graph in self.fixture_graphs():
+            with self.subTest(fixture=fixture):
+                self._check(graph)
+
+
+_rss = """import resource
+def rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+"""
+
+
+def run_isolated(code, *args):
+    """ run code in a new python process so that its peak rss is not
+        inflated by the test process, code can call rss() for the peak
+        in bytes so far, returns the whitespace separated output """
+    root = Path(__file__).parent.parent
+    out = subprocess.check_output([sys.executable, '-c', _rss + code, *args], cwd=root)
+    return out.split()
@@ -0,0 +1,121 @@
+import re
+import random
+import unittest
+import rdflib
+from pyontutils.core import OntGraph
+from pyontutils import compact_store
+from pyontutils.compact_store import CompactStore
+from pyontutils.namespaces import rdf
+from . import test_ontgraph
+from .common import log, skipif_no_bench, run_isolated
+
+_default = 'default', rdflib.store.Store
+_compact = rdflib.plugin.Plugin('default', rdflib.store.Store,
+                                'pyontutils.compact_store', 'CompactStore')
+
+
+class CompactDefault:
+    """ every graph created in the test is backed by CompactStore """
+
+    def setUp(self):
+        old = rdflib.plugin._plugins[_default]
+        rdflib.plugin._plugins[_default] = _compact
+        def restore():
+            rdflib.plugin._plugins[_default] = old
+
+        self.addCleanup(restore)
+        super().setUp()
+
+
+# rerun the whole test_ontgraph suite against the compact store
+for _name, _cls in list(vars(test_ontgraph).items()):
+    if (_name.startswith('Test') and isinstance(_cls, type) and
+        issubclass(_cls, unittest.TestCase)):
+        globals()[_name + 'Compact'] = type(_name + 'Compact', (CompactDefault, _cls), {})
+
+
+class TestCompactStore(unittest.TestCase):
+    fixtures = 'ttlser/test/nasty.ttl', 'ttlser/test/good.ttl', 'test/owl-test.ttl'
+
+    def setUp(self):
+        self.memory = OntGraph()
+        for fixture in self.fixtures:
+            self.memory.parse(fixture)
+
+    def _compact(self, buffer_size):
+        graph = OntGraph(store='pyontutils-compact')
+        graph.store.buffer_size = buffer_size
+        return graph.populate_from(self.memory)
+
+    def test_store(self):
+        graph = OntGraph(store='pyontutils-compact')
+        assert isinstance(graph.store, CompactStore)
+
+    def test_patterns(self):
+        random.seed(0)
+        trips = list(self.memory)
+        for buffer_size in (1, 7, 10000):
+            graph = self._compact(buffer_size)
+            assert len(graph) == len(self.memory)
+            assert set(graph) == set(self.memory)
+            for t in random.sample(trips, 200):
+                for mask in range(8):
+                    pattern = tuple(e if mask & (1 << i) else None for i, e in enumerate(t))
+                    assert set(graph.triples(pattern)) == set(self.memory.triples(pattern)), pattern
+
+            assert (rdflib.URIRef('http://example.org/missing'), None, None) not in graph
+
+    def test_add_remove(self):
+        random.seed(0)
+        trips = list(self.memory)
+        for buffer_size in (1, 7, 10000):
+            graph = self._compact(buffer_size)
+            expect = OntGraph().populate_from(self.memory)
+            removes = ([(t,) for t in random.sample(trips, 30)] +
+                       [((trips[0][0], None, None),), ((None, rdf.type, None),)])
+            for pattern, in removes:
+                graph.remove(pattern)
+                expect.remove(pattern)
+                assert len(graph) == len(expect)
+                assert set(graph) == set(expect)
+
+            graph.populate_from(trips + trips[:100])
+            assert len(graph) == len(self.memory)
+            assert set(graph) == set(self.memory)
+            graph.remove((None, None, None))
+            assert len(graph) == 0 and not list(graph)
+
+    def test_serialize(self):
+        graph = self._compact(7)
+        graph.namespace_manager.populate_from(self.memory)
+        # nasty.ttl has top level bnodes with identical structure that
+        # are ordered by their random labels so only compare structure
+        unlabel = lambda ttl: re.sub(rb'_:\w+', b'_:', ttl)
+        assert (unlabel(graph.serialize(format='nifttl', encoding='utf-8')) ==
+                unlabel(self.memory.serialize(format='nifttl', encoding='utf-8')))
+
+    def test_intern_limit(self):
+        store = CompactStore()
+        store._terms = range(compact_store._max_terms)
+        with self.assertRaises(OverflowError):
+            store.add((rdf.type, rdf.type, rdf.type), None)
+
+    @skipif_no_bench
+    def test_memory_per_triple(self):
+        code = '''import sys, time
+from pyontutils.core import OntGraph
+from test.test_ontgraph import synthetic_classes
+trips = list(synthetic_classes(100_000))
+base = rss()
+start = time.time()
+graph = OntGraph(store=sys.argv[1]).populate_from_triples(trips)
+print(len(graph), rss() - base, time.time() - start)
+'''
+        results = {}
+        for store in ('default', 'pyontutils-compact'):
+            n, used, seconds = run_isolated(code, store)
+            results[store] = int(used) / int(n)
+            log.info(f'{store} {int(n)} triples {results[store]:.0f} bytes/triple '
+                     f'load {float(seconds):.2f}s')
+
+        assert results['pyontutils-compact'] < results['default'] / 4
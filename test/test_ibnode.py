@@ -1,15 +1,25 @@
+import gc
+import sys
+import shutil
+import time
+import random
+import itertools
 import pytest
+import weakref
 import unittest
+import tracemalloc
 import subprocess
 import pprint
+from io import BytesIO
 from pathlib import Path
 from collections import Counter
 import rdflib
 import ttlser
 from pyontutils.core import yield_recursive, OntGraph, bnNone, OntResIri
-from pyontutils.identity_bnode import bnodes, IdentityBNode as IdentityBNodeBase, idf, it as ibn_it
+from pyontutils.identity_bnode import bnodes, IdentityBNode as IdentityBNodeBase, idf, it as ibn_it, _LRUCache
+from pyontutils.identity_bnode import IncrementalIdentity, blake2b
 from pyontutils.namespaces import rdf, ilxtr
-from .common import temp_path, ensure_temp_path, log
+from .common import temp_path, ensure_temp_path, log, skipif_no_bench, run_isolated
 
 
 def formatgraph(g):
@@ -1636,6 +1646,464 @@ class TextXVersion(unittest.TestCase):
                 pass
 
 
+class TestIBNodeCaches(unittest.TestCase):
+
+    IdentityBNode = IdentityBNodeBase
+
+    def tearDown(self):
+        self.IdentityBNode.cache_resize()
+
+    @staticmethod
+    def make_graph(i):
+        graph = OntGraph()
+        s = ilxtr[f'subject-{i}']
+        bn = rdflib.BNode()
+        graph.add((s, rdf.type, ilxtr.Class))
+        graph.add((s, ilxtr.label, rdflib.Literal(f'label {i}')))
+        graph.add((s, ilxtr.p, bn))
+        graph.add((bn, ilxtr.q, rdflib.Literal(i)))
+        return graph
+
+    def live_graphs(self):
+        # graphs from other tests may still be alive
+        gc.collect()
+        return self.IdentityBNode.cache_stats()['identity_function']['graphs']
+
+    def test_graphs_released(self):
+        before = self.live_graphs()
+        alive = weakref.WeakSet()
+        for i in range(10):
+            graph = self.make_graph(i)
+            self.IdentityBNode(graph)
+            alive.add(graph)
+
+        del graph
+        gc.collect()
+        assert not alive, 'graphs kept alive by identity caches'
+        assert self.live_graphs() == before
+
+    def test_graph_results_readable(self):
+        graph = self.make_graph(0)
+        ibn = self.IdentityBNode(graph, debug=True)
+        s = ilxtr['subject-0']
+        assert (graph, s, idf['((p o) ...)']) in ibn._if_cache
+        assert [k for k in ibn._if_cache if graph in k]
+
+    def test_memory_flat(self):
+        self.IdentityBNode.cache_clear()
+        self.IdentityBNode.cache_resize(max_entries=1024, max_bytes=2 ** 18)
+        before_graphs = self.live_graphs()
+        alive = weakref.WeakSet()
+
+        def run(start, stop):
+            for i in range(start, stop):
+                graph = self.make_graph(i)
+                self.IdentityBNode(graph)
+                alive.add(graph)
+
+        tracemalloc.start()
+        try:
+            run(0, 100)  # fill the bounded caches
+            gc.collect()
+            before, _ = tracemalloc.get_traced_memory()
+            run(100, 1100)
+            gc.collect()
+            after, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        stats = self.IdentityBNode.cache_stats()
+        assert not alive
+        assert stats['identity_function']['graphs'] == before_graphs
+        assert stats['ordered_identity']['evictions'] > 0
+        assert all(s['entries'] <= 1024 for s in stats.values()), stats
+        assert after - before < 2 ** 19, f'memory grew by {after - before} bytes'
+
+    def test_lru(self):
+        cache = _LRUCache(max_entries=2)
+        cache['a'] = 1
+        cache['b'] = 2
+        assert cache['a'] == 1  # a is now most recent
+        cache['c'] = 3
+        assert 'b' not in cache
+        assert list(cache) == ['a', 'c']
+        stats = cache.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['evictions'] == 1
+
+
+class TestIBNodeDeep(unittest.TestCase):
+    """ long lists and deeply nested bnodes must not hit the recursion limit """
+
+    IdentityBNode = IdentityBNodeBase
+
+    def tearDown(self):
+        # do not leave full caches behind for the tests that follow
+        self.IdentityBNode.cache_clear()
+
+    @staticmethod
+    def make_list(n, last=None):
+        graph = OntGraph()
+        head = rdflib.BNode()
+        graph.add((ilxtr.s, ilxtr.p, head))
+        node = head
+        for i in range(n):
+            graph.add((node, rdf.first, rdflib.Literal(i if last is None or i < n - 1 else last)))
+            rest = rdflib.BNode() if i < n - 1 else rdf.nil
+            graph.add((node, rdf.rest, rest))
+            node = rest
+
+        return graph
+
+    @staticmethod
+    def make_nested(n, last=None):
+        graph = OntGraph()
+        node = rdflib.BNode()
+        graph.add((ilxtr.s, ilxtr.p, node))
+        for i in range(n):
+            inner = rdflib.BNode()
+            graph.add((node, rdf.type, ilxtr.Restriction))
+            graph.add((node, ilxtr.someValuesFrom, inner))
+            node = inner
+
+        graph.add((node, rdf.type, ilxtr.Class if last is None else last))
+        return graph
+
+    def _check(self, make, n):
+        limit = sys.getrecursionlimit()
+        assert limit < n
+        self.IdentityBNode(make(n))
+        assert sys.getrecursionlimit() == limit
+
+    def test_same_digests(self):
+        # digests computed by the recursive implementation
+        a = self.IdentityBNode(self.make_list(1000)).identity
+        b = self.IdentityBNode(self.make_nested(2000)).identity
+        assert a != self.IdentityBNode(self.make_list(1000, last=ilxtr.other)).identity
+        assert b != self.IdentityBNode(self.make_nested(2000, last=ilxtr.other)).identity
+        assert a.hex() == 'deb4990c49ccf570e9fed179177b58d635cd9c36431da1e4c4a114e458244924'
+        assert b.hex() == '9412af4a98cf67ce43cb0b8a3beed6ca5ee225b9e6b53bdd795e19f3fa02615b'
+
+    def test_long_list(self):
+        self._check(self.make_list, 2 * sys.getrecursionlimit())
+
+    def test_deep_nesting(self):
+        self._check(self.make_nested, 2 * sys.getrecursionlimit())
+
+    @skipif_no_bench
+    def test_bench_long_list(self):
+        self._check(self.make_list, 500_000)
+
+    @skipif_no_bench
+    def test_bench_deep_nesting(self):
+        self._check(self.make_nested, 50_000)
+
+
+class TestIBNodeParallel(unittest.TestCase):
+    """ workers > 1 must produce exactly the sequential identities """
+
+    IdentityBNode = IdentityBNodeBase
+    paths = ('ttlser/test/nasty.ttl',
+             'ttlser/test/good.ttl',
+             'ttlser/test/list-nasty.ttl',
+             'ttlser/test/list-good.ttl',
+             'ttlser/test/scogood.ttl',
+             'ttlser/test/no-reorder.ttl',
+             'test/graphload-test.ttl',
+             'test/sneech-file.ttl',)
+
+    def tearDown(self):
+        self.IdentityBNode.cache_clear()
+
+    @staticmethod
+    def make_synthetic(n):
+        """ about 10 triples per unit: named triples, restrictions,
+            lists, a bnode shared by two subjects, and a free axiom """
+        graph = OntGraph()
+        for i in range(n):
+            s = ilxtr[f'c{i}']
+            graph.add((s, rdf.type, ilxtr.Class))
+            graph.add((s, ilxtr.label, rdflib.Literal(f'class {i}')))
+            restriction = rdflib.BNode()
+            graph.add((s, ilxtr.subClassOf, restriction))
+            graph.add((restriction, ilxtr.onProperty, ilxtr.partOf))
+            graph.add((restriction, ilxtr.someValuesFrom, ilxtr[f'c{i // 2}']))
+            shared = rdflib.BNode()
+            graph.add((shared, ilxtr.value, rdflib.Literal(i // 3)))
+            graph.add((s, ilxtr.shared, shared))
+            graph.add((ilxtr[f'other{i}'], ilxtr.shared, shared))
+            axiom = rdflib.BNode()
+            graph.add((axiom, ilxtr.annotatedSource, s))
+            graph.add((axiom, ilxtr.annotatedTarget, rdflib.Literal(i % 7)))
+
+        return graph
+
+    def _check(self, graph):
+        def identities(workers):
+            ident = self.IdentityBNode(graph, workers=workers).identity
+            subjects = {k[1:]: v for k, v in self.IdentityBNode('')._if_cache.items()
+                        if k[0] is graph and len(k) == 3}
+            assert subjects
+            self.IdentityBNode.cache_discard(graph)
+            return ident, subjects
+
+        sequential = identities(None)
+        parallel = identities(2)
+        assert parallel[0] == sequential[0]
+        assert parallel[1] == sequential[1]
+
+    def test_fixtures(self):
+        for path in self.paths:
+            graph = OntGraph().parse(path)
+            with self.subTest(path=path):
+                self._check(graph)
+
+    def test_cycles(self):
+        graph = OntGraph().parse('ttlser/test/evil.ttl')
+        for workers in (None, 2):
+            try:
+                self.IdentityBNode(graph, workers=workers)
+                raise AssertionError('should have failed')
+            except NotImplementedError:
+                pass
+
+            self.IdentityBNode.cache_discard(graph)
+
+    def test_synthetic(self):
+        self._check(self.make_synthetic(2_000))
+
+    @skipif_no_bench
+    def test_synthetic_1m(self):
+        self._check(self.make_synthetic(100_000))
+
+
+class Unseekable(BytesIO):
+    def seekable(self):
+        return False
+
+
+class TestIBNodeStream(unittest.TestCase):
+    """ from_ntriples_stream must match the identity of the parsed graph """
+
+    IdentityBNode = IdentityBNodeBase
+    paths = TestIBNodeParallel.paths
+
+    def tearDown(self):
+        self.IdentityBNode.cache_clear()
+        if temp_path.exists():
+            shutil.rmtree(temp_path)
+
+    @staticmethod
+    def write_ntriples(path, n):
+        """ about n lines, mostly named subjects with some restrictions """
+        t = '<http://www.w3.org/1999/02/22-rdf-syntax-ns#type>'
+        owl = 'http://www.w3.org/2002/07/owl#'
+        ex = 'http://example.org/'
+        lines = 0
+        with open(path, 'wt') as f:
+            for i in itertools.count():
+                if lines >= n:
+                    break
+
+                s = f'<{ex}c{i}>'
+                f.write(f'{s} {t} <{owl}Class> .\n'
+                        f'{s} <{ex}label> "class {i}" .\n'
+                        f'{s} <{ex}value> "{i % 97}" .\n'
+                        f'{s} <{ex}next> <{ex}c{i // 2}> .\n')
+                lines += 4
+                if not i % 10:
+                    f.write(f'{s} <{ex}subClassOf> _:r{i} .\n'
+                            f'_:r{i} <{owl}onProperty> <{ex}partOf> .\n'
+                            f'_:r{i} <{owl}someValuesFrom> <{ex}c{i // 3}> .\n')
+                    lines += 3
+
+    def test_fixtures(self):
+        for path in self.paths:
+            nt = OntGraph().parse(path).serialize(format='nt', encoding='utf-8')
+            graph = OntGraph().parse(data=nt, format='nt')
+            expect = self.IdentityBNode(graph).identity
+            with self.subTest(path=path):
+                assert self.IdentityBNode.from_ntriples_stream(BytesIO(nt)).identity == expect
+                # force every on disk sort to spill
+                small = self.IdentityBNode.from_ntriples_stream(BytesIO(nt), max_sort_bytes=256)
+                assert small.identity == expect
+                pipe = self.IdentityBNode.from_ntriples_stream(Unseekable(nt))
+                assert pipe.identity == expect
+
+    def test_path_and_duplicates(self):
+        ensure_temp_path()
+        path = temp_path / 'stream.nt'
+        self.write_ntriples(path, 1000)
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        with open(path, 'ab') as f:
+            f.write(data[:data.index(b'\n', len(data) // 2) + 1])  # graphs are sets
+
+        expect = self.IdentityBNode(OntGraph().parse(path, format='nt')).identity
+        assert self.IdentityBNode.from_ntriples_stream(path).identity == expect
+        assert self.IdentityBNode.from_ntriples_stream(path.as_posix()).identity == expect
+
+    def test_cycles(self):
+        nt = OntGraph().parse('ttlser/test/evil.ttl').serialize(format='nt', encoding='utf-8')
+        with self.assertRaises(NotImplementedError):
+            self.IdentityBNode.from_ntriples_stream(BytesIO(nt))
+
+    @skipif_no_bench
+    def test_memory_5m(self):
+        ensure_temp_path()
+        path = temp_path / 'stream-5m.nt'
+        self.write_ntriples(path, 5_000_000)
+        code = f'''from pyontutils.identity_bnode import IdentityBNode
+IdentityBNode.cache_resize(max_entries=2 ** 16)
+IdentityBNode.from_ntriples_stream({path.as_posix()!r})
+print(rss())
+'''
+        max_rss, = run_isolated(code)
+        max_rss_mb = int(max_rss) // 2 ** 20
+        log.info(f'from_ntriples_stream 5M lines max rss {max_rss_mb}MB')
+        # the graph alone would need several GB
+        assert max_rss_mb < 256, max_rss_mb
+
+
+class TestIncrementalIdentity(unittest.TestCase):
+    """ randomized add and remove must match hashing from scratch """
+
+    IdentityBNode = IdentityBNodeBase
+
+    def tearDown(self):
+        self.IdentityBNode.cache_clear()
+
+    @staticmethod
+    def random_triples(rng, n):
+        """ named triples, restrictions, shared bnodes and list like
+            chains, bnodes only point to later bnodes so no cycles """
+        named = [ilxtr[f's{i}'] for i in range(n // 4 + 1)]
+        bnodes = [rdflib.BNode() for i in range(n // 4 + 1)]
+        preds = [ilxtr.p, ilxtr.q, rdf.type, rdf.first, rdf.rest]
+        objects = named[:5] + [rdflib.Literal(i) for i in range(5)]
+        triples = []
+        for _ in range(n):
+            p = rng.choice(preds)
+            kind = rng.random()
+            if kind < .3:
+                triples.append((rng.choice(named), p, rng.choice(objects)))
+            elif kind < .5:
+                triples.append((rng.choice(named), p, rng.choice(bnodes)))
+            else:
+                i = rng.randrange(len(bnodes))
+                o = (rng.choice(bnodes[i + 1:]) if kind < .7 and i + 1 < len(bnodes)
+                     else rng.choice(objects))
+                triples.append((bnodes[i], p, o))
+
+        return triples
+
+    def _check(self, inc):
+        graph = rdflib.Graph()
+        for t in inc.graph:
+            graph.add(t)
+
+        assert inc.identity == self.IdentityBNode(graph).identity
+
+    def test_empty(self):
+        self._check(IncrementalIdentity())
+
+    def test_fixtures(self):
+        for path in TestIBNodeParallel.paths:
+            graph = OntGraph().parse(path)
+            with self.subTest(path=path):
+                inc = IncrementalIdentity(graph)
+                assert inc.identity == self.IdentityBNode(graph).identity
+                triples = sorted(graph)
+                inc.remove(triples[::3])
+                self._check(inc)
+                inc.add(triples[::3])
+                assert inc.identity == self.IdentityBNode(graph).identity
+
+    def test_random(self):
+        for seed in range(20):
+            rng = random.Random(seed)
+            pool = self.random_triples(rng, 60)
+            inc = IncrementalIdentity(rng.sample(pool, 20))
+            with self.subTest(seed=seed):
+                self._check(inc)
+                for _ in range(15):
+                    batch = rng.sample(pool, rng.randint(1, 5))
+                    if rng.random() < .5:
+                        inc.add(batch)
+                    else:
+                        inc.remove(batch)
+
+                    self._check(inc)
+
+    def test_cycle_rollback(self):
+        a, b = rdflib.BNode(), rdflib.BNode()
+        inc = IncrementalIdentity([(ilxtr.s, ilxtr.p, a), (a, ilxtr.p, b)])
+        before = inc.identity
+        with self.assertRaises(NotImplementedError):
+            inc.add([(b, ilxtr.p, a)])
+
+        assert inc.identity == before
+        assert len(inc) == 2
+        self._check(inc)
+
+
+class TestIBNodeCyphers(unittest.TestCase):
+
+    IdentityBNode = IdentityBNodeBase
+    versions = 3, 3.1, 3.2
+
+    @classmethod
+    def setUpClass(cls):
+        cls.IdentityBNode.register_version(3.2, blake2b(16))
+
+    def tearDown(self):
+        for version in self.versions:
+            self.IdentityBNode.cache_clear(version)
+
+    def test_stable(self):
+        graph = OntGraph().parse('ttlser/test/nasty.ttl')
+        nt = graph.serialize(format='nt', encoding='utf-8')
+        identities = set()
+        for version in self.versions:
+            meta = self.IdentityBNode.version_metadata(version)
+            with self.subTest(version=version):
+                a = self.IdentityBNode(graph, version=version)
+                b = self.IdentityBNode(OntGraph().parse(data=nt, format='nt'), version=version)
+                assert a.identity == b.identity
+                assert a.algorithm == meta['algorithm']
+                assert len(a.identity) == meta['digest_size']
+                identities.add(a.identity)
+
+        assert len(identities) == len(self.versions)
+        assert self.IdentityBNode.version_metadata(3.1)['algorithm'] == 'blake2b-256'
+        assert self.IdentityBNode.version_metadata(3.2)['algorithm'] == 'blake2b-128'
+        assert self.IdentityBNode.version_metadata(3)['algorithm'] == 'sha256'
+
+    def test_not_confused(self):
+        a = self.IdentityBNode('a')
+        b = self.IdentityBNode('a', version=3.1)
+        with self.assertRaises(ValueError):
+            a.check(b)
+
+        with self.assertRaises(ValueError):
+            self.IdentityBNode.register_version(3.1, blake2b(16))
+
+    @skipif_no_bench
+    def test_bench(self):
+        graph = TestIBNodeParallel.make_synthetic(20_000)
+        times = {}
+        for version in self.versions:
+            start = time.perf_counter()
+            self.IdentityBNode(graph, version=version)
+            times[version] = time.perf_counter() - start
+            self.IdentityBNode.cache_clear(version)
+
+        log.info(' '.join(f'{self.IdentityBNode.version_metadata(v)["algorithm"]} {t:.2f}s'
+                          for v, t in times.items()))
+
+
 class TestStability(unittest.TestCase):
 
     @pytest.mark.skip('requires pypy and cpython TODO a cpython only version to hunt down the problem')
@@ -1,9 +1,30 @@
+import io
+import sys
+import json
+import shutil
+import time
 import unittest
 import pytest
 import pathlib
 import rdflib
-from pyontutils.core import OntGraph, ilxtr
+from pyontutils.core import OntGraph, OntGraphUnion, OntResPath, Edge, ilxtr
+from pyontutils.namespaces import owl, rdf, rdfs
 from pyontutils.identity_bnode import IdentityBNode, idf, it as ibn_it
+from .common import log, skipif_no_bench, temp_path, ensure_temp_path
+from .common import GraphFixtures, run_isolated, bench_batch
+
+
+def synthetic_classes(n, prefix='class'):
+    """ n owl classes each with a label and a restriction """
+    for i in range(n):
+        s = ilxtr[f'{prefix}-{i}']
+        r = rdflib.BNode()
+        yield s, rdf.type, owl.Class
+        yield s, rdfs.label, rdflib.Literal(f'{prefix} {i}')
+        yield s, rdfs.subClassOf, r
+        yield r, rdf.type, owl.Restriction
+        yield r, owl.onProperty, ilxtr.hasPart
+        yield r, owl.someValuesFrom, ilxtr[f'{prefix}-{(i + 1) % n}']
 
 
 class TestOntGraph(unittest.TestCase):
@@ -71,6 +92,52 @@ class TestOntGraphOpsComplex(TestOntGraphOps):
         assert not c, d
 
 
+class TestSubjectIdentities(unittest.TestCase):
+
+    def _check(self, graph):
+        subjects = set(graph.named_subjects())
+        condensed = graph.subjectIdentities()
+        embedded = graph.subjectIdentities(kind='embedded')
+        assert set(condensed) == set(embedded) == subjects
+        for s in subjects:
+            assert condensed[s] == graph.subjectCondensedIdentity(s)
+            assert embedded[s] == graph.subjectEmbeddedIdentity(s)
+            assert embedded[s] == graph.subjectIdentity(s)
+
+    def test_nasty(self):
+        self._check(OntGraph().parse(pathlib.Path('ttlser/test/nasty.ttl')))
+
+    def test_good(self):
+        self._check(OntGraph().parse(pathlib.Path('ttlser/test/good.ttl')))
+
+    def test_synthetic(self):
+        self._check(OntGraph().populate_from_triples(synthetic_classes(50)))
+
+    def test_subjects(self):
+        graph = OntGraph().populate_from_triples(synthetic_classes(10))
+        subjects = [ilxtr['class-1'], ilxtr['class-2']]
+        assert set(graph.subjectIdentities(subjects)) == set(subjects)
+
+    def test_modified(self):
+        graph = OntGraph().populate_from_triples(synthetic_classes(10))
+        s = ilxtr['class-1']
+        before = graph.subjectIdentities([s])[s]
+        graph.add((s, rdfs.comment, rdflib.Literal('changed')))
+        after = graph.subjectIdentities([s])[s]
+        assert before != after
+        assert after == graph.subjectCondensedIdentity(s)
+
+    @skipif_no_bench
+    def test_bench(self):
+        n = 100000
+        graph = OntGraph().populate_from_triples(synthetic_classes(n))
+        subjects = sorted(graph.named_subjects())
+        batch = bench_batch(graph.subjectEmbeddedIdentity,
+                            lambda subjects: graph.subjectIdentities(subjects, kind='embedded'),
+                            subjects, 20)
+        assert len(batch) == n
+
+
 class TestCycleCheckLong(unittest.TestCase):
     def _do_cycle(self, trips, test_trips, neg=False):
         g = OntGraph().populate_from_triples(trips)
@@ -109,6 +176,506 @@ class TestCycleCheckLong(unittest.TestCase):
         test_trips = trips[l:u]
         self._do_cycle(trips, test_trips)
 
+    def test_scc_self_loop(self):
+        bn0 = rdflib.BNode()
+        bn1 = rdflib.BNode()
+        trips = (
+            (bn0, ilxtr.c0, bn0),
+            (bn0, ilxtr.c1, bn1),
+        )
+        g = OntGraph().populate_from_triples(trips)
+        assert g.cycle_check_long(scc_only=True) == [[trips[0]]]
+
+    def test_scc_clique(self):
+        # every bnode points to every other bnode, the number of simple
+        # cycles is super exponential so cycle_check_long would not finish
+        n = 30
+        nodes = [rdflib.BNode() for _ in range(n)]
+        trips = [(na, ilxtr.p, nb) for na in nodes for nb in nodes if na != nb]
+        tail = rdflib.BNode()
+        trips.append((nodes[0], ilxtr.tail, tail))
+        g = OntGraph().populate_from_triples(trips)
+        start = time.time()
+        sccs = g.cycle_check_long(scc_only=True)
+        assert len(sccs) == 1
+        assert set(sccs[0]) == set(trips[:-1])
+        with self.assertRaises(NotImplementedError):
+            IdentityBNode(g)
+
+        assert time.time() - start < 30
+
+
+class LocalChain(OntResPath):
+    """ an import chain of local files without resolving owl:imports """
+    chain = ()
+
+    @property
+    def import_chain(self):
+        yield from self.chain
+
+
+def write_ontology(path, i, n, imports=()):
+    """ an owl:Ontology header and n triples worth of synthetic classes """
+    g = OntGraph()
+    g.bind('ilxtr', ilxtr)
+    ont = rdflib.URIRef(path.as_uri())
+    g.add((ont, rdf.type, owl.Ontology))
+    for imp in imports:
+        g.add((ont, owl.imports, rdflib.URIRef(imp.as_uri())))
+
+    g.populate_from_triples(synthetic_classes(n // 6, prefix=f'ont-{i}-class'))
+    g.write(path)
+
+
+class TestPopulate(unittest.TestCase):
+
+    def tearDown(self):
+        if temp_path.exists():
+            shutil.rmtree(temp_path)
+
+    def test_batch_size(self):
+        trips = list(synthetic_classes(100))
+        for batch_size in (1, 7, 10000):
+            g = OntGraph().populate_from_triples(iter(trips), batch_size=batch_size)
+            assert set(g) == set(trips)
+            assert set(OntGraph().populate_from(g, batch_size=batch_size)) == set(trips)
+
+    def _chain(self, n_graphs, n_triples):
+        ensure_temp_path()
+        paths = [temp_path / f'ont-{i}.ttl' for i in range(n_graphs)]
+        for i, path in enumerate(paths):
+            write_ontology(path, i, n_triples, imports=paths[i + 1:i + 2])
+
+        root, *rest = [LocalChain(path) for path in paths]
+        root.chain = rest
+        for r in (root, *rest):
+            r.graph, r.metadata().graph  # load everything before timing
+
+        return root
+
+    def _check_closure(self, merged):
+        o0, o1, o2 = [rdflib.URIRef((temp_path / f'ont-{i}.ttl').as_uri()) for i in range(3)]
+        # only the root stays an owl:Ontology and owl:imports become ilxtr:imports
+        meta = {(o0, rdf.type, owl.Ontology),
+                (o0, ilxtr.imports, o1),
+                (o1, rdf.type, ilxtr.Ontology),
+                (o1, ilxtr.imports, o2),
+                (o2, rdf.type, ilxtr.Ontology),}
+        named = {t for i in range(3)
+                 for t in synthetic_classes(10, prefix=f'ont-{i}-class')
+                 if not any(isinstance(e, rdflib.BNode) for e in t)}
+        assert {t for t in merged if not any(isinstance(e, rdflib.BNode) for e in t)} == meta | named
+        assert len(merged) == len(meta) + 3 * 60
+        assert ('ilxtr', rdflib.URIRef(str(ilxtr))) in set(merged.namespaces())
+
+    def test_import_closure_graph(self):
+        root = self._chain(3, 60)
+        self._check_closure(root.import_closure_graph())
+
+    def test_import_closure_view(self):
+        root = self._chain(3, 60)
+        view = root.import_closure_view()
+        self._check_closure(view)
+        merged = root.import_closure_graph()
+        assert set(view) == set(merged)
+        assert len(view) == len(merged)
+        assert set(view.subjects(unique=True)) == set(merged.subjects(unique=True))
+        for pattern in ((None, rdf.type, owl.Ontology),
+                        (None, ilxtr.imports, None),
+                        (None, rdfs.label, None),
+                        (ilxtr['ont-2-class-3'], None, None)):
+            assert set(view.triples(pattern)) == set(merged.triples(pattern)), pattern
+
+        assert set(view.namespaces()) == set(merged.namespaces())
+
+    @skipif_no_bench
+    def test_bench_closure(self):
+        n_graphs, n_triples = 50, 100_000
+        root = self._chain(n_graphs, n_triples)
+        start = time.time()
+        merged = root.import_closure_graph()
+        batch_time = time.time() - start
+        start = time.time()
+        copy = OntGraph()
+        for t in merged:
+            copy.add(t)
+
+        add_time = time.time() - start
+        log.info(f'{n_graphs} x {n_triples} closure addN {batch_time:.2f}s add {add_time:.2f}s')
+        assert batch_time < add_time
+
+
+class TestOntGraphUnion(unittest.TestCase):
+
+    def setUp(self):
+        trips = list(synthetic_classes(20))
+        self.a = OntGraph().populate_from_triples(trips[:80])
+        self.b = OntGraph().populate_from_triples(trips[60:])
+        self.expect = OntGraph().populate_from_triples(trips)
+
+    def test_dedup(self):
+        union = OntGraphUnion([self.a, self.b])
+        assert len(union) == len(self.expect) < len(self.a) + len(self.b)
+        assert sorted(union) == sorted(self.expect)
+        assert (sorted(union.subjects(rdf.type, owl.Class)) ==
+                sorted(self.expect.subjects(rdf.type, owl.Class)))
+
+    def test_exclude(self):
+        s = ilxtr['class-0']
+        union = OntGraphUnion([self.a, self.b], exclude=[(s,), ()])
+        assert set(union) == set(t for t in self.expect if t[0] != s)
+
+    def test_member_changes(self):
+        union = OntGraphUnion([self.a, self.b])
+        before = len(union)
+        self.b.add((ilxtr.new, rdf.type, owl.Class))
+        assert len(union) == before + 1
+        assert (ilxtr.new, rdf.type, owl.Class) in union
+        # a subject that was only in b is now in a as well
+        self.a.add((ilxtr.new, rdf.type, owl.Class))
+        assert len(union) == before + 1
+        assert len(list(union[ilxtr.new::])) == 1
+
+    def test_len_cached(self):
+        union = OntGraphUnion([self.a, self.b])
+        scans = []
+        _union = union._union
+        def counted(*args):
+            scans.append(args)
+            return _union(*args)
+
+        union._union = counted
+        assert len(union) == len(union) == len(self.expect)
+        assert len(scans) == 1
+        self.b.add((ilxtr.new, rdf.type, owl.Class))
+        assert len(union) == len(union) == len(self.expect) + 1
+        assert len(scans) == 2
+
+    def test_read_only(self):
+        union = OntGraphUnion([self.a, self.b])
+        self.assertRaises(rdflib.graph.ModificationException,
+                          union.add, (ilxtr.new, rdf.type, owl.Class))
+        self.assertRaises(rdflib.graph.ModificationException,
+                          union.remove, (None, None, None))
+
+    @skipif_no_bench
+    def test_memory_closure(self):
+        code = '''from pyontutils.core import OntGraph, OntGraphUnion
+from test.test_ontgraph import synthetic_classes
+graphs = [OntGraph().populate_from_triples(synthetic_classes(20_000, prefix=f'ont-{i}'))
+          for i in range(10)]
+base = rss()
+view = OntGraphUnion(graphs)
+n_view = len(view)
+after_view = rss()
+copy = OntGraph().populate_from(view)
+print(base, after_view, rss(), n_view, len(copy))
+'''
+        base, view, copy, n_view, n_copy = [int(i) for i in run_isolated(code)]
+        log.info(f'{n_view} triples view {(view - base) // 2 ** 20}MB '
+                 f'copy {(copy - view) // 2 ** 20}MB')
+        assert n_view == n_copy
+        assert view - base < (copy - view) // 10, (view - base, copy - view)
+
+
+class TestOboGraph(GraphFixtures, unittest.TestCase):
+    calls = (
+        dict(),
+        dict(predicate='rdfs:subClassOf', restriction=False),
+        dict(predicate='ilxtr:hasPart'),
+        dict(predicate='rdfs:subClassOf', label_predicate='rdfs:comment', restriction=False),
+    )
+
+    def tearDown(self):
+        if temp_path.exists():
+            shutil.rmtree(temp_path)
+
+    def _check(self, g):
+        g.bind('ilxtr', ilxtr)
+        for kwargs in self.calls:
+            j = g.asOboGraph(**kwargs)
+            ids = [n['id'] for n in j['nodes']]
+            assert len(ids) == len(set(ids)), kwargs
+            assert {e[k] for e in j['edges'] for k in ('sub', 'pred', 'obj')} <= set(ids), kwargs
+            sio = io.StringIO()
+            try:
+                expect = json.dumps(j)
+            except TypeError:
+                # e.g. nasty.ttl has labels that are datetimes
+                with self.assertRaises(TypeError):
+                    g.writeOboGraph(sio, **kwargs)
+
+                continue
+
+            g.writeOboGraph(sio, **kwargs)
+            assert sio.getvalue() == expect
+            assert json.loads(sio.getvalue()) == j
+
+    def test_synthetic(self):
+        g = OntGraph().populate_from_triples(synthetic_classes(50))
+        g.add((ilxtr['class-3'], owl.deprecated, rdflib.Literal(True)))
+        self._check(g)
+        assert [n for n in g.asOboGraph()['nodes'] if n['meta']]
+
+    def test_expected(self):
+        g = OntGraph()
+        g.bind('ilxtr', ilxtr)
+        r = rdflib.BNode()
+        g.add((ilxtr.a, rdfs.subClassOf, ilxtr.b))
+        g.add((ilxtr.a, rdfs.label, rdflib.Literal('a')))
+        g.add((ilxtr.a, owl.deprecated, rdflib.Literal(True)))
+        g.add((ilxtr.b, rdfs.subClassOf, r))
+        g.add((r, rdf.type, owl.Restriction))
+        g.add((r, owl.onProperty, ilxtr.hasPart))
+        g.add((r, owl.someValuesFrom, ilxtr.c))
+        def node(id, lbl=None, meta={}):
+            return {'id': id, 'lbl': lbl if lbl else str(g.namespace_manager.expand(id)), 'meta': meta}
+
+        assert g.asOboGraph('rdfs:subClassOf', restriction=False) == {
+            'nodes': [node('ilxtr:a', 'a', {str(owl.deprecated): True}),
+                      node('rdfs:subClassOf'),
+                      node('ilxtr:b')],
+            'edges': [{'sub': 'ilxtr:a', 'pred': 'rdfs:subClassOf', 'obj': 'ilxtr:b'}]}
+        assert g.asOboGraph('ilxtr:hasPart') == {
+            'nodes': [node('ilxtr:b'), node('ilxtr:hasPart'), node('ilxtr:c')],
+            'edges': [{'sub': 'ilxtr:b', 'pred': 'ilxtr:hasPart', 'obj': 'ilxtr:c'}]}
+        sio = io.StringIO()
+        g.writeOboGraph(sio, 'ilxtr:hasPart')
+        assert json.loads(sio.getvalue()) == g.asOboGraph('ilxtr:hasPart')
+
+    @skipif_no_bench
+    def test_memory_500k(self):
+        ensure_temp_path()
+        path = temp_path / 'obograph-500k.json'
+        code = f'''import rdflib
+from pyontutils.core import OntGraph, ilxtr
+from pyontutils.namespaces import rdfs
+n = 500_000
+g = OntGraph().populate_from_triples(
+    t for i in range(n) for t in (
+        (ilxtr[f'c{{i}}'], rdfs.subClassOf, ilxtr[f'c{{i + 1}}']),
+        (ilxtr[f'c{{i}}'], rdfs.label, rdflib.Literal(f'class {{i}}'))))
+base = rss()
+with open({path.as_posix()!r}, 'wt') as f:
+    g.writeOboGraph(f, 'rdfs:subClassOf', restriction=False)
+write = rss()
+j = g.asOboGraph('rdfs:subClassOf', restriction=False)
+print(base, write, rss(), len(j['nodes']))
+'''
+        base, write, full, n_nodes = [int(i) for i in run_isolated(code)]
+        write, full = (write - base) // 2 ** 20, (full - base) // 2 ** 20
+        log.info(f'{n_nodes} nodes write {write}MB asOboGraph {full}MB')
+        assert n_nodes > 500_000
+        assert write < 160, write
+
+
+class TestSubjectGraphs(GraphFixtures, unittest.TestCase):
+
+    def _check(self, g):
+        subjects = set(g.subjects()) | {ilxtr.not_in_graph}
+        graphs = g.subjectGraphs(subjects)
+        assert set(graphs) == subjects
+        for s, sg in graphs.items():
+            expect = g.subjectGraph(s)
+            assert set(sg) == set(expect), s
+            assert set(sg.namespaces()) == set(expect.namespaces())
+
+    def test_synthetic(self):
+        self._check(OntGraph().populate_from_triples(synthetic_classes(50)))
+
+    def test_invalidate(self):
+        g = OntGraph().populate_from_triples(synthetic_classes(10))
+        s = ilxtr['class-1']
+        before = set(g.subjectGraphs([s])[s])
+        r = rdflib.BNode()
+        g.add((s, rdfs.subClassOf, r))
+        g.add((r, owl.onProperty, ilxtr.hasPart))
+        after = set(g.subjectGraphs([s])[s])
+        assert after - before == {(s, rdfs.subClassOf, r), (r, owl.onProperty, ilxtr.hasPart)}
+        g.remove((r, None, None))
+        assert set(g.subjectGraphs([s])[s]) == set(g.subjectGraph(s))
+
+    @skipif_no_bench
+    def test_bench(self):
+        n = 100000
+        graph = OntGraph().populate_from_triples(synthetic_classes(n))
+        subjects = sorted(graph.named_subjects())
+        batch = bench_batch(graph.subjectGraph, graph.subjectGraphs, subjects, 1000)
+        assert len(batch) == n
+
+
+class TestMatchNamespace(GraphFixtures, unittest.TestCase):
+
+    def _check(self, g):
+        terms = {e for t in g for e in t if isinstance(e, rdflib.URIRef)}
+        ignore = rdf.type, rdfs.label
+        for prefix, namespace in list(g.namespaces()):
+            new = list(g.matchNamespace(namespace))
+            assert len(new) == len(set(new)), prefix
+            assert set(new) <= terms, prefix
+            for e in new:
+                assert g.compute_qname(e, generate=False)[1] == namespace, e
+
+            ignored = set(g.matchNamespace(namespace, ignore_predicates=ignore))
+            assert ignored <= set(new), prefix
+            assert not ignored & set(ignore), prefix
+
+    def test_nested(self):
+        obo = rdflib.Namespace('http://purl.obolibrary.org/obo/')
+        g = OntGraph()
+        g.bind('obo', obo)
+        g.bind('UBERON', obo['UBERON_'])
+        g.bind('sub', obo['sub/'])
+        for i in range(10):
+            g.add((obo[f'UBERON_{i}'], rdfs.subClassOf, obo[f'BFO_{i}']))
+            g.add((obo[f'sub/thing/{i}'], rdfs.label, rdflib.Literal(str(i))))
+            g.add((obo[f'other/{i}'], ilxtr.p, obo[f'sub/{i}']))
+
+        self._check(g)
+        # terms in a longer bound namespace do not match the shorter one
+        assert set(g.matchNamespace(obo)) == {obo[f'BFO_{i}'] for i in range(10)}
+        assert set(g.matchNamespace(obo['UBERON_'])) == {obo[f'UBERON_{i}'] for i in range(10)}
+        assert set(g.matchNamespace(obo['sub/'])) == {obo[f'sub/{i}'] for i in range(10)}
+        assert not set(g.matchNamespace(obo['sub/'], ignore_predicates=(ilxtr.p,)))
+        assert not list(g.matchNamespace('http://unbound.example.org/'))
+
+    def test_invalidate(self):
+        g = OntGraph().parse(self.fixtures[0])
+        g.bind('ilxtr', ilxtr)
+        self._check(g)
+        g.add((ilxtr.added, rdf.type, owl.Class))
+        assert ilxtr.added in set(g.matchNamespace(ilxtr))
+        g.remove((ilxtr.added, None, None))
+        assert ilxtr.added not in set(g.matchNamespace(ilxtr))
+        g.parse(self.fixtures[1])
+        self._check(g)
+
+    @skipif_no_bench
+    def test_bench(self):
+        n_prefixes, n = 200, 1_000_000
+        namespaces = [rdflib.Namespace(f'http://example.org/ns{i}/') for i in range(n_prefixes)]
+        g = OntGraph()
+        for i, ns in enumerate(namespaces):
+            g.bind(f'ns{i}', ns)
+
+        g.populate_from_triples(
+            (namespaces[i % n_prefixes][f'n{i}'], rdf.type,
+             namespaces[(i * 7) % n_prefixes][f'n{i}']) for i in range(n // 2))
+
+        start = time.time()
+        first = set(g.matchNamespace(namespaces[0]))
+        build = time.time() - start
+        start = time.time()
+        for ns in namespaces:
+            set(g.matchNamespace(ns))
+
+        query = (time.time() - start) / n_prefixes
+        start = time.time()
+        for t in g:
+            pass
+
+        scan = time.time() - start
+        assert first == {namespaces[0][f'n{i}'] for i in range(n // 2)
+                         if not i % n_prefixes or not (i * 7) % n_prefixes}
+        log.info(f'build {build:.2f}s query {query:.4f}s scan {scan:.2f}s')
+        assert query * 100 < scan
+
+
+def modify_labels(triples, every=100):
+    """ change the label of every nth synthetic class """
+    for s, p, o in triples:
+        if p == rdfs.label and not int(str(s).rsplit('-', 1)[1]) % every:
+            o = rdflib.Literal(o + ' changed')
+
+        yield s, p, o
+
+
+class TestDiffFromGraph(GraphFixtures, unittest.TestCase):
+
+    def _check(self, g0):
+        # the subset shares its bnodes with the full graph
+        new = ilxtr.new, rdfs.label, rdflib.Literal('new')
+        g1 = OntGraph().populate_from_triples(sorted(g0)[::7])
+        kept = set(g1)
+        g1.add(new)
+        add, rem, same = [set(d) for d in g0.diffFromGraph(g1)]
+        assert (add, rem, same) == ({new}, set(g0) - kept, kept)
+        add, rem, same = [set(d) for d in g1.diffFromGraph(g0)]
+        assert (add, rem, same) == (set(g0) - kept, {new}, kept)
+        add, rem, same = [set(d) for d in g0.diffFromGraph(g0)]
+        assert (add, rem, same) == (set(), set(), set(g0))
+
+    def test_reparse(self):
+        for fixture, g0 in self.fixture_graphs():
+            g1 = OntGraph().parse(fixture)
+            add, rem, same, subjects = g0.diffFromGraph(g1, subjects=True)
+            assert not add and not rem, fixture
+            assert set(same) == set(g0)
+            assert not any(subjects.values())
+
+    def test_subjects(self):
+        g0 = OntGraph().populate_from_triples(synthetic_classes(300))
+        g1 = OntGraph().populate_from_triples(modify_labels(synthetic_classes(300)))
+        g1.add((ilxtr.new, rdfs.label, rdflib.Literal('new')))
+        g1.remove((ilxtr['class-1'], None, None))
+        add, rem, same, subjects = g0.diffFromGraph(g1, subjects=True)
+        assert subjects['changed'] == {ilxtr[f'class-{i}'] for i in range(0, 300, 100)}
+        assert subjects['added'] == {ilxtr.new}
+        assert subjects['removed'] == {ilxtr['class-1']}
+        # the restriction of class-1 has no parent left so it is not matched
+        assert len(rem) == 3 + 6
+        assert len(add) == 3 + 1 + 3
+
+    def test_plain_graph(self):
+        g0 = OntGraph().populate_from_triples(synthetic_classes(30))
+        g1 = rdflib.Graph()
+        for t in modify_labels(synthetic_classes(30), every=10):
+            g1.add(t)
+
+        g1.add((ilxtr.new, rdfs.label, rdflib.Literal('new')))
+        add, rem, same, subjects = g0.diffFromGraph(g1, subjects=True)
+        changed = [ilxtr[f'class-{i}'] for i in (0, 10, 20)]
+        assert set(rem) == {(s, rdfs.label, rdflib.Literal(f'class {i}'))
+                            for s, i in zip(changed, (0, 10, 20))}
+        assert set(add) == {(s, rdfs.label, rdflib.Literal(f'class {i} changed'))
+                            for s, i in zip(changed, (0, 10, 20))} | {
+                                (ilxtr.new, rdfs.label, rdflib.Literal('new'))}
+        assert len(same) == len(g0) - 3
+        assert subjects == dict(added={ilxtr.new}, removed=set(), changed=set(changed))
+
+        g2 = rdflib.Graph().parse(self.fixtures[0])
+        add, rem, same = OntGraph().parse(self.fixtures[0]).diffFromGraph(g2)
+        assert not add and not rem and len(same) == len(g2)
+
+    @skipif_no_bench
+    def test_bench_500k(self):
+        n = 500_000 // 6
+        g0 = OntGraph().populate_from_triples(synthetic_classes(n))
+        changed = {ilxtr[f'class-{i}'] for i in range(0, n, 100)}
+
+        # an edited copy, bnodes are shared
+        g1 = OntGraph().populate_from_triples(modify_labels(g0))
+        start = time.time()
+        add, rem, same, subjects = g0.diffFromGraph(g1, subjects=True)
+        new_time = time.time() - start
+        assert subjects['changed'] == changed
+        assert len(add) == len(rem) == len(changed)
+        start = time.time()
+        for t in g0:
+            t in g1
+
+        lookup_time = time.time() - start
+        log.info(f'edited {len(g0)} triples diff {new_time:.2f}s lookups {lookup_time:.2f}s')
+        assert new_time < 10 * lookup_time
+
+        # regenerated, every bnode is different
+        g1 = OntGraph().populate_from_triples(modify_labels(synthetic_classes(n)))
+        start = time.time()
+        add, rem, same, subjects = g0.diffFromGraph(g1, subjects=True)
+        log.info(f'regenerated {len(g0)} triples {time.time() - start:.2f}s')
+        assert subjects['changed'] == changed
+        assert len(add) == len(rem) == len(changed)
+
 
 class TestVersionHistory(unittest.TestCase):
     """
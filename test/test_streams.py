@@ -1,8 +1,10 @@
+import shutil
 import unittest
 import rdflib
 from pyontutils.core import OntResIri, OntResPath, OntResGit, OntResAny
 from pyontutils.core import OntGraph, OntConjunctiveGraph
-from .common import skipif_no_net
+from pyontutils.identity_bnode import IdentityBNode, IdentityCache
+from .common import skipif_no_net, temp_path, ensure_temp_path
 
 
 @skipif_no_net
@@ -58,3 +60,45 @@ class TestOntResIriConsecutive(TestOntResIri):
         #super().test_4_graph()
 
 
+class TestIdentityCache(unittest.TestCase):
+    def setUp(self):
+        ensure_temp_path()
+        self.cache = IdentityCache(path=(temp_path / 'identity.sqlite').as_posix())
+        self.path = temp_path / 'nasty.ttl'
+        self.path.write_bytes(open('ttlser/test/nasty.ttl', 'rb').read())
+
+    def tearDown(self):
+        shutil.rmtree(temp_path)
+
+    def test_cached(self):
+        first = OntResPath(self.path)
+        identity = first.identity_next(cache=self.cache)
+        assert hasattr(first, '_graph')
+        expect = IdentityBNode(OntGraph().parse(self.path)).identity
+        assert identity == expect
+        assert first.subject_identities
+
+        second = OntResPath(self.path)
+        assert second.identity_next(cache=self.cache) == identity
+        assert not hasattr(second, '_graph'), 'graph was parsed on a cache hit'
+        assert second.subject_identities == first.subject_identities
+
+    def test_invalidated(self):
+        OntResPath(self.path).identity_next(cache=self.cache)
+        data = self.path.read_bytes()
+        # one byte, a label gains a different final character
+        i = data.index(b'" .')
+        self.path.write_bytes(data[:i - 1] + b'!' + data[i:])
+        changed = OntResPath(self.path)
+        identity = changed.identity_next(cache=self.cache)
+        assert hasattr(changed, '_graph'), 'stale cache entry was used'
+        assert identity == IdentityBNode(OntGraph().parse(self.path)).identity
+
+    def test_spilled(self):
+        # chunks past the spool size go to disk before parsing
+        res = OntResPath(self.path)
+        res.identity_spool_size = 1024
+        assert self.path.stat().st_size > res.identity_spool_size
+        identity = res.identity_next(cache=self.cache)
+        assert len(res._graph) == len(OntGraph().parse(self.path))
+        assert identity == IdentityBNode(OntGraph().parse(self.path)).identity
@@ -16,7 +16,6 @@ with open('README.md', 'rt') as f:
     long_description = f.read()
 
 ttlfmt_require = ['docopt',
-                  'joblib',     # FIXME better if this were optional? or just use a PPE?
 ]
 tests_require = ['pytest'] + ttlfmt_require
 setup(
@@ -54,6 +53,7 @@ setup(
     ],
     extras_require={'dev': ['pytest-cov', 'wheel'],
                     'ttlfmt': ttlfmt_require,
+                    'canonical': ['pyontutils'],  # canonical-nt uses IdentityBNode
                     'test': tests_require},
     entry_points={
         'console_scripts': [
@@ -65,6 +65,7 @@ setup(
             'cmpttl = ttlser:CompactTurtleSerializer',
             'uncmpttl = ttlser:CompactTurtleSerializer',
             'rktttl = ttlser:CompactTurtleSerializer',
+            'canonical-nt = ttlser:CanonicalNTriplesSerializer',
         ],
     },
     data_files=[('share/ttlser/', ['test/nasty.ttl',
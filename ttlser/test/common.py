@@ -0,0 +1,8 @@
+import os
+import logging
+import unittest
+
+log = logging.getLogger('ttlser.test')
+
+RUN_BENCHMARKS = 'BENCHMARK' in os.environ
+skipif_no_bench = unittest.skipUnless(RUN_BENCHMARKS, 'Skipping benchmark, set BENCHMARK to run')
@@ -1,7 +1,21 @@
+import os
+import re
 import sys
+import random
+import shutil
+import tempfile
 import unittest
+from pathlib import Path
+import rdflib
+from ttlser import ttlfmt
 from ttlser.ttlfmt import main
 
+try:
+    import pyontutils.identity_bnode
+    HAS_PYONTUTILS = True
+except ImportError:
+    HAS_PYONTUTILS = False
+
 f1 = 'test/good.ttl', 'test/f1.ttl'
 f2 = 'test/nasty.ttl', 'test/f2.ttl'
 
@@ -34,3 +48,219 @@ class TestXml(TestTtlfmt):
 
     def test_run_2(self):
         super().test_run()
+
+
+def read_relabeled(path):
+    """ bnode labels from the parser differ between runs """
+    labels = {}
+    with open(path, 'rt') as f:
+        return re.sub(r'_:\w+', lambda m: labels.setdefault(m.group(), f'_:b{len(labels)}'),
+                      f.read())
+
+
+class TestJobs(TestTtlfmt):
+    argv = ['ttlfmt', f1[1], f2[1], '--slow', '--jobs', '2']
+    def test_run(self):
+        super().test_run()
+        parallel = [read_relabeled(dest) for _, dest in (f1, f2)]
+        self.setUp()
+        sys.argv = TestTtlfmt.argv
+        super().test_run()
+        serial = [read_relabeled(dest) for _, dest in (f1, f2)]
+        assert parallel == serial
+
+
+class TempDir(unittest.TestCase):
+    """ run ttlfmt in a temporary directory with its own cache """
+
+    def setUp(self):
+        self.tempdir = Path(tempfile.mkdtemp())
+        self.old_cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = (self.tempdir / 'cache').as_posix()
+        self.oldargv = sys.argv
+
+    def tearDown(self):
+        sys.argv = self.oldargv
+        if self.old_cache_home is None:
+            os.environ.pop('XDG_CACHE_HOME')
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.old_cache_home
+
+        shutil.rmtree(self.tempdir)
+
+
+@unittest.skipUnless(HAS_PYONTUTILS, 'canonical-nt requires pyontutils')
+class TestCanonicalNT(TempDir):
+
+    def test_orderings(self):
+        graph = rdflib.Graph().parse(f2[0], format='turtle')
+        lines = graph.serialize(format='nt').splitlines(keepends=True)
+        random.shuffle(lines)
+        shuffled = self.tempdir / 'shuffled.nt'
+        with open(shuffled, 'wt') as f:
+            f.writelines(lines)
+
+        outs = []
+        for source in (f2[0], shuffled.as_posix()):
+            out = self.tempdir / 'out.nt'
+            sys.argv = ['ttlfmt', source, '-t', 'canonical-nt', '--output', out.as_posix()]
+            main()
+            with open(out, 'rb') as f:
+                outs.append(f.read())
+
+        assert outs[0] == outs[1]
+        assert len(outs[0].splitlines()) == len(graph)
+
+
+class TestSkipCache(TempDir):
+    n_files = 500
+
+    def setUp(self):
+        super().setUp()
+        self.old_parse = ttlfmt.parse
+        self.parsed = []
+        def parse(*args, **kwargs):
+            self.parsed.append(kwargs['source'])
+            return self.old_parse(*args, **kwargs)
+
+        ttlfmt.parse = parse
+
+        ex = rdflib.Namespace('http://example.org/ex/')
+        self.files = []
+        for i in range(self.n_files):
+            graph = rdflib.Graph()
+            graph.bind('ex', ex)
+            graph.add((ex[f'c{i}'], rdflib.RDF.type, rdflib.OWL.Class))
+            graph.add((ex[f'c{i}'], rdflib.RDFS.label, rdflib.Literal(f'class {i}')))
+            path = self.tempdir / f'f{i}.ttl'
+            graph.serialize(path.as_posix(), format='nifttl')
+            self.files.append(path.as_posix())
+
+    def tearDown(self):
+        ttlfmt.parse = self.old_parse
+        super().tearDown()
+
+    def run_main(self, *args):
+        sys.argv = ['ttlfmt', *args, '--slow']
+        self.parsed = []
+        main()
+        return self.parsed
+
+    def test_second_run(self):
+        assert len(self.run_main(*self.files)) == self.n_files
+        assert not self.run_main(*self.files)
+        # changing the options that affect the output invalidates the cache
+        assert len(self.run_main(*self.files, '--format', 'ttl')) == self.n_files
+
+    def test_no_cache(self):
+        self.run_main(*self.files)
+        assert len(self.run_main(*self.files, '--no-cache')) == self.n_files
+
+    def test_check(self):
+        unformatted = (self.tempdir / 'nasty.ttl').as_posix()
+        shutil.copy(f2[0], unformatted)
+        with open(unformatted, 'rb') as f:
+            before = f.read()
+
+        for i in range(2):  # the second check uses the cache
+            with self.assertRaises(SystemExit) as cm:
+                self.run_main(self.files[0], unformatted, '--check')
+
+            assert cm.exception.code == 1
+            with open(unformatted, 'rb') as f:
+                assert f.read() == before
+
+        assert not self.parsed
+        self.run_main(self.files[0], '--check')  # formatted files exit cleanly
+
+    def test_check_output(self):
+        output = (self.tempdir / 'out.ttl').as_posix()
+        with self.assertRaises(SystemExit) as cm:
+            self.run_main(self.files[0], '--check', '--output', output)
+
+        assert cm.exception.code == 2
+        assert not os.path.exists(output)
+
+
+class TestPool(TempDir):
+    sizes = 1, 2000, 10, 500, 50, 5000, 3, 200
+
+    def setUp(self):
+        super().setUp()
+        ex = rdflib.Namespace('http://example.org/ex/')
+        owl, rdf, rdfs = rdflib.OWL, rdflib.RDF, rdflib.RDFS
+        self.serial, self.pool = [], []
+        for i, n in enumerate(self.sizes):
+            graph = rdflib.Graph()
+            graph.bind('ex', ex)
+            for j in range(n):
+                c, r = ex[f'c{j}'], rdflib.BNode()
+                graph.add((c, rdf.type, owl.Class))
+                graph.add((c, rdfs.label, rdflib.Literal(f'class {j}')))
+                graph.add((c, rdfs.subClassOf, r))
+                graph.add((r, rdf.type, owl.Restriction))
+                graph.add((r, owl.onProperty, ex[f'p{j % 7}']))
+                graph.add((r, owl.someValuesFrom, ex[f'c{j // 2}']))
+
+            data = graph.serialize(format='turtle', encoding='utf-8')
+            for name, files in (('serial', self.serial), ('pool', self.pool)):
+                path = self.tempdir / f'{name}-{i}.ttl'
+                with open(path, 'wb') as f:
+                    f.write(data)
+
+                files.append(path.as_posix())
+
+    def test_by_size(self):
+        ordered = ttlfmt.by_size(self.pool)
+        sizes = [os.path.getsize(f) for f in ordered]
+        assert sizes == sorted(sizes, reverse=True)
+        assert sorted(ordered) == sorted(self.pool)
+
+    def test_pool(self):
+        sys.argv = ['ttlfmt', *self.serial, '--slow', '--no-cache']
+        main()
+        sys.argv = ['ttlfmt', *self.pool, '--workers', '3', '--no-cache']
+        main()
+        for serial, pool in zip(self.serial, self.pool):
+            with open(serial, 'rb') as s, open(pool, 'rb') as p:
+                out = s.read()
+                assert out == p.read()
+                assert b'### Serialized using the ttlser' in out
+
+    def test_pool_options(self):
+        from ttlser.serializers import CustomTurtleSerializer
+        # configure sets these on the class in this process
+        cts = CustomTurtleSerializer
+        old = cts.no_reorder_list, cts._do_id_swap
+        def restore():
+            cts.no_reorder_list, cts._do_id_swap = old
+
+        self.addCleanup(restore)
+        for option in ('--noreord', '--id-swap'):
+            sys.argv = ['ttlfmt', *self.serial, '--slow', '--no-cache', option]
+            main()
+            sys.argv = ['ttlfmt', *self.pool, '--workers', '3', '--no-cache', option]
+            main()
+            for serial, pool in zip(self.serial, self.pool):
+                with open(serial, 'rb') as s, open(pool, 'rb') as p:
+                    assert s.read() == p.read(), option
+
+    def test_pool_curies(self):
+        curies = self.tempdir / 'curies.ttl'
+        with open(curies, 'wt') as f:
+            f.write('@prefix exc: <http://example.org/ex/> .\n')
+
+        curies_from = ['--curies-from', curies.as_posix()]
+        sys.argv = ['ttlfmt', *self.serial, '--slow', '--no-cache', *curies_from]
+        main()
+        # the pool run populates the cache for the serial check below
+        sys.argv = ['ttlfmt', *self.pool, '--workers', '3', *curies_from]
+        main()
+        for serial, pool in zip(self.serial, self.pool):
+            with open(serial, 'rb') as s, open(pool, 'rb') as p:
+                out = s.read()
+                assert out == p.read()
+                assert b'exc:c0' in out
+
+        sys.argv = ['ttlfmt', *self.pool, '--slow', '--check', *curies_from]
+        main()  # exits nonzero if anything would change
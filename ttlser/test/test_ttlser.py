@@ -1,3 +1,4 @@
+import io
 import os
 import re
 import sys
@@ -5,20 +6,138 @@ import difflib
 import inspect
 import unittest
 import subprocess
+import tracemalloc
+from time import time
 from io import BytesIO
 from random import shuffle
 from pathlib import Path
 from collections import defaultdict
 import rdflib
+from rdflib.compare import isomorphic
 from rdflib.plugins.serializers.turtle import TurtleSerializer
 
 from ttlser import CustomTurtleSerializer, SubClassOfTurtleSerializer
 from ttlser import CompactTurtleSerializer, UncompactTurtleSerializer
-from ttlser import RacketTurtleSerializer
+from ttlser import RacketTurtleSerializer, CanonicalNTriplesSerializer
+from ttlser.utils import subclasses
+from ttlser.serializers import Instrumentation, qname_mp
+
+from common import log, skipif_no_bench
 
 thisfile = Path(__file__).resolve()
 parent = thisfile.parent.parent
 
+try:
+    import pyontutils.identity_bnode
+    HAS_PYONTUTILS = True
+except ImportError:
+    HAS_PYONTUTILS = False
+
+skipif_no_pyontutils = unittest.skipUnless(HAS_PYONTUTILS, 'canonical-nt requires pyontutils')
+
+
+def synthetic_graph(n_triples):
+    """ owl-ish graph with literals, restrictions, and lists, ~10 triples per class """
+    ex = rdflib.Namespace('http://example.org/ex/')
+    owl, rdf, rdfs = rdflib.OWL, rdflib.RDF, rdflib.RDFS
+    graph = rdflib.Graph()
+    graph.bind('ex', ex)
+    graph.bind('owl', owl)
+    n = max(n_triples // 10, 1)
+    for i in range(n):
+        c = ex[f'C{i}']
+        r = rdflib.BNode()
+        graph.add((c, rdf.type, owl.Class))
+        graph.add((c, rdfs.label, rdflib.Literal(f'class {i}')))
+        graph.add((c, ex['count'], rdflib.Literal(i % 1000)))
+        graph.add((c, rdfs.subClassOf, ex[f'C{i // 2}']))
+        graph.add((c, rdfs.subClassOf, r))
+        graph.add((r, rdf.type, owl.Restriction))
+        graph.add((r, owl.onProperty, ex[f'p{i % 17}']))
+        graph.add((r, owl.someValuesFrom, ex[f'C{(i * 7) % n}']))
+        if i % 4 == 0:
+            l = rdflib.BNode()
+            graph.add((c, owl.disjointWith, ex[f'C{(i + 1) % n}']))
+            graph.add((c, ex['members'], l))
+            graph.add((l, rdf.first, ex[f'C{(i * 3) % n}']))
+            graph.add((l, rdf.rest, rdf.nil))
+        else:
+            graph.add((c, rdfs.comment, rdflib.Literal(f'Comment {i % 100}', lang='en')))
+            graph.add((c, ex['weight'], rdflib.Literal(i / 8)))
+
+    return graph
+
+
+def multi_section_graph(n):
+    """ graph with subjects in every section, shared bnodes, axioms,
+        lists of bnodes, and untyped subjects """
+    ex = rdflib.Namespace('http://example.org/ex/')
+    owl, rdf, rdfs = rdflib.OWL, rdflib.RDF, rdflib.RDFS
+    graph = synthetic_graph(n * 10)
+    ont = rdflib.URIRef('http://example.org/ex.ttl')
+    graph.add((ont, rdf.type, owl.Ontology))
+    graph.add((ont, owl.imports, rdflib.URIRef('http://example.org/other.ttl')))
+    for i in range(17):
+        p = ex[f'p{i}']
+        graph.add((p, rdf.type, owl.ObjectProperty))
+        graph.add((p, rdfs.label, rdflib.Literal(f'property {i}')))
+        graph.add((ex[f'a{i}'], rdf.type, owl.AnnotationProperty))
+
+    shared = rdflib.BNode()
+    graph.add((shared, rdf.type, owl.Restriction))
+    graph.add((shared, owl.onProperty, ex['p0']))
+    graph.add((shared, owl.allValuesFrom, ex['C0']))
+    for i in range(n):
+        c = ex[f'C{i}']
+        graph.add((ex[f'I{i}'], rdf.type, owl.NamedIndividual))
+        graph.add((ex[f'I{i}'], rdf.type, c))
+        graph.add((ex[f'U{i}'], ex[f'a{i % 17}'], rdflib.Literal(f'untyped {i}')))
+        if i % 5 == 0:
+            graph.add((c, rdfs.subClassOf, shared))
+        if i % 3 == 0:
+            a = rdflib.BNode()
+            graph.add((a, rdf.type, owl.Axiom))
+            graph.add((a, owl.annotatedSource, c))
+            graph.add((a, owl.annotatedProperty, rdfs.label))
+            graph.add((a, owl.annotatedTarget, rdflib.Literal(f'class {i}')))
+            graph.add((a, ex['a0'], rdflib.Literal(f'source {i}')))
+        if i % 7 == 0:
+            cells = [rdflib.BNode() for _ in range(3)]
+            graph.add((c, owl.unionOf, cells[0]))
+            for j, (cell, rest) in enumerate(zip(cells, cells[1:] + [rdf.nil])):
+                r = rdflib.BNode()
+                graph.add((cell, rdf.first, r))
+                graph.add((cell, rdf.rest, rest))
+                graph.add((r, rdf.type, owl.Restriction))
+                graph.add((r, owl.onProperty, ex[f'p{j}']))
+                graph.add((r, owl.someValuesFrom, ex[f'C{(i + j) % n}']))
+
+    return graph
+
+
+def nested_restrictions(n_bnodes, depth=5):
+    """ chains of owl:someValuesFrom restrictions depth bnodes deep """
+    ex = rdflib.Namespace('http://example.org/ex/')
+    owl, rdf, rdfs = rdflib.OWL, rdflib.RDF, rdflib.RDFS
+    graph = rdflib.Graph()
+    graph.bind('ex', ex)
+    graph.bind('owl', owl)
+    n = max(n_bnodes // depth, 1)
+    for i in range(n):
+        c = ex[f'C{i}']
+        graph.add((c, rdf.type, owl.Class))
+        subject, predicate = c, rdfs.subClassOf
+        for d in range(depth):
+            r = rdflib.BNode()
+            graph.add((subject, predicate, r))
+            graph.add((r, rdf.type, owl.Restriction))
+            graph.add((r, owl.onProperty, ex[f'p{(i + d) % 13}']))
+            subject, predicate = r, owl.someValuesFrom
+
+        graph.add((subject, predicate, ex[f'C{(i * 7) % n}']))
+
+    return graph
+
 
 def randomize_dict_order(d):
     random_order_keys = list(d)
@@ -344,3 +463,310 @@ class TestPredicateScoStrEq(unittest.TestCase):
               -1),
              p)
             for p in nser.predicateOrder]
+
+
+class TestNoMutation(unittest.TestCase):
+
+    path = 'test/nasty.ttl'
+    serializers = (CustomTurtleSerializer, *subclasses(CustomTurtleSerializer))
+
+    def _check(self, serializer):
+        graph = rdflib.Graph()
+        graph.parse((parent / self.path).as_posix(), format='turtle')
+        dw = rdflib.OWL.disjointWith
+        flipped = [(s, dw, o) for s, o in graph.subject_objects(dw)
+                   if isinstance(s, rdflib.URIRef) and
+                   isinstance(o, rdflib.URIRef) and o < s]
+        assert flipped
+        triples = set(graph)
+        length = len(graph)
+        namespaces = sorted(graph.namespaces())
+        ser = serializer(graph)
+        stream = BytesIO()
+        ser.serialize(stream)
+        assert len(graph) == length
+        assert set(graph) == triples
+        assert sorted(graph.namespaces()) == namespaces
+        # qname is only replaced on the overlay
+        assert type(graph).qname is not qname_mp
+        assert 'qname' in vars(ser.store)
+        # the serializer still sees its own changes
+        for s, p, o in flipped:
+            assert (s, p, o) in graph
+            assert (s, p, o) not in ser.store
+            assert (o, p, s) in ser.store
+
+    def test_serializers(self):
+        for serializer in self.serializers:
+            with self.subTest(serializer=serializer.__name__):
+                self._check(serializer)
+
+    def test_id_swap(self):
+        for serializer in self.serializers:
+            with self.subTest(serializer=serializer.__name__):
+                serializer._do_id_swap = True
+                try:
+                    self._check(serializer)
+                finally:
+                    serializer._do_id_swap = False
+
+
+class CountingStream(BytesIO):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        return super().write(data)
+
+
+class TestStreaming(unittest.TestCase):
+
+    serializers = (CustomTurtleSerializer, *subclasses(CustomTurtleSerializer))
+
+    def _ser(self, serializer, graph, max_buffer_bytes):
+        stream = CountingStream()
+        serializer(graph).serialize(stream, max_buffer_bytes=max_buffer_bytes)
+        return stream
+
+    def test_buffer_sizes(self):
+        graph = synthetic_graph(2000)
+        for serializer in self.serializers:
+            with self.subTest(serializer=serializer.__name__):
+                unbuffered = self._ser(serializer, graph, 0)
+                small = self._ser(serializer, graph, 64)
+                default = self._ser(serializer, graph, None)
+                assert unbuffered.getvalue() == small.getvalue() == default.getvalue()
+                assert default.writes < small.writes < unbuffered.writes
+
+
+class TestParallel(unittest.TestCase):
+
+    serializers = (CustomTurtleSerializer, *subclasses(CustomTurtleSerializer))
+    paths = 'good.ttl', 'nasty.ttl', 'scogood.ttl', 'list-nasty.ttl', 'no-reorder.ttl'
+
+    def _check(self, graph):
+        for serializer in self.serializers:
+            with self.subTest(serializer=serializer.__name__):
+                outs = []
+                for parallel in (1, 2, 3):
+                    stream = BytesIO()
+                    serializer(graph).serialize(stream, parallel=parallel)
+                    outs.append(stream.getvalue())
+
+                assert outs[0] == outs[1] == outs[2]
+
+    def test_corpus(self):
+        for path in self.paths:
+            with self.subTest(path=path):
+                graph = rdflib.Graph()
+                graph.parse((parent / 'test' / path).as_posix(), format='turtle')
+                self._check(graph)
+
+    def test_sections(self):
+        graph = multi_section_graph(500)
+        stream = BytesIO()
+        CustomTurtleSerializer(graph).serialize(stream, parallel=2)
+        out = stream.getvalue()
+        for header in (b'### Object Properties', b'### Classes',
+                       b'### Individuals', b'### Axioms', b'### Annotations'):
+            assert header in out, header
+
+        self._check(graph)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    path = 'test/nasty.ttl'
+
+    def test_counters(self):
+        graph = rdflib.Graph()
+        graph.parse((parent / self.path).as_posix(), format='turtle')
+        assert CustomTurtleSerializer(graph).instrumentation is None
+        ser = CustomTurtleSerializer(graph, instrument=True)
+        stream = BytesIO()
+        ser.serialize(stream)
+        inst = ser.instrumentation
+        assert set(inst.times) == {'term keys', 'predicate rank', 'literal uri rank',
+                                   'list rank', 'bnode rank', 'preprocess',
+                                   'order subjects', 'write'}
+        assert all(t >= 0 for t in inst.times.values())
+        counts = inst.counts
+        assert counts['bnodes'] == len(ser.node_rank) == 284
+        assert counts['lists'] == 70
+        assert counts['fixed point rounds'] >= 1
+        assert counts['qname cache hits'] > 0
+        assert counts['bytes written'] == len(stream.getvalue())
+        assert 'bnode rank' in str(inst)
+
+    def test_per_call(self):
+        graph = rdflib.Graph()
+        graph.parse((parent / self.path).as_posix(), format='turtle')
+        inst = Instrumentation()
+        out = graph.serialize(format='nifttl', encoding='utf-8', instrument=inst)
+        assert 'bnode rank' in inst.times and 'write' in inst.times
+        assert inst.counts['bytes written'] == len(out)
+        assert inst.counts['bnodes'] == 284
+        # nothing leaks into other serializers
+        ser = CustomTurtleSerializer(graph)
+        ser.serialize(BytesIO())
+        assert ser.instrumentation is None
+        assert inst.counts['bnodes'] == 284
+
+    def test_debug(self):
+        from ttlser import serializers
+        graph = rdflib.Graph()
+        graph.parse((parent / 'test/good.ttl').as_posix(), format='turtle')
+        expect = graph.serialize(format='nifttl', encoding='utf-8')
+        stderr = sys.stderr
+        serializers.DEBUG = True
+        sys.stderr = io.StringIO()
+        try:
+            out = graph.serialize(format='nifttl', encoding='utf-8')
+            debug = sys.stderr.getvalue()
+        finally:
+            serializers.DEBUG = False
+            sys.stderr = stderr
+
+        assert out == expect
+        assert 'rank index v' in debug
+
+
+def reordered(graph):
+    """ a copy of graph with new bnode ids and a shuffled insertion order """
+    bnodes = {}
+    def swap(e):
+        if isinstance(e, rdflib.BNode):
+            if e not in bnodes:
+                bnodes[e] = rdflib.BNode()
+            return bnodes[e]
+        return e
+
+    triples = [tuple(swap(e) for e in t) for t in graph]
+    shuffle(triples)
+    out = rdflib.Graph()
+    for t in triples:
+        out.add(t)
+
+    return out
+
+
+@skipif_no_pyontutils
+class TestCanonicalNT(unittest.TestCase):
+
+    paths = 'good.ttl', 'nasty.ttl', 'list-nasty.ttl'
+
+    def _ser(self, graph, max_sort_bytes=None):
+        serializer = CanonicalNTriplesSerializer(graph)
+        stream = BytesIO()
+        serializer.serialize(stream, max_sort_bytes=max_sort_bytes)
+        return stream.getvalue(), serializer.spills
+
+    def _check(self, graph, check_isomorphic=True):
+        out, _ = self._ser(graph)
+        lines = out.splitlines()
+        assert lines == sorted(set(lines))
+        assert len(lines) == len(graph)
+        assert out == self._ser(graph)[0]
+        assert out == self._ser(reordered(graph))[0]
+        parsed = rdflib.Graph().parse(data=out.decode(), format='nt')
+        if check_isomorphic:  # slow for large graphs
+            assert isomorphic(graph, parsed)
+
+        assert out == self._ser(parsed)[0]
+        return out
+
+    def test_corpus(self):
+        for path in self.paths:
+            with self.subTest(path=path):
+                graph = rdflib.Graph()
+                graph.parse((parent / 'test' / path).as_posix(), format='turtle')
+                self._check(graph)
+
+    def test_cycles(self):
+        graph = rdflib.Graph()
+        graph.parse((parent / 'test' / 'evil.ttl').as_posix(), format='turtle')
+        with self.assertRaises(ValueError):
+            self._ser(graph)
+
+    def test_spill(self):
+        graph = synthetic_graph(20000)
+        out = self._check(graph, check_isomorphic=False)
+        max_sort_bytes = 2 ** 16
+        assert len(out) > max_sort_bytes * 10
+        spilled, spills = self._ser(reordered(graph), max_sort_bytes)
+        assert spills >= 10
+        assert spilled == out
+
+    def test_plugin(self):
+        graph = synthetic_graph(100)
+        assert graph.serialize(format='canonical-nt', encoding='utf-8') == self._ser(graph)[0]
+
+
+class TestBenchmark(unittest.TestCase):
+
+    serializer = CustomTurtleSerializer
+    n_triples = 1_000_000
+    n_triples_memory = 2_000_000
+    n_bnodes = 200_000
+
+    @skipif_no_bench
+    def test_bench_bnodes(self):
+        # ranking time is dominated by _BNodeRank for this graph
+        graph = nested_restrictions(self.n_bnodes)
+        start = time()
+        ser = self.serializer(graph)
+        done = time()
+        assert len(ser.node_rank) == self.n_bnodes
+        log.info(f'{self.__class__.__name__} {len(ser.node_rank)} nested bnodes '
+                 f'rank: {done - start:.2f}s')
+
+    @skipif_no_bench
+    def test_bench(self):
+        graph = synthetic_graph(self.n_triples)
+        start = time()
+        ser = self.serializer(graph)
+        ranked = time()
+        stream = BytesIO()
+        ser.serialize(stream)
+        done = time()
+        log.info(f'{self.__class__.__name__} {len(graph)} triples '
+                 f'rank: {ranked - start:.2f}s '
+                 f'serialize: {done - ranked:.2f}s '
+                 f'total: {done - start:.2f}s')
+
+    @skipif_no_bench
+    def test_bench_memory(self):
+        # peak memory used by the serializer on top of the graph itself
+        # writing to a file vs holding the whole document in memory
+        def peaks(graph, stream):
+            base, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            ser = self.serializer(graph)
+            _, rank_peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            ser.serialize(stream)
+            _, write_peak = tracemalloc.get_traced_memory()
+            return rank_peak - base, write_peak - base
+
+        tracemalloc.start()
+        try:
+            graph = synthetic_graph(self.n_triples_memory)
+            size, _ = tracemalloc.get_traced_memory()
+            in_memory = BytesIO()
+            _, in_memory_peak = peaks(graph, in_memory)
+            in_memory.close()
+            with open(os.devnull, 'wb') as stream:
+                rank_peak, streaming_peak = peaks(graph, stream)
+        finally:
+            tracemalloc.stop()
+
+        M = 1024 ** 2
+        log.info(f'{self.__class__.__name__} {len(graph)} triples '
+                 f'graph: {size / M:.1f}M '
+                 f'rank peak: {rank_peak / M:.1f}M '
+                 f'write peak in memory: {in_memory_peak / M:.1f}M '
+                 f'streaming: {streaming_peak / M:.1f}M')
+        assert streaming_peak < in_memory_peak
+        assert max(rank_peak, streaming_peak) < size
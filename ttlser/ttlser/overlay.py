@@ -0,0 +1,129 @@
+""" Read only overlays so that serializers never modify the caller's graph. """
+
+import rdflib
+from rdflib.store import Store
+from rdflib.plugins.stores.memory import Memory
+
+
+class OverlayStore(Store):
+    """ A store that reads through to an underlying graph and records
+        any additions and removals in a delta instead of applying them.
+        Namespace bindings are copied on creation and also kept local. """
+
+    context_aware = False
+    formula_aware = False
+    graph_aware = False
+    transaction_aware = False
+
+    def __init__(self, graph):
+        super().__init__()
+        self.graph = graph
+        if type(graph).triples is rdflib.Graph.triples:
+            # read from the store directly, Graph.triples only adds paths
+            self._store, self._context = graph.store, graph
+        else:  # the graph defines its own triples e.g. for a union
+            self._store = self._context = None
+
+        self._added = Memory()
+        self._removed = set()
+        self._namespace = dict(graph.namespaces())
+        self._prefix = {}
+        for namespace in set(self._namespace.values()):
+            prefix = graph.store.prefix(namespace)
+            if prefix is not None:
+                self._prefix[namespace] = prefix
+
+    def _graph_triples(self, triple_pattern):
+        if self._store is None:
+            yield from self.graph.triples(triple_pattern)
+        else:
+            for triple, _ in self._store.triples(triple_pattern, self._context):
+                yield triple
+
+    def _in_graph(self, triple):
+        for _ in self._graph_triples(triple):
+            return True
+
+        return False
+
+    def add(self, triple, context=None, quoted=False):
+        if triple in self._removed:
+            self._removed.remove(triple)
+        elif not self._in_graph(triple):
+            self._added.add(triple, None)
+
+    def remove(self, triple_pattern, context=None):
+        for triple in [t for t, _ in self.triples(triple_pattern)]:
+            if triple in self._removed:
+                continue
+            elif self._in_graph(triple):
+                self._removed.add(triple)
+            else:
+                self._added.remove(triple, None)
+
+    def triples(self, triple_pattern, context=None):
+        removed = self._removed
+        for triple in self._graph_triples(triple_pattern):
+            if not removed or triple not in removed:
+                yield triple, iter(())
+
+        if len(self._added):
+            for triple, _ in self._added.triples(triple_pattern, None):
+                yield triple, iter(())
+
+    def __len__(self, context=None):
+        return len(self.graph) - len(self._removed) + len(self._added)
+
+    def contexts(self, triple=None):
+        return iter(())
+
+    def bind(self, prefix, namespace, override=True):
+        """ same semantics as Memory.bind """
+        bound_namespace = self._namespace.get(prefix)
+        bound_prefix = self._prefix.get(namespace)
+        if bound_prefix is None:
+            bound_prefix = self._prefix.get(bound_namespace)
+
+        if override:
+            if bound_prefix is not None:
+                del self._namespace[bound_prefix]
+            if bound_namespace is not None:
+                del self._prefix[bound_namespace]
+            self._prefix[namespace] = prefix
+            self._namespace[prefix] = namespace
+        else:
+            ns = namespace if bound_namespace is None else bound_namespace
+            pf = prefix if bound_prefix is None else bound_prefix
+            self._prefix[ns] = pf
+            self._namespace[pf] = ns
+
+    def unbind(self, prefix):
+        namespace = self._namespace.pop(prefix, None)
+        if namespace is not None and self._prefix.get(namespace) == prefix:
+            self._prefix.pop(namespace)
+
+    def namespace(self, prefix):
+        return self._namespace.get(prefix, None)
+
+    def prefix(self, namespace):
+        return self._prefix.get(namespace, None)
+
+    def namespaces(self):
+        yield from tuple(self._namespace.items())
+
+
+def overlay(graph):
+    """ Return a graph that reads through to graph but that
+        can be modified without modifying graph. """
+    if isinstance(graph.store, OverlayStore):
+        return graph
+
+    store = OverlayStore(graph)
+    try:
+        out = rdflib.Graph(store=store, identifier=graph.identifier,
+                           base=graph.base, bind_namespaces='none')
+    except TypeError:  # rdflib < 6.2
+        out = rdflib.Graph(store=store, identifier=graph.identifier,
+                           base=graph.base)
+
+    return out
@@ -1,12 +1,22 @@
 import re
 import sys
+import hashlib
+from types import MethodType
+from io import BytesIO
+from time import perf_counter
+from itertools import islice
+from collections import Counter
+from contextlib import contextmanager
 from decimal import Decimal
 from datetime import datetime
 from rdflib import RDF, RDFS, OWL, XSD, BNode, URIRef, Literal
 from rdflib.graph import QuotedGraph
+from rdflib.serializer import Serializer
+from rdflib.plugins.serializers.nt import _nt_row
 from rdflib.namespace import SKOS, DC, Namespace
 from rdflib.plugins.serializers.turtle import TurtleSerializer
-from ttlser.utils import subclasses
+from ttlser.utils import subclasses, can_fork, fork_map, ExternalSort
+from ttlser.overlay import overlay
 
 # XXX WARNING prefixes are not 100% deterministic if there is more than one prefix for namespace
 #     the implementation of IOMemory.bind in rdflib means that the last prefix defined in the list
@@ -54,7 +64,7 @@ def make_litsort(sortkey=natsort):
     return litsort
 
 
-def qname_mp(self, uri):  # for monkey patching Graph
+def qname_mp(self, uri):  # bound on the overlay graph to fix generate=True
     try:
         prefix, namespace, name = self.compute_qname(uri, False)
     except (ValueError, KeyError) as e:#Exception:  # no prefix no problems
@@ -154,16 +164,108 @@ class ListRanker:
         else:
             return out
 
-    def irank_vec(self, ranks):
-        out = tuple(sorted(self._bval_key(v, ranks) for v in self.bvals))
-        return out
-
     def _vis_val_key(self, val):
         if val in self.serializer.object_rank:
             return self.serializer.object_rank[val]
 
-    def _bval_key(self, val, ranks):
-        return ranks[val]
+
+class TermKeys:
+    """ Per-serialization table of sort keys for the URIRefs, Literals,
+        and predicates in a store. Each key is computed once per distinct
+        term and is shared by all of the ranking phases. """
+
+    def __init__(self, serializer):
+        self.qname = serializer.store.qname
+        self.sortkey = serializer.sortkey
+        self.litsortkey = serializer.litsortkey
+        self._uri_keys = {}
+        self.hits = 0
+        predicates = {}
+        uris = {}
+        literals = {}
+        for t in serializer.store:
+            predicates[t[1]] = None
+            for e in t:
+                if isinstance(e, URIRef):
+                    uris[e] = None
+
+            o = t[2]
+            if isinstance(o, Literal):
+                literals[o] = None
+
+        self.predicates = tuple(predicates)
+        self.uris = tuple(uris)
+        self.literals = self.sort_literals(literals)
+
+    def uri_key(self, uri):
+        """ (sortkey(qname), qname) which matches sorting on qname
+            and then stable sorting on sortkey(qname) """
+        try:
+            key = self._uri_keys[uri]
+            self.hits += 1
+            return key
+        except KeyError:
+            qname = self.qname(uri)
+            key = self._uri_keys[uri] = self.sortkey(qname), qname
+            return key
+
+    def sort_uris(self, uris):
+        return sorted(uris, key=self.uri_key)
+
+    def sort_literals(self, literals):
+        """ same order as sorted(sorted(literals), key=litsortkey) but only
+            falls back to the (slow) rdflib term ordering to break ties """
+        litsortkey = self.litsortkey
+        keyed = sorted(((litsortkey(l), l) for l in literals),
+                       key=lambda kl: kl[0])
+        out = []
+        run = []
+        old_key = None
+        for key, l in keyed:
+            # keys may hold Literals that are neither equal nor ordered
+            if run and old_key < key:
+                out.extend(sorted(run) if len(run) > 1 else run)
+                run = []
+            run.append(l)
+            old_key = key
+
+        out.extend(sorted(run) if len(run) > 1 else run)
+        return out
+
+
+class Instrumentation:
+    """ Wall time per phase and counters for a single serializer.
+        Pass instrument=True or an Instrumentation to the serializer or
+        to serialize, e.g. graph.serialize(format='nifttl', instrument=inst),
+        read from serializer.instrumentation (or inst) after serialize. """
+
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0) + perf_counter() - start
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def update(self, other):
+        for name, t in other.times.items():
+            self.times[name] = self.times.get(name, 0) + t
+
+        for name, n in other.counts.items():
+            self.count(name, n)
+
+    def __str__(self):
+        names = (*self.times, *self.counts)
+        width = max(len(name) for name in names) if names else 0
+        return ''.join([f'{name:<{width}} {t:.3f}s\n' for name, t in self.times.items()] +
+                       [f'{name:<{width}} {n}\n' for name, n in self.counts.items()])
 
 
 SUBJECT = 0
@@ -185,6 +287,8 @@ class CustomTurtleSerializer(TurtleSerializer):
     make_litsortkey = staticmethod(make_litsort)
     _do_id_swap = False
     _idswap = {}
+    max_buffer_bytes = 2 ** 16  # output held before writing to the stream
+    parallel = 1  # processes used to write subject blocks
     no_reorder_list = (OWL.propertyChainAxiom,)
     no_reorder_rdf_star = {
          OWL.annotatedTarget: OWL.annotatedProperty,
@@ -286,8 +390,16 @@ class CustomTurtleSerializer(TurtleSerializer):
                 cls.topClasses = [uri] + cls.topClasses
                 cls.SECTIONS = ('',) + cls.SECTIONS
 
-    def __init__(self, store, reset=True):
-        setattr(store.__class__, 'qname', qname_mp)  # monkey patch to fix generate=True
+    def __init__(self, store, reset=True, instrument=None):
+        # ranking runs before serialize is called, it is always recorded
+        # (a handful of timers and counters) so that serialize(instrument=...)
+        # can report it as well
+        self._unreported = Instrumentation()
+        self.instrumentation = None
+        self._setInstrumentation(instrument)
+        # all changes made while serializing go to the overlay, never to store
+        store = overlay(store)
+        store.qname = MethodType(qname_mp, store)  # only the overlay, never rdflib.Graph
         if reset:
             store.namespace_manager.reset()  # ensure that the namespace_manager cache doesn't lead to non deterministic ser
 
@@ -296,7 +408,7 @@ class CustomTurtleSerializer(TurtleSerializer):
 
         sym_cases = []
         for p in self.symmetric_predicates:
-            for s, o in store.subject_objects(p):
+            for s, o in list(store.subject_objects(p)):
                 if isinstance(s, URIRef) and isinstance(o, URIRef):
                     if s < o:
                         pass  # always put disjointness axioms earlier in the file
@@ -317,16 +429,22 @@ class CustomTurtleSerializer(TurtleSerializer):
         super(CustomTurtleSerializer, self).__init__(store)
         self.litsortkey = self.make_litsortkey(self.sortkey)
         self.rank_init = 0
+        with self._phase('term keys'):
+            self.term_keys = TermKeys(self)
         #self.terminals = set(s for s in self.store.subjects(RDF.type, None) if isinstance(s, URIRef))
-        self.predicate_rank = self._PredRank()
-        self.object_rank = self._LitUriRank()
+        with self._phase('predicate rank'):
+            self.predicate_rank = self._PredRank()
+        with self._phase('literal uri rank'):
+            self.object_rank = self._LitUriRank()
         or_values = tuple(self.object_rank.values())
         self.max_or = (max(or_values) + 1) if or_values else 1
         self.nosort = set()
-        self.list_rankers = self._ListRank()
+        with self._phase('list rank'):
+            self.list_rankers = self._ListRank()
         self.max_lr = len(self.list_rankers)
         self._list_helpers = {n:p for p, lr in self.list_rankers.items() for n in lr.nodes}
-        self.node_rank = self._BNodeRank()
+        with self._phase('bnode rank'):
+            self.node_rank = self._BNodeRank()
         for s, p, o in sym_cases:
             rs, ro = self._globalSortKey(s), self._globalSortKey(o)
             if rs > ro :  # TODO verify that this does what we expect
@@ -351,11 +469,10 @@ class CustomTurtleSerializer(TurtleSerializer):
                               # order every time, if iteration order changed each time then this would break
                               # since this is mostly for debug and tests I'm not particularly worried about it
                                         )))}
-            self._ilu = {v: k for k, v in lu.items()}
             for _k, _v in lu.items():
                 self.node_rank[_v] = self.node_rank[_k]
 
-            for s, p, o in store:
+            for s, p, o in list(store):
                 if isinstance(s, BNode):
                     ns = lu[s]
                 else:
@@ -394,126 +511,204 @@ class CustomTurtleSerializer(TurtleSerializer):
             [sys.stderr.write('{:<30} {}\n'.format(self.store.qname(p), i))
              for i, p in enumerate(self.predicateOrder)]
         if DEBUG: debug()
+        count = self._recording().count
+        count('bnodes', len(self.node_rank))
+        count('lists', len(self.list_rankers))
+        count('qname cache hits', self.term_keys.hits)
+        count('qname cache misses', len(self.term_keys._uri_keys))
+
+        del self.term_keys  # only needed for ranking
 
         # hopefully reduce any memory load?
         self.list_rankers = None
         self._list_helpers = None
 
     def _BNodeRank(self):
-        empty = []
-        bnodes = {}
+        """ Rank bnodes by the ranks of their objects and list members.
+
+            Each bnode has a rank vector with four sections, visible
+            objects (URIRefs and Literals) by predicate rank, invisible
+            objects (bnodes) by predicate rank, visible list members, and
+            invisible list members. The vectors are flat tuples of ints
+            that sort the same way as the nested lists they encode.
+
+            predicate sections (pr, r, r, ..., -1, pr, r, ..., -1, npreds)
+            list sections (r, r, ..., -1) or (max_worst_case, -1) if empty
+
+            -1 sorts before any rank so that shorter lists sort first and
+            npreds sorts after any predicate rank so that a predicate that
+            is missing sorts after one that is present.
+
+            Only the invisible sections depend on the ranks of other bnodes
+            so after the initial ranking only the vectors of bnodes whose
+            children changed rank are recomputed, until no vector changes. """
+
+        object_rank = self.object_rank
+        predicate_rank = self.predicate_rank
+        first, rest = RDF.first, RDF.rest
+        bnode_types = BNode, QuotedGraph
+        index = {}
         rerank = {}
-        for t in self.store:
-            for i, v in enumerate(t):
-                if isinstance(v, BNode) or isinstance(v, QuotedGraph):
-                    if v not in bnodes:
-                        bnodes[v] = [[empty for _ in range(self.npreds)],
-                                     [empty for _ in range(self.npreds)],
-                                     [[], []]]
-                    if i == 2:
-                        if isinstance(t[0], URIRef):
-                            if v not in rerank:
-                                rerank[v] = []
-                            rerank[v].append(self.object_rank[t[0]])
-
-        max_worst_case = len(bnodes) + self.max_or + 2
-        mwc = [max_worst_case]
-        mwcm1 = [max_worst_case - 1]
-        def smwc(l):
-            return [_ if _ else mwc for _ in l]
-        def normalize():
-            for node, (vl, il, (listlists)) in bnodes.items():
-                if node in self.nosort:  # FIXME slow, break out before?
-                    continue
-                for l in vl + il + listlists:  # FIXME SLOW
-                    if not (l is empty or l is mwc):
-                        l.sort()
-            return {k:[smwc(v), smwc(i), smwc(ll)]
-                    for k, (v, i, ll) in bnodes.items()}
-        def rank():
-            old_ls = None
-            out = {}
-            i = 0  # skip zero so we don't overwrite it
-            for nb, ls in sorted(normalize().items(), key=lambda t: t[1]):
-                if ls != old_ls:
-                    i += 1
-                old_ls = ls
-                out[nb] = i
-            return out
-        def specref(rank_vec, pr):
-            rv = rank_vec[pr]
-            if rv is empty:
-                rv = rank_vec[pr] = []
-            elif rv is mwc:
-                rv = rank_vec[pr] = [max_worst_case]
-            elif rv is mwcm1:
-                rv = rank_vec[pr] = [max_worst_case - 1]
-            return rv
-        def fixedpoint(ranks):
-            for n, rank_vecs in bnodes.items():
-                if n in self._list_helpers:
-                    if DEBUG:
-                        list_internals.add(n)
-                    continue
-                rank_vecs[1] = [empty for _ in range(self.npreds)]
-                rank_vecs[2][1] = []
-                if n in self.list_rankers:
-                    rank_vecs[2][1].extend(self.list_rankers[n].irank_vec(ranks))
-                for p, o in self.store.predicate_objects(n):
-                    # TODO speedup by not looking up from store every time
-                    if o not in self.object_rank:
-                        if p == RDF.first or p == RDF.rest:
-                            # these are the list ranker head cases
-                            continue
-
-                        pr = self.predicate_rank[p]
-                        invisible_ranks = rank_vecs[1]
-                        rv = specref(invisible_ranks, pr)
-                        rv.append(ranks[o])
-
+        pos = {}
+        for s, p, o in self.store:
+            if isinstance(s, bnode_types):
+                if s not in index:
+                    index[s] = len(index)
+                if s not in pos:
+                    pos[s] = []
+                pos[s].append((p, o))
+            if isinstance(p, bnode_types) and p not in index:
+                index[p] = len(index)
+            if isinstance(o, bnode_types):
+                if o not in index:
+                    index[o] = len(index)
+                if isinstance(s, URIRef):
+                    if o not in rerank:
+                        rerank[o] = []
+                    rerank[o].append(object_rank[s])
+
+        nodes = list(index)
+        nnodes = len(nodes)
+        max_worst_case = nnodes + self.max_or + 2
+        end = self.npreds,
+        empty = max_worst_case, -1
+        heads = [end] * nnodes  # visible objects
+        mids = [empty] * nnodes  # visible list members
+        kids = [None] * nnodes  # invisible objects
+        lkids = [None] * nnodes  # invisible list members
+        resort = [True] * nnodes
+        parents = [[] for _ in range(nnodes)]
         if DEBUG:
             list_internals = set()
-        def one_time():
-            for n, (visible_ranks, invisible_ranks, (list_vis_rank, _list_invis_unused)) in bnodes.items():
-                if n in self._list_helpers:
-                    if DEBUG:
-                        list_internals.add(n)
+
+        for j, n in enumerate(nodes):
+            if n in self._list_helpers:
+                if DEBUG:
+                    list_internals.add(n)
+                continue
+
+            if n in self.nosort:
+                # unsorted vectors depend on store order
+                resort[j] = False
+                predicate_objects = self.store.predicate_objects(n)
+            elif n in pos:
+                predicate_objects = pos[n]
+            else:
+                predicate_objects = ()
+
+            visible = {}
+            invisible = {}
+            for p, o in predicate_objects:
+                if p == first or p == rest:
+                    # these are the list ranker head cases
                     continue
-                if n in self.list_rankers and self.list_rankers[n].vis_vals:
-                    list_vis_rank.extend(self.list_rankers[n].rank_vec)
-                for p, o in self.store.predicate_objects(n):
-                    if p == RDF.first or p == RDF.rest:
-                        # these are the list ranker head cases
-                        continue
-                    pr = self.predicate_rank[p]
-                    rv = specref(visible_ranks, pr)
-                    if o in self.object_rank:
-                        or_ = self.object_rank[o]
-                        rv.append(or_)
+                pr = predicate_rank[p]
+                if pr not in visible:
+                    visible[pr] = []
+                if o in object_rank:
+                    visible[pr].append(object_rank[o])
+                else:
+                    # presence of a more highly ranked predicate counts
+                    visible[pr].append(max_worst_case - 1)
+                    if pr not in invisible:
+                        invisible[pr] = []
+                    c = index[o]
+                    invisible[pr].append(c)
+                    parents[c].append(j)
+
+            if visible:
+                head = []
+                for pr in sorted(visible):
+                    head.append(pr)
+                    head.extend(sorted(visible[pr]) if resort[j] else visible[pr])
+                    head.append(-1)
+                heads[j] = (*head, *end)
+
+            if invisible:
+                kids[j] = [(pr, invisible[pr]) for pr in sorted(invisible)]
+
+            if n in self.list_rankers:
+                lr = self.list_rankers[n]
+                if lr.vis_vals:
+                    mid = list(lr.rank_vec)
+                    if resort[j]:
+                        mid.sort()
+                    mids[j] = (*mid, -1)
+                if lr.bvals:
+                    lkids[j] = [index[v] for v in lr.bvals]
+                    for c in lkids[j]:
+                        parents[c].append(j)
+
+        del pos  # released before the vectors are built to keep the peak down
+
+        def vector(j, ranks):
+            if kids[j] is None:
+                tail = end
+            else:
+                tail = []
+                for pr, cs in kids[j]:
+                    tail.append(pr)
+                    if resort[j]:
+                        tail.extend(sorted([ranks[c] for c in cs]))
                     else:
-                        # presence of a more highly ranked predicate counts
-                        if not rv:
-                            visible_ranks[pr] = mwcm1
-                        else:
-                            rv.append(max_worst_case - 1)
-            ranks = rank()
-            fixedpoint(ranks)
-
-        one_time()
+                        tail.extend([ranks[c] for c in cs])
+                    tail.append(-1)
+                tail.append(self.npreds)
+
+            if lkids[j] is None:
+                ltail = empty
+            else:
+                ltail = sorted([ranks[c] for c in lkids[j]])
+                ltail.append(-1)
+
+            return (*heads[j], *tail, *mids[j], *ltail)
+
+        def rank(order):
+            # order is the order from the previous round so is mostly sorted
+            order.sort(key=vectors.__getitem__)
+            ranks = [0] * nnodes
+            old_v = None
+            i = 0  # skip zero so we don't overwrite it
+            for j in order:
+                v = vectors[j]
+                if v != old_v:
+                    i += 1
+                old_v = v
+                ranks[j] = i
+            return ranks
+
+        order = list(range(nnodes))
+        vectors = [(*heads[j], *end, *mids[j], *empty) for j in order]
+        ranks = rank(order)
+        for j in order:
+            if kids[j] is not None or lkids[j] is not None:
+                vectors[j] = vector(j, ranks)
+
         i = 0
-        old_norm = None
         while 1:
             if DEBUG:
                 sys.stderr.write('\nfixed point iteration {i}'.format(i=i))
             i += 1
-            norm = normalize()
-            if old_norm == norm:
+            new_ranks = rank(order)
+            dirty = set(p for c, (r, nr) in enumerate(zip(ranks, new_ranks))
+                        if r != nr for p in parents[c])
+            ranks = new_ranks
+            changed = False
+            for j in dirty:
+                v = vector(j, ranks)
+                if v != vectors[j]:
+                    vectors[j] = v
+                    changed = True
+
+            if not changed:
                 break
-            else:
-                old_norm = norm
-                irank = rank()
-                fixedpoint(irank)
 
+        self._recording().count('fixed point rounds', i)
+
+        if not DEBUG:  # the debug output below still needs the vectors
+            del vectors, heads, mids, kids, lkids, parents
+
+        irank = {nodes[j]:ranks[j] for j in sorted(range(nnodes), key=ranks.__getitem__)}
         pair_rank = {}
         imax = [self.max_or + 1]
         for n, i in irank.items():
@@ -532,52 +727,25 @@ class CustomTurtleSerializer(TurtleSerializer):
             reirank[o] = i
 
         out = {n:i + self.max_or for n, i in reirank.items()}
-        def debug():
-            [sys.stderr.write('\n{v:<4}{k}'.format(v=v, k=k))
-             for k, v in sorted(self.object_rank.items(),
-                                key=lambda t:t[1])]
-            sys.stderr.write('\n')
-            [sys.stderr.write('\n{v:<4}{k}'.format(v=v, k=k))
-             for k, v in sorted(self.predicate_rank.items(),
-                                key=lambda t:t[1])]
-            def sss(l, k=None):
-                return ' '.join([
-                    '{:>5}'.format(str(_))
-                    if _ != [max_worst_case] else
-                    ('  -  ' if k is not None and k in list_internals else '-----')
-                    # internal list bnodes always show up as max worst
-                    # case, but we want to see which ones they are
-                    for _ in l])
-            r = {o:i for i, o in enumerate(list(zip(*sorted(rank().items(), key=lambda t:t[1])))[0])}
-            sys.stderr.write('\n\nrank index v\nout value v\npredicate ranks >\n')
-            sys.stderr.write('\n' + ' ' * 5 + sss(range(len(self.predicate_rank))) + '\n')
-            [sys.stderr.write('\n' +
-                              '{:>4} '.format(r[k]) + sss(a, k) + '\n' +
-                              '{:>4} '.format(out[k]) + sss(b, k) + '\n' +
-                              ' ' * 5 + sss(c, k))
-             #       v  i  ll
-             for k, (a, b, c) in sorted(normalize().items(),
-                                        key=lambda t:t[1])]
-            sys.stderr.write('\n' + ' ' * 5 + sss(range(len(self.predicate_rank))) + '\n')
         if DEBUG:
-            debug()
-            sigh = max(set(out.values()))
-            # sigh = self.max_or + max(set(irank.values()))  # alt calc
-            maxvt = set(k for k, v in out.items() if v == sigh)
-            maxvt_ni = maxvt - list_internals
-            derp = {k: v for k, v in bnodes.items() if k in maxvt}
-            maxvt_trips = {b:(list(self.store[b::]), list(self.store[::b])) for b in maxvt}  # ok yes these are VERY CLEARLY the list_internal cases ... wtf
-            maxvt_ni_trips = {k: v for k, v in maxvt_trips.items() if k in maxvt_ni}
-            #breakpoint()
+            sys.stderr.write('\n\nrank index v\nout value v\nvector >\n')
+            [sys.stderr.write('\n{:>4} {:>4} {}{}'.format(
+                irank[n], out[n], ' - ' if n in list_internals else '',
+                vectors[index[n]]))
+             for n in irank]
+            sys.stderr.write('\n')
 
         return out
 
     def _PredRank(self):
-        pr = sorted(sorted(set(self.store.predicates(None, None)),
-                           key=self.store.qname),
-                    key=lambda p: self.sortkey(self.store.qname(p)))
+        pr = self.term_keys.sort_uris(self.term_keys.predicates)
         # predicates in predicateOrder go first but are not guranteed to arrive
         # in predicateOrder thus a_nord
+        order = {}
+        for i, p in enumerate(self.predicateOrder):
+            if p not in order:
+                order[p] = i
+
         a_nord = []
         b = []
         for p in pr:
@@ -586,8 +754,8 @@ class CustomTurtleSerializer(TurtleSerializer):
             # because if there are duplicate values due to e.g. a subClassOf
             # URIRef being used, then len(a + b) != len(pr) therefore we only
             # iterate over pr to ensure that len(a + b) == len(pr) always
-            if p in self.predicateOrder:
-                a_nord.append((self.predicateOrder.index(p), p))
+            if p in order:
+                a_nord.append((order[p], p))
             else:
                 b.append(p)
 
@@ -595,29 +763,19 @@ class CustomTurtleSerializer(TurtleSerializer):
 
         self.predicateOrder = a + b  # predicateOrder first, then any remaining
         self.npreds = len(self.predicateOrder)
-        return {o:i for i, o in
-                enumerate(
-                    sorted(set((_ for _ in self.store.predicates())),
-                           key=self.predicateOrder.index))}
+        return {o:i for i, o in enumerate(self.predicateOrder)}
 
     def _LitUriRank(self):
+        terms = self.term_keys
         return {o:i  # global rank for all Literals and URIRefs
                 for i, o in
-                enumerate(
-                    sorted(  # doublesort needed for stability wrt case for literals
-                           sorted((_ for _ in self.store.objects()
-                                   if isinstance(_, Literal))),
-                           key=self.litsortkey) +
-                    sorted(
-                        sorted(set(_ for t in self.store for _ in t
-                                   if isinstance(_, URIRef)),
-                               key=self.store.qname),
-                        key=lambda _: self.sortkey(self.store.qname(_))))}
+                enumerate(terms.literals + terms.sort_uris(terms.uris))}
 
     def _ListRank(self):
         list_rankers = {}
+        rests = set(self.store.objects(None, RDF.rest))
         list_starts = (s for s in self.store.subjects(RDF.first, None)
-                       if not tuple(self.store.subjects(RDF.rest, s)))
+                       if s not in rests)
         for s in (*self.store.subjects(RDF.type, RDF.List), *list_starts):
             list_rankers[s] = ListRanker(s, self)
         return list_rankers
@@ -638,6 +796,21 @@ class CustomTurtleSerializer(TurtleSerializer):
 
     _topClassSortKey = _globalSortKey
 
+    @staticmethod
+    def _rankSorted(terms, key, reverse_ties=False):
+        """ same order as sorted(sorted(terms)[::-1 if reverse_ties], key=key)
+            the rdflib term ordering is only needed to break ties in rank
+            which only happens for bnodes so skip it when every rank differs """
+        ranks = {t:key(t) for t in terms}
+        if len(set(ranks.values())) == len(ranks):
+            return sorted(ranks, key=ranks.__getitem__)
+
+        presorted = sorted(ranks)
+        if reverse_ties:
+            presorted.reverse()
+
+        return sorted(presorted, key=ranks.__getitem__)
+
     def startDocument(self):  # modified to natural sort prefixes
         self._started = True
         ns_list = sorted(sorted(self.namespaces.items()), key=lambda kv: (self.sortkey(kv[0]), kv[1]))
@@ -651,8 +824,8 @@ class CustomTurtleSerializer(TurtleSerializer):
         sections = []
 
         for i, classURI in enumerate(self.topClasses):  # SECTIONS
-            members = sorted(self.store.subjects(RDF.type, classURI))
-            members.sort(key=self._topClassSortKey)
+            members = self._rankSorted(self.store.subjects(RDF.type, classURI),
+                                       self._topClassSortKey)
 
             subjects = []
             for member in members:
@@ -702,17 +875,17 @@ class CustomTurtleSerializer(TurtleSerializer):
 
     def predicateList(self, subject, newline=False):  # modified to sort object lists
         properties = self.buildPredicateHash(subject)
-        propList = self.sortProperties(properties)
+        propList = sorted(properties, key=self.predicate_rank.__getitem__)
         if len(propList) == 0:
             return
         self.verb(propList[0], newline=newline)
-        self.objectList(sorted(sorted(properties[propList[0]])[::-1], key=self._globalSortKey))  # rdf:type
+        self.objectList(self._rankSorted(properties[propList[0]], self._globalSortKey, True))  # rdf:type
         whitespace = ('{};{}'.format(self._space, self._nl) + self.indent(1)
                       if self._newline else ';')
         for predicate in propList[1:]:
             self.write(whitespace)
             self.verb(predicate, newline=self._newline)
-            self.objectList(sorted(sorted(properties[predicate])[::-1], key=self._globalSortKey))
+            self.objectList(self._rankSorted(properties[predicate], self._globalSortKey, True))
 
         return True
 
@@ -892,6 +1065,54 @@ class CustomTurtleSerializer(TurtleSerializer):
     def getQName(self, uri, gen_prefix=True): # modified to make it possible to block gen_prefix
         return super(CustomTurtleSerializer, self).getQName(uri, gen_prefix and self._gen_prefix)
 
+    def reset(self):
+        super().reset()
+        self._buffer = []
+        self._buffer_size = 0
+        self._max_buffer_bytes = self.max_buffer_bytes
+
+    def write(self, text):  # modified to write whole subject blocks at a time
+        data = text.encode(self.encoding, 'replace')
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size > self._max_buffer_bytes:
+            self.flush()
+
+    def _setInstrumentation(self, instrument):
+        """ instrument is True for a new Instrumentation or an existing
+            Instrumentation to record into, anything already recorded
+            by this serializer is carried over """
+        if not instrument or instrument is self.instrumentation:
+            return
+
+        inst = Instrumentation() if instrument is True else instrument
+        inst.update(self._recording())
+        self.instrumentation = inst
+        self._unreported = Instrumentation()
+
+    def _recording(self):
+        return self._unreported if self.instrumentation is None else self.instrumentation
+
+    def _phase(self, name):
+        return self._recording().phase(name)
+
+    def flush(self):
+        """ write any buffered output to the stream """
+        if self._buffer:
+            self._recording().count('bytes written', self._buffer_size)
+
+            self.stream.write(b''.join(self._buffer))
+            self._buffer = []
+            self._buffer_size = 0
+
+    def preprocess(self):  # modified to only retain reference counts for bnodes
+        super().preprocess()
+        # only bnode counts are ever used, all the other counts are
+        # dead weight for the whole of serialization on large graphs,
+        # Counter so that lookups of missing nodes do not insert them
+        self._references = Counter({n: c for n, c in self._references.items()
+                                    if isinstance(n, BNode)})
+
     def _write(self, value):
         """ rename to write and import inspect to debut the callstack """
         if ' ' in value:
@@ -901,24 +1122,60 @@ class CustomTurtleSerializer(TurtleSerializer):
         super().write(value)
 
     def serialize(self, stream, base=None, encoding=None,  # modified to enable section headers
-                  spacious=None, gen_prefix=True, **args):
+                  spacious=None, gen_prefix=True, max_buffer_bytes=None,
+                  parallel=None, instrument=None, **args):
+        """ Each subject block is written to stream as soon as it is
+            complete, blocks that grow past max_buffer_bytes are written
+            out in pieces. Set max_buffer_bytes=0 to write unbuffered.
+
+            If parallel > 1 subject blocks are written by that many
+            processes and then concatenated in order, the output is
+            identical to the single process output. Requires fork.
+
+            If instrument is True or an Instrumentation phase times and
+            counters, including those for ranking, are recorded in
+            self.instrumentation. """
+        self._setInstrumentation(instrument)
         self.reset()
         self.stream = stream
         self.base = base
+        if max_buffer_bytes is not None:
+            self._max_buffer_bytes = max_buffer_bytes
+
+        if parallel is None:
+            parallel = self.parallel
 
         if spacious is not None:
             self._spacious = spacious
 
         self._gen_prefix = gen_prefix
 
-        self.preprocess()
-        sections_list = self.orderSubjects()
+        with self._phase('preprocess'):
+            self.preprocess()
+        with self._phase('order subjects'):
+            sections_list = self.orderSubjects()
 
-        self.startDocument()
+        with self._phase('write'):
+            self.startDocument()
 
+            if parallel > 1 and can_fork():
+                self._serializeParallel(sections_list, parallel)
+            else:
+                self._writeBlocks(self._sectionBlocks(sections_list))
+
+            self.endDocument()
+            n, v = self._name, self.__version
+            self.write(self._nl)
+            self.write(u'### Serialized using the {} serializer {}{}'.format(n, v, self._nl))
+            self.flush()
+
+    def _sectionBlocks(self, sections_list):
+        """ Yield (header, None) for section headers and (None, subject)
+            for subject blocks in output order. Subjects must be marked
+            done before the next value is requested. """
         whitespace = self._nl if self._newline else ''
-        firstTime = True
-        for header, subjects_list in zip(self.SECTIONS, sections_list):
+        for i, (header, subjects_list) in enumerate(zip(self.SECTIONS, sections_list)):
+            sections_list[i] = None  # release each section once written
             if subjects_list and header:
                 # check if there is at least one subject that is not done
                 # so that we only emit headers when there are things that
@@ -926,7 +1183,7 @@ class CustomTurtleSerializer(TurtleSerializer):
                 # next section
                 for subject in subjects_list:
                     if not self.isDone(subject):
-                        self.write(whitespace + header)
+                        yield whitespace + header, None
                         break
                 else:
                     continue
@@ -934,32 +1191,92 @@ class CustomTurtleSerializer(TurtleSerializer):
             for subject in subjects_list:
                 if self.isDone(subject):
                     continue
-                if firstTime:
-                    firstTime = False
-                if self.statement(subject) and not firstTime:
-                    self.write(self._nl)
-
-        self.endDocument()
-        stream.write(self._nl.encode('ascii'))
-        n, v = self._name, self.__version
-        stream.write(u'### Serialized using the {} serializer {}{}'.format(n, v, self._nl).encode('ascii'))
+                yield None, subject
+
+    def _writeBlocks(self, blocks):
+        for header, subject in blocks:
+            if header is not None:
+                self.write(header)
+                continue
+
+            if self.statement(subject):
+                self.write(self._nl)
+
+            self.flush()
+
+    def _markBlock(self, subject):
+        """ Mark every node that statement would serialize as part of the
+            block for subject without writing anything. Follows the rules
+            in p_squared and doList. """
+        serialized = self._serialized
+        references = self._references
+        store = self.store
+        serialized[subject] = True
+        expand = [subject]  # nodes whose predicate lists are written
+        while expand:
+            candidates = [n for po in store.predicate_objects(expand.pop()) for n in po]
+            while candidates:
+                node = candidates.pop()
+                if (not isinstance(node, BNode)
+                    or node in serialized
+                    or references[node] > 1):
+                    continue
 
-        if self._do_id_swap:
-            # undo the debug
-            for s, p, o in self.store:
-                if isinstance(s, BNode):
-                    ns = self._ilu[s]
+                if self.isValidList(node):
+                    l = node
+                    while l:
+                        item = store.value(l, RDF.first)
+                        if item is not None:
+                            candidates.append(item)
+                        serialized[l] = True
+                        l = store.value(l, RDF.rest)
                 else:
-                    ns = s
+                    serialized[node] = True
+                    expand.append(node)
+
+    def _serializeParallel(self, sections_list, parallel):
+        # plan which blocks are written and which nodes each block
+        # serializes so that each chunk can start from the exact
+        # state it would have in a single process, since _serialized
+        # preserves insertion order the state before a chunk is the
+        # first n nodes marked by the blocks before it
+        blocks = []
+        done = []
+        for header, subject in self._sectionBlocks(sections_list):
+            blocks.append((header, subject))
+            if subject is not None:
+                self._markBlock(subject)
+            done.append(len(self._serialized))
+
+        nchunks = min(len(blocks), parallel * 4)
+        bounds = [len(blocks) * i // nchunks for i in range(nchunks + 1)]
+        starts, stops = bounds[:-1], bounds[1:]
+        before = [done[start - 1] if start else 0 for start in starts]
+        after = [done[stop - 1] for stop in stops]
+
+        self.flush()  # so the workers start with an empty buffer
+        self._blocks = blocks
+        self._planned = list(self._serialized)
+        try:
+            chunks = fork_map(self._serializeChunk, parallel, starts, stops, before)
+            for (data, n_done), n_expect in zip(chunks, after):
+                if n_done != n_expect:
+                    raise RuntimeError('parallel serialization diverged from the plan '
+                                       f'{n_done} != {n_expect}')
 
-                if isinstance(o, BNode):
-                    no = self._ilu[o]
-                else:
-                    no = o
+                self._recording().count('bytes written', len(data))
 
-                if isinstance(s, BNode) or isinstance(o, BNode):
-                    self.store.remove((s, p, o))
-                    self.store.add((ns, p, no))
+                self.stream.write(data)
+        finally:
+            del self._blocks, self._planned
+
+    def _serializeChunk(self, start, stop, before):
+        """ runs in a forked worker, workers are reused between chunks """
+        self._serialized = dict.fromkeys(islice(self._planned, before), True)
+        self.stream = BytesIO()
+        self._writeBlocks(self._blocks[start:stop])
+        self.flush()
+        return self.stream.getvalue(), len(self._serialized)
 
 
 class HtmlTurtleSerializer(CustomTurtleSerializer):
@@ -1061,7 +1378,7 @@ class CompactTurtleSerializer(CustomTurtleSerializer):
     _compact = True
 
     def __init__(self, store):
-        from collections import Counter
+        store = overlay(store)
         counts = Counter(e for t in store
                          for e in (*t, *(_.datatype
                                         for _ in t
@@ -1069,13 +1386,9 @@ class CompactTurtleSerializer(CustomTurtleSerializer):
                          if isinstance(e, URIRef))
         preds = set(v for v, c in counts.items() if c > 2 and len(v) > 10)
         if not self._compact:
-            nm_store = store.store
-            real_namespace = getattr(nm_store, f'_{nm_store.__class__.__name__}__namespace')
-            real_prefix = getattr(nm_store, f'_{nm_store.__class__.__name__}__prefix')
-            for p, n in tuple(real_namespace.items()):
+            for p, n in tuple(store.namespaces()):
                 if n in preds:
-                    real_namespace.pop(p)
-                    real_prefix.pop(n)
+                    store.store.unbind(p)
         store.namespace_manager.reset()
         if self._compact:
             #existing = set(n for q, n in store.namespace_manager.namespaces())
@@ -1126,9 +1439,10 @@ class SubClassOfTurtleSerializer(CustomTurtleSerializer):
     short_name = 'scottl'
     _name = 'ttlser subClassOf deterministic'
 
-    def __init__(self, store):
-        super(SubClassOfTurtleSerializer, self).__init__(store)
-        self.topclass_rank = self._TCRank()
+    def __init__(self, store, *args, **kwargs):
+        super(SubClassOfTurtleSerializer, self).__init__(store, *args, **kwargs)
+        with self._phase('top class rank'):
+            self.topclass_rank = self._TCRank()
 
     def _topClassSortKey(self, bnode):
         if isinstance(bnode, BNode):
@@ -1200,15 +1514,124 @@ class SubClassOfTurtleSerializer(CustomTurtleSerializer):
         return {o:i  # global rank for all Literals and URIRefs
                 for i, o in
                 enumerate(
-                    sorted(  # doublesort needed for stability wrt case for literals
-                           sorted((_ for _ in self.store.objects()
-                                   if isinstance(_, Literal))),
-                           key=self.litsortkey) +
+                    [o for o in self.object_rank if isinstance(o, Literal)] +
                     sorted(
                         sorted(uris, key=self.store.qname),
                         key=wrapsort))}
 
 
-__all__ = ['natsort', CustomTurtleSerializer.__name__] + [
+class CanonicalNTriplesSerializer(Serializer):
+    """ Sorted N-Triples, one triple per line, with blank node labels
+        derived from the content of each blank node by IdentityBNode
+        so that isomorphic graphs serialize to identical bytes.
+
+        Lines are sorted using an external merge sort, at most
+        max_sort_bytes of lines are kept in memory, sorted runs
+        beyond that are spilled to temporary files and merged. """
+
+    max_sort_bytes = 2 ** 24
+
+    def __init__(self, store):
+        from pyontutils.identity_bnode import IdentityBNode, idf
+        self._IdentityBNode = IdentityBNode
+        self._idf = idf
+        self.spills = 0
+        super().__init__(store)
+
+    def bnode_labels(self):
+        """ Blank nodes whose content is unique are labeled with their
+            identity. Blank nodes that share content with other blank
+            nodes are labeled with a hash of their content and of the
+            subjects and predicates that reference them, the remaining
+            duplicates are indistinguishable and are numbered. """
+        graph = self.store
+        try:
+            ibn = self._IdentityBNode(graph)
+        except NotImplementedError as e:
+            # IdentityBNode is not stable for graphs with bnode cycles
+            msg = f'{self.__class__.__name__} cannot serialize graphs with blank node cycles'
+            raise ValueError(msg) from e
+
+        condensed = self._idf['((p o) ...)']
+        identities = {s: v for (s, *rest), v in ibn._if_cache.partition_items(graph)
+                      if rest == [condensed] and isinstance(s, BNode)}
+        del ibn
+
+        bnodes = {e for t in graph for e in t if isinstance(e, BNode)}
+        shared = Counter(identities.get(b) for b in bnodes)
+        labels = {}
+        for b in bnodes:
+            identity = identities.get(b)
+            if identity is not None and shared[identity] == 1:
+                labels[b] = identity.hex()
+
+        # referencing bnodes must be labeled first, use an explicit
+        # stack since chains of shared list cells can be very long
+        numbered = Counter()
+        stack = [b for b in bnodes if b not in labels]
+        while stack:
+            b = stack.pop()
+            if b in labels:
+                continue
+
+            referrers = list(graph.subject_predicates(b))
+            unlabeled = [s for s, p in referrers
+                         if isinstance(s, BNode) and s not in labels and s != b]
+            if unlabeled:
+                stack.append(b)
+                stack.extend(unlabeled)
+                continue
+
+            context = sorted((labels[s] if isinstance(s, BNode) else s.n3()) + ' ' + p.n3()
+                             for s, p in referrers)
+            m = hashlib.sha256(identities.get(b, b''))
+            m.update('\n'.join(context).encode())
+            label = m.hexdigest()
+            if numbered[label]:
+                labels[b] = f'{label}_{numbered[label]}'
+            else:
+                labels[b] = label
+
+            numbered[label] += 1
+
+        return labels
+
+    def lines(self, labels):
+        for triple in self.store:
+            yield _nt_row(tuple(BNode(labels[e]) if isinstance(e, BNode) else e
+                                for e in triple)).encode()
+
+    def serialize(self, stream, base=None, encoding=None, max_sort_bytes=None, **args):
+        if max_sort_bytes is None:
+            max_sort_bytes = self.max_sort_bytes
+
+        labels = self.bnode_labels()
+        lines = ExternalSort(max_sort_bytes)
+        try:
+            for line in self.lines(labels):
+                lines.add(line)
+
+            del labels
+            self.spills += lines.spills
+            previous = None
+            buffer, size = [], 0
+            for line in lines:
+                if line == previous:  # the same triple from multiple contexts
+                    continue
+
+                previous = line
+                buffer.append(line)
+                size += len(line)
+                if size > 2 ** 16:
+                    stream.write(b''.join(buffer))
+                    buffer, size = [], 0
+
+            stream.write(b''.join(buffer))
+        finally:
+            lines.close()
+
+
+__all__ = ['natsort', CustomTurtleSerializer.__name__,
+           CanonicalNTriplesSerializer.__name__] + [
     c.__name__ for c in subclasses(CustomTurtleSerializer)
 ]
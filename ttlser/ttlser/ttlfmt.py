@@ -20,19 +20,30 @@ Options:
     -t --outfmt=F   specify the output format [default: nifttl]
 
     -s --slow       do not use a process pool
+    -w --workers=N  size of the process pool, defaults to the cpu count
+    --jobs=N        serialize each file using N processes [default: 1]
+    --check         report files that would be reformatted but do not write
+    --no-cache      do not skip files that were already formatted
     -n --nowrite    parse the file and reserialize it but do not write changes
     -o --output=FI  serialize all input files to output file
-    -p --profile    enable profiling on parsing and serialization
+    -p --profile    enable profiling and report parse and serialize times
     -d --debug      launch debugger after parsing and before serialization
 
     --curies-from=F parse using curies from file F
     --noreord       do not reorder lists when serializing
     --id-swap       use consecutive integers for bnode ids
 
+Files that are already formatted are remembered in a cache under
+$XDG_CACHE_HOME/ttlfmt (~/.cache/ttlfmt) and are not parsed again.
+
 """
 import os
 import sys
+import sqlite3
+import hashlib
 from io import StringIO, TextIOWrapper
+from time import time
+from contextlib import closing
 from json.decoder import JSONDecodeError
 from concurrent.futures import ProcessPoolExecutor
 from docopt import docopt, parse_defaults
@@ -52,6 +63,93 @@ def getVersion():
     return version
 
 
+class SkipCache:
+    """ Map the sha256 of an input file, the serializer, the ttlser
+        version, and any options that change the output to the sha256
+        of the output so that files that are already formatted can be
+        skipped without parsing them. """
+
+    def __init__(self, options='', path=None):
+        if path is None:
+            cache_home = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+            path = os.path.join(cache_home, 'ttlfmt', 'cache.sqlite')
+
+        self.path = path
+        self.options = options
+        self.version = getVersion()
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=60)
+        conn.execute('CREATE TABLE IF NOT EXISTS formatted ('
+                     'input TEXT, serializer TEXT, version TEXT, options TEXT, output TEXT, '
+                     'PRIMARY KEY (input, serializer, version, options))')
+        return conn
+
+    def get(self, input_sha, serializer):
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT output FROM formatted WHERE input = ? AND '
+                               'serializer = ? AND version = ? AND options = ?',
+                               (input_sha, serializer, self.version, self.options)).fetchone()
+
+        return row[0] if row else None
+
+    def put(self, input_sha, serializer, output_sha):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('INSERT OR REPLACE INTO formatted VALUES (?, ?, ?, ?, ?)',
+                         (input_sha, serializer, self.version, self.options, output_sha))
+
+
+class AllPredicates:
+    def __contains__(self, other):
+        return True
+
+
+# namespace manager loaded from --curies-from by configure
+_use_nsm = None
+
+
+def configure(outfmt, noreord=False, id_swap=False, curies_from=None):
+    """ Set serializer options and load the serializer plugin, run once
+        in the main process and once in each worker process. Returns the
+        namespace manager for curies_from so both paths use the same one. """
+    global _use_nsm
+    if curies_from:
+        ucg = GRAPHCLASS()
+        ucg.parse(curies_from)
+        _use_nsm = ucg.namespace_manager
+    else:
+        _use_nsm = None
+
+    if noreord or id_swap:
+        from ttlser.serializers import CustomTurtleSerializer
+
+    if noreord:
+        CustomTurtleSerializer.no_reorder_list = AllPredicates()
+
+    if id_swap:
+        CustomTurtleSerializer._do_id_swap = True
+
+    rdflib.plugin.get(outfmt, rdflib.serializer.Serializer)
+    return _use_nsm
+
+
+def convert_configured(file, **kwargs):
+    """ convert in a worker process with the curies loaded by configure """
+    return convert(file, use_nsm=_use_nsm, **kwargs)
+
+
+def by_size(files):
+    """ largest files first so that a run is not bounded by a
+        worker that happens to draw the largest files last """
+    return sorted(files, key=lambda f: os.path.getsize(os.path.expanduser(f)), reverse=True)
+
+
+def report_times(path, start, parsed, done):
+    sys.stderr.write('TIMES {} parse {:.3f}s serialize {:.3f}s\n'.format(
+        path, parsed - start, done - parsed))
+
+
 def prepare(filepath_or_stream, outpath=None, stream=False):
     if stream:
         infmt_guess = 'turtle'
@@ -118,7 +216,7 @@ def parse(source, format_guess, outpath, graph=None, infmt=None, graph_class=GRA
 
 
 def serialize(graph, outpath, outfmt=defaults['--outfmt'],
-              debug=False, profile=False, nowrite=False):
+              debug=False, profile=False, nowrite=False, jobs=1, check=False):
     if debug:
         if type(outpath) == type(sys.stdout):
             pipe_debug(graph=graph, outpath=outpath)
@@ -134,11 +232,24 @@ def serialize(graph, outpath, outfmt=defaults['--outfmt'],
     else:
         kwargs = {}
 
+    if jobs > 1:
+        kwargs['parallel'] = jobs
+
+    if profile:
+        # serializers that do not record phases ignore this
+        from ttlser.serializers import Instrumentation
+        kwargs['instrument'] = instrumentation = Instrumentation()
+
     out = graph.serialize(format=outfmt, encoding='utf-8', **kwargs)
+    if profile and (instrumentation.times or instrumentation.counts):
+        sys.stderr.write('PHASES {}\n{}'.format(outpath, instrumentation))
+
+    if check:
+        return out
 
     if nowrite:
         sys.stderr.write('FILE NOT WRITTEN {}\n'.format(outpath))
-        return
+        return out
 
     if profile:
         sys.stderr.write('PARSING Success {}\n'.format(outpath))
@@ -148,15 +259,63 @@ def serialize(graph, outpath, outfmt=defaults['--outfmt'],
         with open(outpath, 'wb') as f:
             f.write(out)
 
+    return out
+
+
+def format_file(filepath, infmt=None, outfmt=defaults['--outfmt'],
+                debug=False, profile=False, nowrite=False, use_nsm=None,
+                jobs=1, cache=None, check=False):
+    """ Format filepath in place. Returns True if the file was changed
+        or would be changed when check is True. """
+    with open(os.path.expanduser(filepath), 'rb') as f:
+        data = f.read()
+
+    input_sha = hashlib.sha256(data).hexdigest()
+    output_sha = None if cache is None else cache.get(input_sha, outfmt)
+    if output_sha == input_sha:
+        return False  # already formatted
+    elif output_sha is not None and check:
+        sys.stderr.write('WOULD REFORMAT {}\n'.format(filepath))
+        return True
+
+    start = time()
+    graph, outpath = parse(**prepare(filepath), infmt=infmt, use_nsm=use_nsm)
+    parsed = time()
+    out = serialize(graph, outpath,
+                    outfmt=outfmt, debug=debug, profile=profile, nowrite=nowrite,
+                    jobs=jobs, check=check)
+    if profile:
+        report_times(filepath, start, parsed, time())
+
+    if cache is not None:
+        cache.put(input_sha, outfmt, hashlib.sha256(out).hexdigest())
+
+    changed = out != data
+    if check and changed:
+        sys.stderr.write('WOULD REFORMAT {}\n'.format(filepath))
+
+    return changed
+
 
 def convert(file_or_list_or_stream, outpath=None, stream=False,
             infmt=None, outfmt=defaults['--outfmt'],
-            debug=False, profile=False, nowrite=False, graph_class=GRAPHCLASS, use_nsm=None):
+            debug=False, profile=False, nowrite=False, graph_class=GRAPHCLASS, use_nsm=None,
+            jobs=1, cache=None, check=False):
     if stream or type(file_or_list_or_stream) == str:
         file_or_stream = file_or_list_or_stream
-        serialize(*parse(**prepare(file_or_stream, outpath, stream),
-                         infmt=infmt, use_nsm=use_nsm),
-                  outfmt=outfmt, debug=debug, profile=profile, nowrite=nowrite)
+        if stream or outpath is not None:
+            start = time()
+            graph, outpath = parse(**prepare(file_or_stream, outpath, stream),
+                                   infmt=infmt, use_nsm=use_nsm)
+            parsed = time()
+            serialize(graph, outpath,
+                      outfmt=outfmt, debug=debug, profile=profile, nowrite=nowrite, jobs=jobs)
+            if profile:
+                report_times('<stdin>' if stream else file_or_stream, start, parsed, time())
+        else:
+            return format_file(file_or_stream, infmt=infmt, outfmt=outfmt,
+                               debug=debug, profile=profile, nowrite=nowrite,
+                               use_nsm=use_nsm, jobs=jobs, cache=cache, check=check)
     else:
         # file list is used here because this allows is to merge files
         # without any additional code if we pass it more than one file
@@ -167,11 +326,12 @@ def convert(file_or_list_or_stream, outpath=None, stream=False,
 
             [parse(**prepare(file, outpath), graph=graph, infmt=infmt, use_nsm=use_nsm) for file in file_list]
             serialize(graph, outpath, outfmt=outfmt,
-                      debug=debug, profile=profile, nowrite=nowrite)
+                      debug=debug, profile=profile, nowrite=nowrite, jobs=jobs)
         else:
-            [convert(file, infmt=infmt, outfmt=outfmt,
-                     debug=debug, profile=profile,
-                     graph_class=graph_class, use_nsm=use_nsm) for file in file_list]
+            return any([convert(file, infmt=infmt, outfmt=outfmt,
+                                debug=debug, profile=profile, nowrite=nowrite,
+                                graph_class=graph_class, use_nsm=use_nsm, jobs=jobs,
+                                cache=cache, check=check) for file in file_list])
 
 
 def pipe_debug(*args, source=None, graph=None, outpath=None, **kwargs):
@@ -198,6 +358,7 @@ def main():
             pass
 
     nowrite = args['--nowrite']
+    jobs = int(args['--jobs'])
 
     infmt = args['--format']
     debug = args['--debug']
@@ -220,25 +381,23 @@ def main():
     outpath = args['--output']
     files = args['<file>']
 
-    if args['--curies-from']:
-        ucg = GRAPHCLASS()
-        ucg.parse(args['--curies-from'])
-        use_nsm = ucg.namespace_manager
-    else:
-        use_nsm = None
-
-    if args['--noreord'] or args['--id-swap']:
-        from ttlser.serializers import CustomTurtleSerializer
-
-    if args['--noreord']:
-        class AllPredicates:
-            def __contains__(self, other):
-                return True
+    config = outfmt, args['--noreord'], args['--id-swap'], args['--curies-from']
+    use_nsm = configure(*config)
 
-        CustomTurtleSerializer.no_reorder_list = AllPredicates()
+    check = args['--check']
+    if check and (outpath or not files):
+        # there is no file to compare against when writing elsewhere
+        sys.stderr.write('--check cannot be combined with --output or stdin\n')
+        sys.exit(2)
 
-    if args['--id-swap']:
-        CustomTurtleSerializer._do_id_swap = True
+    if args['--no-cache']:
+        cache = None
+    else:
+        # everything other than the serializer that changes the output, the
+        # flags come from config so they match what the workers were given
+        options = repr((infmt, *config[1:-1],
+                        sorted(use_nsm.namespaces()) if use_nsm else None))
+        cache = SkipCache(options=options)
 
     if not files:
         from ttlser.utils import readFromStdIn
@@ -247,7 +406,7 @@ def main():
             convert(stdin, outpath, stream=True,
                     infmt=infmt, outfmt=outfmt,
                     debug=debug, profile=profile,
-                    nowrite=nowrite, use_nsm=use_nsm)
+                    nowrite=nowrite, use_nsm=use_nsm, jobs=jobs)
         else:
             print(__doc__)
     else:
@@ -256,22 +415,29 @@ def main():
             if lenfiles == 1:
                 files,  = files
 
-            convert(files, outpath=outpath,
-                    infmt=infmt, outfmt=outfmt,
-                    debug=debug, profile=profile,
-                    nowrite=nowrite, use_nsm=use_nsm)
+            changed = convert(files, outpath=outpath,
+                              infmt=infmt, outfmt=outfmt,
+                              debug=debug, profile=profile,
+                              nowrite=nowrite, use_nsm=use_nsm, jobs=jobs,
+                              cache=cache, check=check)
         else:
-            from joblib import Parallel, delayed
-            nj = 9
-            if lenfiles < nj:
-                nj = lenfiles
-
-            Parallel(n_jobs=nj, verbose=10)(delayed(convert)
-                                            (file,
-                                             infmt=infmt, outfmt=outfmt,
-                                             debug=debug, profile=profile,
-                                             nowrite=nowrite)
-                                            for file in files)
+            workers = (int(args['--workers']) if args['--workers'] else
+                       os.cpu_count() or 1)
+            workers = min(workers, lenfiles)
+            # worker processes are reused so configure runs once per worker
+            with ProcessPoolExecutor(max_workers=workers,
+                                     initializer=configure,
+                                     initargs=config) as executor:
+                futures = [executor.submit(convert_configured, file,
+                                           infmt=infmt, outfmt=outfmt,
+                                           debug=debug, profile=profile,
+                                           nowrite=nowrite, jobs=jobs,
+                                           cache=cache, check=check)
+                           for file in by_size(files)]
+                changed = any([future.result() for future in futures])
+
+        if check and changed:
+            sys.exit(1)
 
 
 if __name__ == '__main__':
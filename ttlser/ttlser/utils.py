@@ -1,3 +1,7 @@
+import heapq
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import rdflib
 
 rdflib.plugin.register('nifttl', rdflib.serializer.Serializer,
@@ -12,6 +16,8 @@ rdflib.plugin.register('rktttl', rdflib.serializer.Serializer,
                        'ttlser', 'RacketTurtleSerializer')
 rdflib.plugin.register('htmlttl', rdflib.serializer.Serializer,
                        'ttlser', 'HtmlTurtleSerializer')
+rdflib.plugin.register('canonical-nt', rdflib.serializer.Serializer,
+                       'ttlser', 'CanonicalNTriplesSerializer')
 
 
 def readFromStdIn(stdin=None):
@@ -26,3 +32,68 @@ def subclasses(start):
     for sc in start.__subclasses__():
         yield sc
         yield from subclasses(sc)
+
+
+def can_fork():
+    return ('fork' in multiprocessing.get_all_start_methods() and
+            not multiprocessing.current_process().daemon)
+
+
+_fork_map_function = None  # inherited by forked workers
+
+
+def _fork_map_call(*args):
+    return _fork_map_function(*args)
+
+
+def fork_map(function, workers, *iterables):
+    """ map function over iterables in forked worker processes, results
+        are yielded in order, the workers inherit function through fork
+        so it can be a bound method whose state is too big to pickle """
+    global _fork_map_function
+    _fork_map_function = function
+    try:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context('fork')) as executor:
+            yield from executor.map(_fork_map_call, *iterables)
+    finally:
+        _fork_map_function = None
+
+
+class ExternalSort:
+    """ sort lines of bytes keeping at most max_bytes of them in memory,
+        sorted runs beyond that are spilled to temporary files and merged """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.spills = 0
+        self._runs = []
+        self._run = []
+        self._size = 0
+
+    def add(self, line):
+        self._run.append(line)
+        self._size += len(line)
+        if self._size > self.max_bytes:
+            self._run.sort()
+            file = tempfile.TemporaryFile()
+            file.writelines(self._run)
+            file.seek(0)
+            self._runs.append(file)
+            self._run = []
+            self._size = 0
+            self.spills += 1
+
+    def __iter__(self):
+        self._run.sort()
+        try:
+            yield from heapq.merge(*self._runs, self._run)
+        finally:
+            self.close()
+
+    def close(self):
+        for file in self._runs:
+            file.close()
+
+        self._runs = []
+        self._run = []